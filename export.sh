@@ -29,7 +29,7 @@ LEGACY=0
 BASE=$(basename "$MODEL")
 FORMAT="mlpackage"
 FLAGS=""
-QUANTIZE="float16"
+QUANTIZE="mixed-6-4"
 
 if [[ $LEGACY -eq 1 ]]; then
 echo "Legacy mode"
@@ -1,10 +1,15 @@
-import coremltools as ct
-import coremltools.optimize.coreml as cto
+"""
+4-bit palettization of an exported model, using the pipeline in `palettize_config.yaml`:
 
+    python pallettizer.py mistral-7b-instruct-v0.2-512-fp16.mlpackage mistral-7b-instruct-v0.2-512-int4.mlpackage
+"""
+import sys
 
-uncompressed_model_path = "./mistral-7b-instruct-v0.2-512-fp16.mlpackage"
-mlmodel = ct.models.MLModel(uncompressed_model_path)
-op_config = cto.OpPalettizerConfig(mode="kmeans", nbits=4)
-config = cto.OptimizationConfig(global_config=op_config)
-compressed_mlmodel = cto.palettize_weights(mlmodel, config)
-compressed_mlmodel.save("mistral-7b-instruct-v0.2-512-int4.mlpackage")
+from exporters.coreml.compression import main
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if "--pipeline" not in args:
+        args += ["--pipeline", "palettize_config.yaml"]
+    main(args)
@@ -1,10 +1,15 @@
-import coremltools as ct
-import coremltools.optimize.coreml as cto
+"""
+Linear quantization of an exported model, using the pipeline in `linear_config.yaml`:
 
-uncompressed_model_path = "./mistral-7b-instruct-v0.2-512-fp16.mlpackage"
+    python quantize.py mistral-7b-instruct-v0.2-512-fp16.mlpackage mistral-7b-instruct-v0.2-512-int8.mlpackage
+"""
+import sys
 
-mlmodel = ct.models.MLModel(uncompressed_model_path)
-config = cto.OptimizationConfig.from_yaml("linear_config.yaml")
-compressed_mlmodel = cto.linear_quantize_weights(mlmodel, config)
+from exporters.coreml.compression import main
 
-compressed_mlmodel.save("mistral-7b-instruct-v0.2-512-int8.mlpackage")
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if "--pipeline" not in args:
+        args += ["--pipeline", "linear_config.yaml"]
+    main(args)
@@ -14,6 +14,9 @@
 # limitations under the License.
 """Core ML conversion for Hugging Face Transformers models."""
 
+from .chunks import ChunkedModel
+from .compression import CompressionPipeline
 from .config import CoreMLConfig
 from .convert import export
+from .kv_cache import KeyValueCacheManager
 from .validate import validate_model_outputs
@@ -13,26 +13,78 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextlib
+import copy
+import json
+import multiprocessing
+import os
+import sys
+import time
 import warnings
 
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 
 from coremltools import ComputeUnit
 from coremltools.models import MLModel
 from coremltools.models.utils import _is_macos, _macos_version
 
-from transformers.models.auto import AutoFeatureExtractor, AutoProcessor, AutoTokenizer
+from transformers.models.auto import AutoConfig, AutoFeatureExtractor, AutoProcessor, AutoTokenizer
 from transformers.onnx.utils import get_preprocessor
 
+from .batch import estimate_export_memory, parse_size
+from .cache import ExportCache, copy_path
+from .chunks import ChunkedModel
+from .compression import QUANTIZE_OPTIONS, get_compression_pipeline, get_variant_name, is_pipeline_file
+from .config import KV_CACHE_DTYPES, KV_CACHE_MODES
 from .convert import export
+from .profiling import Profiler, get_profiler, profile_span
 from .features import FeaturesManager
-from .validate import validate_model_outputs
+from .validate import validate_chunks, validate_kv_cache, validate_model_outputs
 from ..utils import logging
 
 
-def convert_model(preprocessor, model, model_coreml_config, args, use_past=False, seq2seq=None):
-    coreml_config = model_coreml_config(model.config, use_past=use_past, seq2seq=seq2seq)
+# The oldest PyTorch version with the CPU float16 kernels that tracing a transformer needs.
+MIN_FLOAT16_TORCH_VERSION = (2, 1)
+
+
+def convert_model(preprocessor, model, model_coreml_config, args, use_past=False, seq2seq=None, cache=None):
+    """Convert, save and validate the model. Returns the paths of the saved models."""
+    with profile_span("convert_model", seq2seq=seq2seq, use_past=use_past):
+        return _convert_model(
+            preprocessor, model, model_coreml_config, args, use_past=use_past, seq2seq=seq2seq, cache=cache
+        )
+
+
+def get_config_options(args, use_past=False, seq2seq=None):
+    """The options of the `CoreMLConfig` for the command line arguments."""
+    config_options = {}
+    if seq2seq is None and args.kv_cache != "dynamic":
+        config_options = {"kv_cache": args.kv_cache, "max_context_length": args.max_context_length}
+        if args.prefill_length is not None:
+            config_options["prefill_length"] = args.prefill_length
+    if use_past and args.new_kv_only:
+        config_options["new_kv_only"] = True
+    if use_past and args.stack_kv_cache:
+        config_options["stack_kv_cache"] = True
+    if seq2seq is not None and args.cross_attention_cache:
+        config_options["cross_attention_cache"] = True
+    # The encoder's cross-attention keys and values are inputs of the decoder, so they have the same data type.
+    if (use_past or config_options.get("cross_attention_cache")) and args.kv_cache_dtype is not None:
+        config_options["kv_cache_dtype"] = args.kv_cache_dtype
+    if not use_past and seq2seq is None and args.sequence_lengths is not None:
+        config_options["sequence_lengths"] = args.sequence_lengths
+    if args.batch_size is not None:
+        config_options["batch_size"] = args.batch_size
+    if seq2seq is None and args.num_chunks is not None:
+        config_options["num_chunks"] = args.num_chunks
+    return config_options
+
+
+def _convert_model(preprocessor, model, model_coreml_config, args, use_past=False, seq2seq=None, cache=None):
+    config_options = get_config_options(args, use_past=use_past, seq2seq=seq2seq)
+    coreml_config = model_coreml_config(model.config, use_past=use_past, seq2seq=seq2seq, **config_options)
 
     compute_units = ComputeUnit.ALL
     if args.compute_units == "cpu_and_gpu":
@@ -42,37 +94,351 @@ def convert_model(preprocessor, model, model_coreml_config, args, use_past=False
     elif args.compute_units == "cpu_and_ne":
         compute_units = ComputeUnit.CPU_AND_NE
 
-    mlmodel = export(
+    variants = args.quantize
+    filenames = {}
+    for variant in variants:
+        filename = args.output
+        if len(variants) > 1:
+            filename = filename.with_name(f"{filename.stem}-{get_variant_name(variant)}{filename.suffix}")
+        if seq2seq == "encoder":
+            filename = filename.parent / ("encoder_" + filename.name)
+        elif seq2seq == "decoder":
+            filename = filename.parent / ("decoder_" + filename.name)
+        if coreml_config.num_chunks is not None:
+            # The chunks and their manifest are saved in a directory.
+            filename = filename.with_suffix("")
+        filenames[variant] = filename.as_posix()
+
+    cache_keys = {}
+    remaining = []
+    for variant in variants:
+        cached_path = None
+        if cache is not None:
+            with profile_span("cache_lookup", quantize=variant):
+                pipeline = get_compression_pipeline(variant).to_dict()
+                cache_keys[variant] = cache.get_export_key(
+                    model, coreml_config, pipeline, compute_units, preprocessor
+                )
+                cached_path = cache.lookup_model(cache_keys[variant])
+
+        if cached_path is not None:
+            logger.info(f"Found converted model in the export cache: {cached_path}")
+            copy_path(cached_path, filenames[variant])
+        else:
+            remaining.append(variant)
+
+    if len(remaining) > 0:
+        with profile_span("export"):
+            mlmodels = export(
+                preprocessor,
+                model,
+                coreml_config,
+                quantize=remaining,
+                compute_units=compute_units,
+                cache=cache,
+                # Validation loads the saved model from disk.
+                skip_model_load=True,
+                print_artifacts=args.print_artifacts,
+                compression_workers=args.compression_workers,
+            )
+
+        def save(variant):
+            with profile_span("save", quantize=variant):
+                mlmodels[variant].save(filenames[variant])
+
+        # Writing the packages is mostly I/O, so save all variants at once.
+        with ThreadPoolExecutor(max_workers=len(remaining)) as executor:
+            list(executor.map(save, remaining))
+
+        if cache is not None:
+            for variant in remaining:
+                with profile_span("cache_store", quantize=variant):
+                    cache.store_model(cache_keys[variant], filenames[variant])
+
+    if args.atol is None:
+        args.atol = coreml_config.atol_for_validation
+
+    kv_cache_changed = (
+        coreml_config.kv_cache != "dynamic"
+        or coreml_config.new_kv_only
+        or coreml_config.stack_kv_cache
+        or coreml_config.kv_cache_dtype == "int8"
+    )
+    if seq2seq is None and kv_cache_changed:
+        # This compares the PyTorch model that gets converted, so it also runs without Core ML.
+        import torch
+
+        with profile_span("validate_kv_cache"):
+            # Also decode a few tokens after the prompt of the prefill function.
+            sequence_length = min(max(8, (coreml_config.prefill_length or 0) + 4), coreml_config.max_context_length)
+            input_ids = torch.randint(0, model.config.vocab_size, (1, sequence_length))
+            validate_kv_cache(coreml_config, model, input_ids, args.atol)
+
+    if coreml_config.num_chunks is not None:
+        import torch
+
+        with profile_span("validate_chunks"):
+            sequence_length = min(8, coreml_config.max_context_length)
+            input_ids = torch.randint(0, model.config.vocab_size, (1, sequence_length))
+            validate_chunks(coreml_config, model, input_ids, args.atol)
+
+    for variant in variants:
+        filename = filenames[variant]
+
+        if not _is_macos() or _macos_version() < (12, 0):
+            logger.info("Skipping model validation, requires macOS 12.0 or later")
+        else:
+            # Run validation on CPU
+            with profile_span("validate", quantize=variant):
+                with profile_span("validate.load_model"):
+                    if coreml_config.num_chunks is not None:
+                        mlmodel = ChunkedModel.load(filename, compute_units=ComputeUnit.CPU_ONLY)
+                    else:
+                        mlmodel = MLModel(filename, compute_units=ComputeUnit.CPU_ONLY)
+                validate_model_outputs(coreml_config, preprocessor, model, mlmodel, args.atol)
+
+        logger.info(f"All good, model saved at: {filename}")
+
+    return list(filenames.values())
+
+
+def _convert_model_in_worker(args, seq2seq, use_past, num_threads, weights_hash, log_level, profile):
+    """
+    Convert one half of a seq2seq model in a spawned process. The worker loads the preprocessor and the
+    model again, with the same load options as the parent, instead of inheriting the parent's, as Core ML
+    and PyTorch are not safe to use after a fork.
+    """
+    import torch
+    torch.set_num_threads(num_threads)
+
+    # The spawned process does not run the `__main__` block that sets up the logger.
+    global logger
+    logger = logging.get_logger("exporters.coreml")  # pylint: disable=invalid-name
+    logger.setLevel(log_level)
+
+    # The worker records into its own profiler and sends the spans back.
+    with Profiler() if profile else contextlib.nullcontext() as profiler:
+        start_time = time.perf_counter()
+        # The weights get the same data type as in the parent, and as in a sequential export, so the
+        # converted models and their cache keys do not depend on `--parallel_seq2seq`.
+        preprocessor, model, model_coreml_config = load_model(args)
+
+        cache = None
+        if weights_hash is not None:
+            # These are the same weights that the parent hashed.
+            cache = ExportCache(args.cache_dir)
+            cache.set_weights_hash(model, weights_hash)
+
+        paths = convert_model(
+            preprocessor, model, model_coreml_config, args, use_past=use_past, seq2seq=seq2seq, cache=cache
+        )
+        elapsed = time.perf_counter() - start_time
+
+    if profiler is None:
+        return paths, elapsed, None
+    return paths, elapsed, (profiler.start_time, profiler.spans)
+
+
+def convert_seq2seq_model(preprocessor, model, model_coreml_config, args, cache=None):
+    """
+    Convert the encoder and decoder of a seq2seq model. With `args.parallel_seq2seq`, the two halves
+    are converted, compressed, saved and validated at the same time in separate processes, which are
+    spawned rather than forked and load their own copy of the model. This is not shared with the parent,
+    so the peak memory is that of three copies of the weights.
+
+    Returns the paths of the saved models.
+    """
+    halves = [("encoder", False), ("decoder", args.use_past)]
+    timings = {}
+    paths = []
+
+    if args.parallel_seq2seq:
+        logger.info("Converting encoder and decoder models in parallel...")
+
+        # Hash the weights once here, for the cache keys of both workers.
+        weights_hash = cache.get_weights_hash(model) if cache is not None else None
+
+        num_threads = max(1, (os.cpu_count() or 2) // len(halves))
+        # The halves also share the palettization workers.
+        worker_args = copy.copy(args)
+        if args.compression_workers is not None:
+            worker_args.compression_workers = max(1, args.compression_workers // len(halves))
+        profiler = get_profiler()
+        with ProcessPoolExecutor(max_workers=len(halves), mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = {
+                seq2seq: executor.submit(
+                    _convert_model_in_worker,
+                    worker_args,
+                    seq2seq,
+                    use_past,
+                    num_threads,
+                    weights_hash,
+                    logger.getEffectiveLevel(),
+                    profiler is not None,
+                )
+                for seq2seq, use_past in halves
+            }
+            for seq2seq, future in futures.items():
+                worker_paths, timings[seq2seq], worker_spans = future.result()
+                paths.extend(worker_paths)
+                if worker_spans is not None:
+                    worker_start_time, spans = worker_spans
+                    profiler.add_spans(spans, offset=worker_start_time - profiler.start_time)
+    else:
+        for seq2seq, use_past in halves:
+            logger.info(f"Converting {seq2seq} model...")
+
+            start_time = time.perf_counter()
+            paths += convert_model(
+                preprocessor,
+                model,
+                model_coreml_config,
+                args,
+                use_past=use_past,
+                seq2seq=seq2seq,
+                cache=cache,
+            )
+            timings[seq2seq] = time.perf_counter() - start_time
+
+    for seq2seq, elapsed in timings.items():
+        logger.info(f"Exported {seq2seq} model in {elapsed:.1f} sec")
+
+    return paths
+
+
+def parse_quantize_options(values):
+    """
+    Expand the `--quantize` arguments into a list of variants. An argument can be a quantization option,
+    a compression pipeline file, or a JSON / YAML recipes file with a list of either under the `variants` key.
+    """
+    variants = []
+    for value in values:
+        if value in QUANTIZE_OPTIONS or is_pipeline_file(value):
+            variants.append(value)
+            continue
+
+        path = Path(value)
+        if not path.is_file():
+            raise ValueError(
+                f"Unknown quantization option '{value}', expected one of {QUANTIZE_OPTIONS}, a pipeline file, or a recipes file"
+            )
+
+        with open(path) as f:
+            if path.suffix in [".yaml", ".yml"]:
+                import yaml
+                recipes = yaml.safe_load(f)
+            else:
+                recipes = json.load(f)
+
+        if isinstance(recipes, dict):
+            recipes = recipes.get("variants", [])
+        # Pipeline files in a recipes file are relative to the recipes file.
+        recipes = [
+            recipe if recipe in QUANTIZE_OPTIONS else (path.parent / recipe).as_posix()
+            for recipe in recipes
+        ]
+        variants.extend(parse_quantize_options(recipes))
+
+    # Remove duplicates but keep the order.
+    return list(dict.fromkeys(variants))
+
+
+def parse_batch_size(value):
+    """
+    Parse the `--batch_size` argument: a range such as `1-64`, or `1-` without an upper limit, or a
+    comma-separated list of sizes such as `1,8,32`.
+    """
+    try:
+        if "-" in value:
+            min_size, max_size = value.split("-")
+            return (int(min_size), int(max_size) if max_size else -1)
+        return [int(size) for size in value.split(",")]
+    except ValueError:
+        raise ArgumentTypeError(f"Invalid batch size '{value}', expected a range such as '1-64' or a list such as '1,8,32'")
+
+
+def search_palettization_plan(preprocessor, model, model_coreml_config, args):
+    """Run the palettization search, save the plan, and add it to the variants to export."""
+    from .sensitivity import search_palettization
+
+    if args.feature in ["text2text-generation", "speech-seq2seq"]:
+        raise ValueError("--palettization_search is not supported for seq2seq models")
+
+    # Search with the same inputs and outputs as the model that gets exported.
+    config_options = get_config_options(args, use_past=args.use_past)
+    coreml_config = model_coreml_config(model.config, use_past=args.use_past, **config_options)
+    pipeline = search_palettization(
         preprocessor,
         model,
         coreml_config,
-        quantize=args.quantize,
-        compute_units=compute_units,
+        target_size=args.target_size,
+        bits_per_parameter=args.bits_per_parameter,
+        max_error=args.atol,
+        num_batches=args.calibration_batches,
+        name=args.palettization_search.stem,
     )
+    pipeline.save(args.palettization_search)
+    logger.info(f"Palettization plan saved at: {args.palettization_search}")
 
-    filename = args.output
-    if seq2seq == "encoder":
-        filename = filename.parent / ("encoder_" + filename.name)
-    elif seq2seq == "decoder":
-        filename = filename.parent / ("decoder_" + filename.name)
-    filename = filename.as_posix()
+    args.quantize = list(dict.fromkeys(args.quantize + [args.palettization_search.as_posix()]))
 
-    mlmodel.save(filename)
 
-    if args.atol is None:
-        args.atol = coreml_config.atol_for_validation
+def get_load_options(args):
+    """Decide how to load the weights so that the export stays within `args.max_memory`."""
+    if args.framework != "pt":
+        return {}
 
-    if not _is_macos() or _macos_version() < (12, 0):
-        logger.info("Skipping model validation, requires macOS 12.0 or later")
-    else:
-        # Run validation on CPU
-        mlmodel = MLModel(filename, compute_units=ComputeUnit.CPU_ONLY)
-        validate_model_outputs(coreml_config, preprocessor, model, mlmodel, args.atol)
+    if args.max_memory is not None:
+        config = AutoConfig.from_pretrained(args.model)
+        estimate = estimate_export_memory(config)
+        if not args.low_memory and estimate is not None and estimate > args.max_memory:
+            logger.info(
+                f"Estimated peak memory of {estimate / 1024**3:.1f} GB exceeds --max_memory, enabling --low_memory"
+            )
+            args.low_memory = True
+
+        estimate = estimate_export_memory(config, low_memory=args.low_memory)
+        if estimate is not None and estimate > args.max_memory:
+            logger.warning(
+                f"Estimated peak memory of {estimate / 1024**3:.1f} GB exceeds --max_memory of "
+                f"{args.max_memory / 1024**3:.1f} GB, the export may run out of memory"
+            )
+
+    if not args.low_memory:
+        return {}
+
+    import torch
 
-    logger.info(f"All good, model saved at: {filename}")
+    if any(get_compression_pipeline(variant).compute_precision == "float32" for variant in args.quantize):
+        logger.warning("Keeping the weights in float32 because a float32 variant was requested")
+        return {"low_memory": True}
+
+    # Older versions of PyTorch have no float16 kernels on the CPU for ops such as addmm and layer_norm.
+    torch_version = tuple(int(part) for part in torch.__version__.split("+")[0].split(".")[:2])
+    if torch_version < MIN_FLOAT16_TORCH_VERSION:
+        logger.warning(
+            f"Keeping the weights in float32 because tracing in float16 requires PyTorch "
+            f"{'.'.join(map(str, MIN_FLOAT16_TORCH_VERSION))} or newer"
+        )
+        return {"low_memory": True}
+
+    # The model is traced in float16 on the CPU, which does not give exactly the same trace as in float32,
+    # and the Core ML model is validated against this same float16 model rather than a float32 reference.
+    logger.warning(
+        "Loading the weights in float16: the model is traced and validated in float16, so validation "
+        "does not detect a loss of precision compared to float32"
+    )
+    return {"low_memory": True, "torch_dtype": torch.float16}
 
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        from .batch import main as batch_main
+        return batch_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == "compress":
+        from .compression import main as compression_main
+        return compression_main(sys.argv[2:])
+
     parser = ArgumentParser("Hugging Face Transformers Core ML exporter")
     parser.add_argument(
         "-m", "--model", type=str, required=True, help="Model ID on huggingface.co or path on disk to load model from."
@@ -89,18 +455,86 @@ def main():
     parser.add_argument(
         "--use_past", action="store_true", help="Export the model with precomputed hidden states (key and values in the attention blocks) for fast autoregressive decoding."
     )
+    parser.add_argument(
+        "--kv_cache", type=str, choices=KV_CACHE_MODES, default="dynamic", help="With --use_past and the text-generation feature, how the key / value cache is passed between predictions. 'static' passes a cache with room for --max_context_length tokens in and out, 'stateful' keeps that cache in the model as state."
+    )
+    parser.add_argument(
+        "--max_context_length", type=int, default=None, help="Number of tokens that fit in a fixed-size key / value cache. Defaults to the model's maximum sequence length."
+    )
+    parser.add_argument(
+        "--prefill_length", type=int, default=None, help="With --kv_cache static or stateful, export a multifunction model with a 'prefill' function for a prompt of this many tokens and a 'decode' function for one token, which share their weights."
+    )
+    parser.add_argument(
+        "--num_chunks", type=int, default=None, help="Split a text-generation decoder into this many Core ML models with a contiguous range of layers each, so they can be loaded and compiled separately. The chunks are saved in a directory with a manifest.json."
+    )
+    parser.add_argument(
+        "--new_kv_only", action="store_true", help="With --use_past, only output the keys and values of the new tokens instead of the whole cache."
+    )
+    parser.add_argument(
+        "--stack_kv_cache", action="store_true", help="With --use_past, pass the keys and values of all layers as one stacked input and output."
+    )
+    parser.add_argument(
+        "--sequence_lengths", type=int, nargs="+", default=None, help="Export the model with enumerated shapes for these sequence lengths, for example '--sequence_lengths 32 64 128', which unlike flexible shapes can run on the GPU and Neural Engine. Not supported with --use_past."
+    )
+    parser.add_argument(
+        "--batch_size", type=parse_batch_size, default=None, help="Export the model with a flexible batch size: a range such as '1-64', or '1-' without an upper limit, or enumerated sizes such as '1,8,32'. Not supported for image inputs or classifiers."
+    )
+    parser.add_argument(
+        "--kv_cache_dtype", type=str, choices=KV_CACHE_DTYPES, default=None, help="With --use_past, the data type of the key / value cache inputs and outputs. Defaults to the compute precision of the model. 'int8' quantizes every key and value vector with its own scale."
+    )
+    parser.add_argument(
+        "--cross_attention_cache", action="store_true", help="With --use_past, for an encoder-decoder model, the encoder also outputs the cross-attention keys and values of every decoder layer, which the decoder takes as inputs instead of the encoder's hidden states."
+    )
     parser.add_argument(
         "--framework", type=str, choices=["pt", "tf"], default="pt", help="The framework to use for the Core ML export."
     )
     parser.add_argument(
-        "--quantize", type=str, choices=["float32", "float16", "int8", "int4"], default="float16", help="Quantization option for the model weights."
+        "--quantize", type=str, nargs="+", default=None, help=f"Quantization option for the model weights: {', '.join(QUANTIZE_OPTIONS)}, or a compression pipeline file. Pass several options, or a recipes file, to export multiple variants at once."
     )
     parser.add_argument(
         "--legacy", action="store_true")
     parser.add_argument(
         "--compute_units", type=str, choices=["all", "cpu_and_gpu", "cpu_only", "cpu_and_ne"], default="all", help="Optimize the model for CPU, GPU, and/or Neural Engine."
     )
-    # parser.add_argument("--cache_dir", type=str, default=None, help="Path indicating where to store cache.")
+    parser.add_argument(
+        "--cache_dir", "--cache-dir", type=Path, default=None, help="Where to cache converted models. Defaults to ~/.cache/huggingface/exporters."
+    )
+    parser.add_argument(
+        "--no_cache", "--no-cache", action="store_true", help="Always convert the model, do not use or update the export cache."
+    )
+    parser.add_argument(
+        "--parallel_seq2seq", action="store_true", help="Convert the encoder and decoder of seq2seq models at the same time, in separate processes."
+    )
+    parser.add_argument(
+        "--low_memory", "--low-memory", action="store_true", help="Load the weights memory-mapped and in float16, to reduce the peak memory of the export."
+    )
+    parser.add_argument(
+        "--max_memory", "--max-memory", type=parse_size, default=None, help="Peak memory budget for the export, for example 32GB. Enables --low_memory when needed to stay within the budget."
+    )
+    parser.add_argument(
+        "--compression_workers", type=int, default=None, help="Number of processes for the k-means clustering of palettized variants. By default, coremltools clusters the weights one after the other in this process."
+    )
+    parser.add_argument(
+        "--palettization_search", type=Path, default=None, help="Search for the per-layer palettization with the smallest output error within --target_size or --bits_per_parameter (or the smallest model within --atol otherwise), save it to this pipeline file, and export with it."
+    )
+    parser.add_argument(
+        "--target_size", type=parse_size, default=None, help="Size budget for --palettization_search, for example 3.5GB."
+    )
+    parser.add_argument(
+        "--bits_per_parameter", type=float, default=None, help="Size budget for --palettization_search, in average bits per parameter."
+    )
+    parser.add_argument(
+        "--calibration_batches", type=int, default=4, help="Number of calibration batches for --palettization_search."
+    )
+    parser.add_argument(
+        "--profile", action="store_true", help="Write the time and peak memory of every export stage to a JSON report next to the model."
+    )
+    parser.add_argument(
+        "--chrome_trace", "--chrome-trace", action="store_true", help="Also write the export stages as a Chrome trace file. Implies --profile."
+    )
+    parser.add_argument(
+        "--print_artifacts", action="store_true", help="Print the PyTorch model, dummy inputs and outputs, and the Core ML spec. These can be very large."
+    )
     parser.add_argument(
         "--preprocessor",
         type=str,
@@ -108,27 +542,63 @@ def main():
         default="auto",
         help="Which type of preprocessor to use. 'auto' tries to automatically detect it.",
     )
+    parser.add_argument(
+        "--outputs_file", type=Path, default=None, help="Write the paths of the saved models to this JSON file, such as for the batch exporter."
+    )
     parser.add_argument("output", type=Path, help="Path indicating where to store generated Core ML model.")
 
     args = parser.parse_args()
+    if args.quantize is None:
+        args.quantize = [] if args.palettization_search is not None else ["float16"]
+    args.quantize = parse_quantize_options(args.quantize)
 
     if (not args.output.is_file()) and (args.output.suffix not in [".mlpackage", ".mlmodel"]):
         args.output = args.output.joinpath("Model.mlpackage")
     if not args.output.parent.exists():
         args.output.parent.mkdir(parents=True)
 
+    if not (args.profile or args.chrome_trace):
+        return run_export(args)
+
+    profiler = Profiler()
+    try:
+        with profiler:
+            run_export(args)
+    finally:
+        report_path = args.output.with_name(f"{args.output.stem}-profile.json")
+        profiler.save(report_path)
+        logger.info(f"Profile written to {report_path}")
+        if args.chrome_trace:
+            trace_path = args.output.with_name(f"{args.output.stem}-trace.json")
+            profiler.save_chrome_trace(trace_path)
+            logger.info(f"Chrome trace written to {trace_path}")
+
+
+def load_model(args):
+    """Load the preprocessor and the model, and find the model's Core ML configuration class."""
     # Instantiate the appropriate preprocessor
-    if args.preprocessor == "auto":
-        preprocessor = get_preprocessor(args.model)
-    elif args.preprocessor == "tokenizer":
-        preprocessor = AutoTokenizer.from_pretrained(args.model)
-    elif args.preprocessor == "feature_extractor":
-        preprocessor = AutoFeatureExtractor.from_pretrained(args.model)
-    elif args.preprocessor == "processor":
-        preprocessor = AutoProcessor.from_pretrained(args.model)
-    else:
-        raise ValueError(f"Unknown preprocessor type '{args.preprocessor}'")
+    with profile_span("load_preprocessor"):
+        if args.preprocessor == "auto":
+            preprocessor = get_preprocessor(args.model)
+        elif args.preprocessor == "tokenizer":
+            preprocessor = AutoTokenizer.from_pretrained(args.model)
+        elif args.preprocessor == "feature_extractor":
+            preprocessor = AutoFeatureExtractor.from_pretrained(args.model)
+        elif args.preprocessor == "processor":
+            preprocessor = AutoProcessor.from_pretrained(args.model)
+        else:
+            raise ValueError(f"Unknown preprocessor type '{args.preprocessor}'")
 
+    # Allocate the model
+    with profile_span("load_model"):
+        model = FeaturesManager.get_model_from_feature(
+            args.feature, args.model, framework=args.framework, **get_load_options(args)
+        )
+    model_kind, model_coreml_config = FeaturesManager.check_supported_model_or_raise(model, feature=args.feature)
+    return preprocessor, model, model_coreml_config
+
+
+def run_export(args):
     # Support legacy task names in CLI only
     feature = args.feature
     args.feature = FeaturesManager.map_from_synonym(args.feature)
@@ -136,45 +606,33 @@ def main():
         deprecation_message = f"Feature '{feature}' is deprecated, please use '{args.feature}' instead."
         warnings.warn(deprecation_message, FutureWarning)
 
-    # Allocate the model
-    model = FeaturesManager.get_model_from_feature(
-        args.feature, args.model, framework=args.framework, #cache_dir=args.cache_dir
-    )
-    model_kind, model_coreml_config = FeaturesManager.check_supported_model_or_raise(model, feature=args.feature)
+    preprocessor, model, model_coreml_config = load_model(args)
 
-    print(model_coreml_config)
+    if args.print_artifacts:
+        print(model_coreml_config)
 
-    if args.feature in ["text2text-generation", "speech-seq2seq"]:
-        logger.info(f"Converting encoder model...")
-
-        convert_model(
-            preprocessor,
-            model,
-            model_coreml_config,
-            args,
-            use_past=False,
-            seq2seq="encoder"
-        )
+    if args.palettization_search is not None:
+        with profile_span("palettization_search"):
+            search_palettization_plan(preprocessor, model, model_coreml_config, args)
 
-        logger.info(f"Converting decoder model...")
+    cache = None if args.no_cache else ExportCache(args.cache_dir)
 
-        convert_model(
-            preprocessor,
-            model,
-            model_coreml_config,
-            args,
-            use_past=args.use_past,
-            seq2seq="decoder"
-        )
+    if args.feature in ["text2text-generation", "speech-seq2seq"]:
+        paths = convert_seq2seq_model(preprocessor, model, model_coreml_config, args, cache=cache)
     else:
-        convert_model(
+        paths = convert_model(
             preprocessor,
             model,
             model_coreml_config,
             args,
             use_past=args.use_past,
+            cache=cache,
         )
 
+    if args.outputs_file is not None:
+        with open(args.outputs_file, "w") as f:
+            json.dump(paths, f, indent=2)
+
 
 if __name__ == "__main__":
     logger = logging.get_logger("exporters.coreml")  # pylint: disable=invalid-name
@@ -0,0 +1,343 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Export many checkpoints from a job manifest: `python -m exporters.coreml batch manifest.yaml`."""
+
+import dataclasses
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Union
+
+from .cache import get_path_size
+from ..utils import logging
+
+
+if TYPE_CHECKING:
+    from transformers import PretrainedConfig
+
+
+logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
+
+
+DEFAULT_JOB_MEMORY = 8 * 1024**3
+
+# Converting a model holds the fp32 weights, the traced graph and the MIL program in memory
+# at the same time, so the peak is a few times the size of the weights.
+MEMORY_PER_PARAMETER = 4 * 3
+
+# With `--low_memory` the weights are loaded in float16 and memory-mapped from the checkpoint,
+# leaving one float16 copy in the PyTorch model and one in the Core ML program.
+LOW_MEMORY_PER_PARAMETER = 2 * 2
+
+GATED_MLP_MODEL_TYPES = ["llama", "mistral", "mixtral", "qwen2", "gemma"]
+
+
+@dataclasses.dataclass
+class ExportJob:
+    """
+    A single entry in the batch manifest. The fields map onto the command line options of
+    `python -m exporters.coreml`.
+
+    Args:
+        model (`str`):
+            Model ID on huggingface.co or path on disk.
+        output (`str`):
+            Where to store the generated Core ML model.
+        feature (`str`, *optional*, defaults to `"feature-extraction"`):
+            The type of features to export the model with.
+        use_past (`bool`, *optional*, defaults to `False`):
+            Export the model with precomputed key/values.
+        quantize (`str` or `List[str]`, *optional*, defaults to `"float16"`):
+            Quantization option(s) for the model weights.
+        compute_units (`str`, *optional*, defaults to `"all"`):
+            Optimize the model for CPU, GPU, and/or Neural Engine.
+        low_memory (`bool`, *optional*, defaults to `False`):
+            Load the weights in float16 and memory-mapped, see `--low_memory`.
+        memory (`int`, *optional*):
+            Peak memory of the job in bytes. If not given, this is estimated from the model config.
+        args (`List[str]`, *optional*):
+            Additional command line arguments.
+    """
+    model: str
+    output: str
+    feature: str = "feature-extraction"
+    use_past: bool = False
+    quantize: Union[str, List[str]] = "float16"
+    compute_units: str = "all"
+    low_memory: bool = False
+    memory: Optional[int] = None
+    args: List[str] = dataclasses.field(default_factory=list)
+
+    @property
+    def name(self) -> str:
+        return f"{self.model} ({self.feature})"
+
+    def command(self, outputs_file: Optional[Union[str, Path]] = None) -> List[str]:
+        quantize = [self.quantize] if isinstance(self.quantize, str) else list(self.quantize)
+        command = [
+            sys.executable, "-m", "exporters.coreml",
+            f"--model={self.model}",
+            f"--feature={self.feature}",
+            f"--compute_units={self.compute_units}",
+            "--quantize", *quantize,
+        ]
+        if self.use_past:
+            command.append("--use_past")
+        if self.low_memory:
+            command.append("--low_memory")
+        if outputs_file is not None:
+            command.append(f"--outputs_file={outputs_file}")
+        return command + list(self.args) + [self.output]
+
+
+def load_manifest(path: Union[str, Path]) -> List[ExportJob]:
+    """
+    Read the jobs from a JSON or YAML manifest. The manifest is either a list of jobs, or a mapping
+    with a `jobs` list and optional `defaults` that apply to every job.
+    """
+    path = Path(path)
+    with open(path) as f:
+        if path.suffix in [".yaml", ".yml"]:
+            import yaml
+            manifest = yaml.safe_load(f)
+        else:
+            manifest = json.load(f)
+
+    defaults = {}
+    if isinstance(manifest, dict):
+        defaults = manifest.get("defaults", {})
+        manifest = manifest.get("jobs", [])
+
+    return [ExportJob(**{**defaults, **job}) for job in manifest]
+
+
+def estimate_num_parameters(config: "PretrainedConfig") -> Optional[int]:
+    """Approximate number of parameters of a transformer, computed from its config."""
+    def get(*names, default=None):
+        for name in names:
+            value = getattr(config, name, None)
+            if value is not None:
+                return value
+        return default
+
+    hidden_size = get("hidden_size", "n_embd", "d_model")
+    if hidden_size is None:
+        return None
+
+    num_layers = get("num_hidden_layers", "n_layer", "num_layers", default=0)
+    num_layers += get("decoder_layers", default=0)
+    intermediate_size = get("intermediate_size", "n_inner", "ffn_dim", "d_ff", default=None) or 4 * hidden_size
+    vocab_size = get("vocab_size", default=0)
+
+    # Grouped-query attention has smaller key and value projections.
+    num_heads = get("num_attention_heads", "n_head", "num_heads", default=1)
+    num_key_value_heads = get("num_key_value_heads", default=num_heads)
+    kv_size = hidden_size * num_key_value_heads // num_heads
+    attention = 2 * hidden_size**2 + 2 * hidden_size * kv_size
+
+    # Gated MLPs (Llama, Mistral) have three projections instead of two.
+    num_mlp_projections = 3 if getattr(config, "model_type", None) in GATED_MLP_MODEL_TYPES else 2
+    mlp = num_mlp_projections * hidden_size * intermediate_size
+
+    num_embeddings = 1 if getattr(config, "tie_word_embeddings", True) else 2
+    return num_layers * (attention + mlp) + num_embeddings * vocab_size * hidden_size
+
+
+def estimate_export_memory(config: "PretrainedConfig", low_memory: bool = False) -> Optional[int]:
+    """Rough estimate of the peak memory of an export in bytes, or `None` if the model size is unknown."""
+    num_parameters = estimate_num_parameters(config)
+    if num_parameters is None:
+        return None
+    bytes_per_parameter = LOW_MEMORY_PER_PARAMETER if low_memory else MEMORY_PER_PARAMETER
+    return max(num_parameters * bytes_per_parameter, 1024**3)
+
+
+def estimate_job_memory(job: ExportJob) -> int:
+    """Rough estimate of the peak memory of an export job, derived from the model config."""
+    if job.memory is not None:
+        return int(job.memory)
+
+    try:
+        from transformers import AutoConfig
+        config = AutoConfig.from_pretrained(job.model)
+    except Exception as e:
+        logger.warning(f"Could not load the config for {job.model}, assuming {DEFAULT_JOB_MEMORY} bytes: {e}")
+        return DEFAULT_JOB_MEMORY
+
+    memory = estimate_export_memory(config, low_memory=job.low_memory)
+    return DEFAULT_JOB_MEMORY if memory is None else memory
+
+
+class MemoryBudget:
+    """
+    Admits jobs while the sum of their memory estimates fits in the budget. A job that is larger than
+    the whole budget is still admitted, but only when nothing else is running.
+    """
+    def __init__(self, total: Optional[int]):
+        self.total = total
+        self.used = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, amount: int):
+        with self._condition:
+            while self.total is not None and self.used > 0 and self.used + amount > self.total:
+                self._condition.wait()
+            self.used += amount
+
+    def release(self, amount: int):
+        with self._condition:
+            self.used -= amount
+            self._condition.notify_all()
+
+
+def _run_process(command: List[str], log_path: Path):
+    """Run the command and return its exit code, wall time, and peak resident memory in bytes."""
+    start_time = time.perf_counter()
+    with open(log_path, "w") as log:
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+        _, status, rusage = os.wait4(process.pid, 0)
+
+    # wait4() already reaped the process, tell Popen about it.
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+
+    # ru_maxrss is in kilobytes on Linux but in bytes on macOS.
+    peak_rss = rusage.ru_maxrss if sys.platform == "darwin" else rusage.ru_maxrss * 1024
+    return process.returncode, time.perf_counter() - start_time, peak_rss
+
+
+def read_outputs_file(outputs_file: Path) -> Optional[List[str]]:
+    """The paths of the models that an export saved, as listed in its `--outputs_file`."""
+    if not outputs_file.is_file():
+        return None
+    with open(outputs_file) as f:
+        return json.load(f)
+
+
+def run_job(job: ExportJob, budget: MemoryBudget, retries: int, log_dir: Path, index: int) -> Dict[str, Any]:
+    """Run one export in its own process, retrying on failure, and describe the outcome."""
+    memory = estimate_job_memory(job)
+    result = {
+        "model": job.model,
+        "feature": job.feature,
+        "output": job.output,
+        "memory_estimate": memory,
+        "status": "failed",
+        "attempts": 0,
+    }
+
+    for attempt in range(1 + retries):
+        log_path = log_dir / f"job-{index}-attempt-{attempt}.log"
+        outputs_file = log_dir / f"job-{index}-attempt-{attempt}-outputs.json"
+        logger.info(f"Starting {job.name}, attempt {attempt + 1}, log: {log_path}")
+
+        budget.acquire(memory)
+        try:
+            returncode, elapsed, peak_rss = _run_process(job.command(outputs_file), log_path)
+        finally:
+            budget.release(memory)
+
+        result.update(attempts=attempt + 1, returncode=returncode, time=elapsed, peak_rss=peak_rss, log=log_path.as_posix())
+        if returncode == 0:
+            result["status"] = "ok"
+            # The export names the models after the variants and the halves of a seq2seq model,
+            # so it reports where it saved them.
+            outputs = read_outputs_file(outputs_file)
+            result["outputs"] = outputs
+            result["output_size"] = None
+            if outputs is not None:
+                result["output_size"] = sum(get_path_size(path) for path in outputs if os.path.exists(path))
+            logger.info(f"Finished {job.name} in {elapsed:.1f} sec")
+            break
+
+        logger.warning(f"{job.name} failed with exit code {returncode}, see {log_path}")
+
+    return result
+
+
+def run_batch(
+    jobs: List[ExportJob],
+    workers: int = 1,
+    max_memory: Optional[int] = None,
+    retries: int = 0,
+    log_dir: Union[str, Path] = "batch_logs",
+) -> Dict[str, Any]:
+    """
+    Run the export jobs, at most `workers` at a time and within the `max_memory` budget. Every job runs in
+    its own process, so a crash only affects that job.
+
+    Returns:
+        `Dict[str, Any]`: summary with the time, peak RSS and output size of every job.
+    """
+    log_dir = Path(log_dir)
+    log_dir.mkdir(parents=True, exist_ok=True)
+    budget = MemoryBudget(max_memory)
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(run_job, job, budget, retries, log_dir, i) for i, job in enumerate(jobs)]
+        results = [future.result() for future in futures]
+
+    return {
+        "jobs": results,
+        "succeeded": sum(result["status"] == "ok" for result in results),
+        "failed": sum(result["status"] != "ok" for result in results),
+        "total_time": time.perf_counter() - start_time,
+    }
+
+
+def parse_size(value: str) -> int:
+    """Parse a size such as `"32GB"`, `"512MiB"` or `"1000000"` into bytes."""
+    units = {"k": 1024, "m": 1024**2, "g": 1024**3, "t": 1024**4}
+    value = value.strip().lower().rstrip("bi")
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def main(argv=None):
+    parser = ArgumentParser("Hugging Face Transformers Core ML batch exporter")
+    parser.add_argument("manifest", type=Path, help="JSON or YAML file with the export jobs.")
+    parser.add_argument("--workers", type=int, default=1, help="Maximum number of exports to run at the same time.")
+    parser.add_argument(
+        "--max_memory", type=parse_size, default=None, help="Memory budget for all running exports together, for example 64GB."
+    )
+    parser.add_argument("--retries", type=int, default=0, help="How many times to retry a failed export.")
+    parser.add_argument("--log_dir", type=Path, default=Path("batch_logs"), help="Where to write the output of every export.")
+    parser.add_argument("--summary", type=Path, default=None, help="Where to write the JSON summary. Printed to stdout if not given.")
+    args = parser.parse_args(argv)
+
+    jobs = load_manifest(args.manifest)
+    logger.info(f"Running {len(jobs)} export jobs with {args.workers} worker(s)")
+
+    summary = run_batch(jobs, workers=args.workers, max_memory=args.max_memory, retries=args.retries, log_dir=args.log_dir)
+
+    if args.summary is not None:
+        with open(args.summary, "w") as f:
+            json.dump(summary, f, indent=2)
+        logger.info(f"Summary written to {args.summary}")
+    else:
+        print(json.dumps(summary, indent=2))
+
+    if summary["failed"] > 0:
+        sys.exit(1)
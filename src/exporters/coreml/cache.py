@@ -0,0 +1,334 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""On-disk, content-addressed cache for Core ML export artifacts."""
+
+import dataclasses
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Mapping, Optional, Tuple, Union
+
+from ..utils import logging
+
+
+if TYPE_CHECKING:
+    from transformers.modeling_utils import PreTrainedModel
+    from .config import CoreMLConfig
+
+
+logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
+
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.getenv("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")), "huggingface", "exporters"
+)
+DEFAULT_MAX_CACHE_SIZE = 50 * 1024**3  # 50 GiB
+
+_ENTRY_FILE = "entry.json"
+
+
+def get_path_size(path: Union[str, Path]) -> int:
+    """Return the size in bytes of a file, or of all the files inside a directory."""
+    path = Path(path)
+    if path.is_file():
+        return path.stat().st_size
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def copy_path(src: Union[str, Path], dst: Union[str, Path]):
+    """Copy a `.mlmodel` file or `.mlpackage` directory, replacing `dst` if it already exists."""
+    src, dst = Path(src), Path(dst)
+    if dst.is_dir():
+        shutil.rmtree(dst)
+    elif dst.exists():
+        dst.unlink()
+    if src.is_dir():
+        shutil.copytree(src, dst)
+    else:
+        shutil.copy2(src, dst)
+
+
+def get_library_versions() -> Dict[str, str]:
+    """Versions of the libraries that influence the result of an export."""
+    from importlib import metadata
+
+    versions = {}
+    for name in ["coremltools", "torch", "transformers", "numpy"]:
+        try:
+            versions[name] = metadata.version(name)
+        except metadata.PackageNotFoundError:
+            versions[name] = None
+    return versions
+
+
+def get_exporter_fingerprint() -> str:
+    """
+    Hash of the exporter's own source files, so that cached artifacts are invalidated when the
+    conversion code itself changes.
+    """
+    hasher = hashlib.sha256()
+    package_dir = Path(__file__).parent
+    for path in sorted(package_dir.glob("*.py")):
+        hasher.update(path.name.encode())
+        hasher.update(path.read_bytes())
+    return hasher.hexdigest()
+
+
+def hash_model_weights(model: "PreTrainedModel") -> str:
+    """
+    Content hash of all the parameters and buffers of a PyTorch model. The tensor bytes are hashed
+    in place, without making a copy of the weights.
+    """
+    import torch
+
+    hasher = hashlib.sha256()
+    for name, tensor in model.state_dict().items():
+        tensor = tensor.detach()
+        hasher.update(f"{name}:{tensor.dtype}:{tuple(tensor.shape)}".encode())
+        if tensor.device.type != "cpu":
+            tensor = tensor.cpu()
+        data = tensor.contiguous().reshape(-1).view(torch.uint8).numpy()
+        hasher.update(memoryview(data))
+    return hasher.hexdigest()
+
+
+def _describe_preprocessor(preprocessor: Any) -> Dict[str, Any]:
+    """The preprocessor settings that are part of a traced or converted model, such as the image normalization."""
+    fields = {}
+    for name in ["image_mean", "image_std", "do_normalize", "rescale_factor", "do_rescale"]:
+        value = getattr(preprocessor, name, None)
+        if value is not None:
+            fields[name] = list(value) if isinstance(value, (list, tuple)) else value
+    return fields
+
+
+def _describe_config(config: "CoreMLConfig") -> Dict[str, Any]:
+    return {
+        "class": f"{type(config).__module__}.{type(config).__qualname__}",
+        "task": config.task,
+        "use_past": config.use_past,
+        "seq2seq": config.seq2seq,
+        "use_legacy_format": config.use_legacy_format,
+        "export_options": dict(config.export_options),
+        "inputs": [(key, dataclasses.asdict(desc)) for key, desc in config.inputs.items()],
+        "outputs": [(key, dataclasses.asdict(desc)) for key, desc in config.outputs.items()],
+    }
+
+
+class ExportCache:
+    """
+    Content-addressed cache for export artifacts, such as converted Core ML models.
+
+    Every entry lives in its own directory `<cache_dir>/<namespace>/<key>`. The key is a hash of
+    everything that influences the artifact. The total size of the cache is bounded by `max_size`;
+    when it grows larger, the least recently used entries are evicted.
+
+    Args:
+        cache_dir (`str` or `Path`, *optional*):
+            Where to store the cache. Defaults to `~/.cache/huggingface/exporters`.
+        max_size (`int`, *optional*, defaults to 50 GiB):
+            Maximum size of the cache in bytes.
+    """
+    def __init__(self, cache_dir: Optional[Union[str, Path]] = None, max_size: int = DEFAULT_MAX_CACHE_SIZE):
+        self.cache_dir = Path(cache_dir or DEFAULT_CACHE_DIR).expanduser()
+        self.max_size = max_size
+        self._weights_hashes = {}
+
+    def get_weights_hash(self, model: "PreTrainedModel") -> str:
+        """Hash of the model weights. This is computed only once per model object."""
+        if id(model) not in self._weights_hashes:
+            start_time = time.perf_counter()
+            self._weights_hashes[id(model)] = hash_model_weights(model)
+            logger.info(f"Hashed model weights in {time.perf_counter() - start_time:.1f} sec")
+        return self._weights_hashes[id(model)]
+
+    def set_weights_hash(self, model: "PreTrainedModel", weights_hash: str):
+        """Use a hash computed elsewhere, such as in another process, for the weights of `model`."""
+        self._weights_hashes[id(model)] = weights_hash
+
+    @staticmethod
+    def make_key(fields: Dict[str, Any]) -> str:
+        """Hash a JSON-serializable description of an artifact into a cache key."""
+        serialized = json.dumps(fields, sort_keys=True, default=str)
+        return hashlib.sha256(serialized.encode()).hexdigest()
+
+    def get_export_key(
+        self,
+        model: "PreTrainedModel",
+        config: "CoreMLConfig",
+        quantize: Union[str, Dict[str, Any]],
+        compute_units: Any,
+        preprocessor: Any = None,
+    ) -> str:
+        """
+        Key for a converted Core ML model. Includes the model weights, the Core ML configuration and
+        its input / output descriptions, the preprocessor's image normalization, which becomes the scale
+        and bias of image inputs, the export options, and the library versions.
+        """
+        return self.make_key({
+            "weights": self.get_weights_hash(model),
+            "config": _describe_config(config),
+            "preprocessor": _describe_preprocessor(preprocessor),
+            "quantize": quantize,
+            "compute_units": str(compute_units),
+            "versions": get_library_versions(),
+            "exporter": get_exporter_fingerprint(),
+        })
+
+    def get_trace_key(
+        self,
+        model: "PreTrainedModel",
+        config: "CoreMLConfig",
+        dummy_inputs: Mapping[str, Tuple[Any, Any]],
+        preprocessor: Any = None,
+    ) -> str:
+        """
+        Key for the TorchScript trace of a model. Includes the model weights, the Core ML configuration,
+        the shapes and dtypes of the dummy inputs the model is traced with, and the preprocessor's image
+        normalization, which the trace can include. Export options such as `quantize` only affect the later
+        stages and are deliberately not part of the key.
+        """
+        return self.make_key({
+            "weights": self.get_weights_hash(model),
+            "config": _describe_config(config),
+            "preprocessor": _describe_preprocessor(preprocessor),
+            "values_override": config.values_override,
+            "dummy_inputs": [
+                (name, tuple(ref_value.shape), str(ref_value.dtype))
+                for name, (ref_value, _) in dummy_inputs.items()
+                if hasattr(ref_value, "shape")
+            ],
+            "versions": get_library_versions(),
+            "exporter": get_exporter_fingerprint(),
+        })
+
+    def lookup_trace(self, key: str) -> Optional[Tuple[Any, List[Any]]]:
+        """Return the cached `(traced_model, example_outputs)` tuple, or `None` on a cache miss."""
+        import numpy as np
+        import torch
+
+        entry_dir = self.lookup("traces", key)
+        if entry_dir is None:
+            return None
+
+        traced_model = torch.jit.load((entry_dir / "model.pt").as_posix())
+        with np.load(entry_dir / "outputs.npz") as f:
+            example_output = [f[f"output_{i}"] for i in range(len(f.files))]
+        return traced_model, example_output
+
+    def store_trace(self, key: str, traced_model: Any, example_output: List[Any]):
+        """Serialize a TorchScript module and the numpy outputs it produced on the dummy inputs."""
+        import numpy as np
+        import torch
+
+        def writer(path):
+            torch.jit.save(traced_model, (path / "model.pt").as_posix())
+            np.savez(path / "outputs.npz", **{f"output_{i}": x for i, x in enumerate(example_output)})
+
+        self.store("traces", key, writer)
+
+    def _entry_dir(self, namespace: str, key: str) -> Path:
+        return self.cache_dir / namespace / key
+
+    def lookup(self, namespace: str, key: str) -> Optional[Path]:
+        """
+        Return the directory of the cache entry, or `None` on a cache miss. A hit marks the entry as
+        recently used.
+        """
+        entry_dir = self._entry_dir(namespace, key)
+        entry_file = entry_dir / _ENTRY_FILE
+        if not entry_file.is_file():
+            return None
+        os.utime(entry_file)
+        return entry_dir
+
+    def store(self, namespace: str, key: str, writer: Callable[[Path], None]) -> Path:
+        """
+        Create a new cache entry. `writer` is called with an empty directory to fill in. The entry
+        only becomes visible once `writer` has finished, so concurrent exports never see a partially
+        written entry.
+        """
+        entry_dir = self._entry_dir(namespace, key)
+        tmp_dir = self.cache_dir / namespace / f".tmp-{key}-{os.getpid()}"
+        if tmp_dir.exists():
+            shutil.rmtree(tmp_dir)
+        tmp_dir.mkdir(parents=True)
+
+        try:
+            writer(tmp_dir)
+            with open(tmp_dir / _ENTRY_FILE, "w") as f:
+                json.dump({"key": key, "created": time.time()}, f)
+            if entry_dir.exists():
+                shutil.rmtree(entry_dir, ignore_errors=True)
+            os.replace(tmp_dir, entry_dir)
+        finally:
+            if tmp_dir.exists():
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        self.evict(keep=entry_dir)
+        return entry_dir
+
+    def lookup_model(self, key: str) -> Optional[Path]:
+        """Return the path of a cached `.mlpackage` or `.mlmodel`, or `None` on a cache miss."""
+        entry_dir = self.lookup("models", key)
+        if entry_dir is None:
+            return None
+        paths = list(entry_dir.glob("Model.*"))
+        return paths[0] if len(paths) == 1 else None
+
+    def store_model(self, key: str, path: Union[str, Path]) -> Path:
+        """Put a copy of the saved Core ML model at `path` into the cache."""
+        path = Path(path)
+        entry_dir = self.store("models", key, lambda dst: copy_path(path, dst / ("Model" + path.suffix)))
+        return entry_dir / ("Model" + path.suffix)
+
+    def _list_entries(self) -> List[Path]:
+        if not self.cache_dir.is_dir():
+            return []
+        return [
+            entry_dir
+            for namespace_dir in self.cache_dir.iterdir() if namespace_dir.is_dir()
+            for entry_dir in namespace_dir.iterdir() if (entry_dir / _ENTRY_FILE).is_file()
+        ]
+
+    def evict(self, keep: Optional[Path] = None):
+        """Remove the least recently used entries until the cache fits in `max_size` bytes."""
+        entries = []
+        for entry_dir in self._list_entries():
+            try:
+                last_used = (entry_dir / _ENTRY_FILE).stat().st_mtime
+            except OSError:
+                continue  # removed by another process
+            entries.append((last_used, get_path_size(entry_dir), entry_dir))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in sorted(entries, key=lambda x: x[0]):
+            if total_size <= self.max_size:
+                break
+            if keep is not None and entry_dir == keep:
+                continue
+            logger.info(f"Evicting {entry_dir} from the export cache ({size / 1024**2:.1f} MB)")
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
@@ -0,0 +1,151 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Decoders that are exported as a pipeline of Core ML models, each with a range of layers."""
+
+import json
+import os
+from typing import TYPE_CHECKING, Any, Dict, List, Mapping
+
+import numpy as np
+
+
+if TYPE_CHECKING:
+    from .config import CoreMLConfig
+
+
+# The name of the manifest in the directory of a saved `ChunkedModel`.
+MANIFEST_NAME = "manifest.json"
+
+
+def get_chunk_manifest(config: "CoreMLConfig") -> Dict[str, Any]:
+    """
+    Describe the chunks of a model exported with `num_chunks`: the file, the range of layers, and the names of
+    the inputs and outputs of every chunk, and which output of a chunk is the `hidden_states` input of the next.
+
+    Args:
+        config ([`CoreMLConfig`]):
+            The Core ML configuration the model was exported with, not that of one of its chunks.
+
+    Returns:
+        `Dict[str, Any]`: the manifest, which can be saved as JSON.
+    """
+    if not config.chunk_layers:
+        raise ValueError("a chunk manifest needs a CoreMLConfig with `num_chunks`")
+
+    chunks = []
+    for chunk, (start, end) in enumerate(config.chunk_layers):
+        chunk_config = config.get_chunk_config(chunk)
+        chunks.append({
+            "path": f"chunk_{chunk}.mlpackage",
+            "layers": [start, end],
+            "inputs": [input_desc.name for input_desc in chunk_config.inputs.values()],
+            "outputs": [output_desc.name for output_desc in chunk_config.outputs.values()],
+        })
+
+    return {
+        "task": config.task,
+        "num_layers": config.num_layers,
+        "export_options": dict(config.export_options, use_past=config.use_past),
+        "hidden_states": {
+            "input": config.get_chunk_config(1).inputs["hidden_states"].name,
+            "output": config.get_chunk_config(0).outputs["hidden_states"].name,
+        },
+        "chunks": chunks,
+    }
+
+
+class ChunkedModel:
+    """
+    A decoder exported with `num_chunks` as Core ML models that each run a contiguous range of layers. This runs
+    the chunks one after the other, passing the hidden states from one to the next, and makes predictions with
+    the inputs and outputs of the whole model, so it can take the place of a single model, for example with a
+    [`KeyValueCacheManager`].
+
+    Args:
+        models (`List[ct.models.MLModel]`):
+            The chunks, in order. Any object with a `predict` method that takes and returns a dictionary of
+            arrays by name can be used, such as a wrapper around the PyTorch model of a chunk.
+        manifest (`Dict[str, Any]`):
+            The manifest of the chunks, see [`get_chunk_manifest`].
+
+    Example:
+
+    ```python
+    model = ChunkedModel.load("Model")
+    outputs = model.predict({"input_ids": input_ids, "attention_mask": attention_mask})
+    ```
+    """
+
+    def __init__(self, models: List[Any], manifest: Mapping[str, Any]):
+        if len(models) != len(manifest["chunks"]):
+            raise ValueError(f"expected {len(manifest['chunks'])} chunk models, got {len(models)}")
+        self.models = list(models)
+        self.manifest = manifest
+
+    @classmethod
+    def load(cls, path: str, **kwargs) -> "ChunkedModel":
+        """
+        Load the chunks saved with `save`.
+
+        Args:
+            path (`str`):
+                The directory with the manifest and the chunks.
+            kwargs:
+                Options for loading every chunk, such as `compute_units`, see `ct.models.MLModel`.
+        """
+        import coremltools as ct
+
+        with open(os.path.join(path, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+        models = [ct.models.MLModel(os.path.join(path, chunk["path"]), **kwargs) for chunk in manifest["chunks"]]
+        return cls(models, manifest)
+
+    def save(self, path: str):
+        """Save the chunks and the manifest in the directory `path`."""
+        os.makedirs(path, exist_ok=True)
+        for model, chunk in zip(self.models, self.manifest["chunks"]):
+            model.save(os.path.join(path, chunk["path"]))
+        with open(os.path.join(path, MANIFEST_NAME), "w") as f:
+            json.dump(self.manifest, f, indent=2)
+
+    def predict(self, inputs: Mapping[str, Any]) -> Dict[str, np.ndarray]:
+        """
+        Run the chunks.
+
+        Args:
+            inputs (`Mapping[str, np.ndarray]`):
+                The inputs of the whole model. Every chunk gets those it has, such as the key / value cache of
+                its layers.
+
+        Returns:
+            `Dict[str, np.ndarray]`: the outputs of all chunks, except the hidden states between them.
+        """
+        hidden_states_names = self.manifest["hidden_states"]
+        outputs = {}
+        hidden_states = None
+
+        for model, chunk in zip(self.models, self.manifest["chunks"]):
+            chunk_inputs = {}
+            for name in chunk["inputs"]:
+                if name == hidden_states_names["input"]:
+                    chunk_inputs[name] = hidden_states
+                elif name in inputs:
+                    chunk_inputs[name] = inputs[name]
+
+            chunk_outputs = model.predict(chunk_inputs)
+            hidden_states = chunk_outputs.pop(hidden_states_names["output"], None)
+            outputs.update(chunk_outputs)
+
+        return outputs
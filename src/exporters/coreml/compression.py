@@ -0,0 +1,492 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Declarative weight compression pipelines for converted Core ML models."""
+
+import copy
+import inspect
+import json
+import re
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from .cache import get_path_size
+from .palettization import (
+    ParallelPalettizer,
+    _read_blob_metadata,
+    benchmark_clustering,
+    benchmark_palettization,
+    make_palettizer_config,
+)
+from .profiling import profile_span
+from ..utils import logging
+
+
+if TYPE_CHECKING:
+    import coremltools as ct
+
+
+logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
+
+
+# The coremltools.optimize.coreml function that applies each type of op config.
+STAGE_FUNCTIONS = {
+    "OpThresholdPrunerConfig": "prune_weights",
+    "OpMagnitudePrunerConfig": "prune_weights",
+    "OpPalettizerConfig": "palettize_weights",
+    "OpLinearQuantizerConfig": "linear_quantize_weights",
+}
+
+COMPUTE_PRECISIONS = ["float16", "float32"]
+
+PRUNER_CONFIG_TYPES = ["OpThresholdPrunerConfig", "OpMagnitudePrunerConfig"]
+
+
+# The parsed contents of pipeline files, by path, modification time and size. The `--quantize` options
+# are looked up for every variant and stage of an export, and the files only need to be read once.
+_pipeline_files = {}
+
+
+def read_pipeline_file(path: Union[str, Path]) -> Any:
+    """
+    The parsed contents of a YAML or JSON file. The file is only read again when it changes. Returns a copy,
+    which the caller may modify.
+    """
+    path = Path(path).resolve()
+    stat = path.stat()
+    key = (path.as_posix(), stat.st_mtime_ns, stat.st_size)
+    if key not in _pipeline_files:
+        with open(path) as f:
+            if path.suffix in [".yaml", ".yml"]:
+                import yaml
+                contents = yaml.safe_load(f)
+            else:
+                contents = json.load(f)
+        # Forget older versions of the file.
+        for old_key in [old_key for old_key in _pipeline_files if old_key[0] == key[0]]:
+            del _pipeline_files[old_key]
+        _pipeline_files[key] = contents
+    return copy.deepcopy(_pipeline_files[key])
+
+
+def palettize_stage(nbits: int, nbits_linear: int) -> Dict[str, Any]:
+    """K-means palettization with `nbits`, and `nbits_linear` for the weights of `linear` ops. Embeddings are skipped."""
+    return {
+        "config_type": "OpPalettizerConfig",
+        "global_config": {"mode": "kmeans", "nbits": nbits},
+        "op_type_configs": {"gather": None, "linear": {"mode": "kmeans", "nbits": nbits_linear}},
+    }
+
+
+BUILTIN_PIPELINES = {
+    "float32": {"compute_precision": "float32", "stages": []},
+    "float16": {"compute_precision": "float16", "stages": []},
+    "int8": {
+        "compute_precision": "float16",
+        "stages": [
+            {
+                "config_type": "OpLinearQuantizerConfig",
+                "global_config": {"mode": "linear_symmetric", "dtype": "int8"},
+            },
+        ],
+    },
+    "int4": {"compute_precision": "float16", "stages": [palettize_stage(4, 4)]},
+    "mixed-6-4": {"compute_precision": "float16", "stages": [palettize_stage(6, 4)]},
+}
+
+QUANTIZE_OPTIONS = list(BUILTIN_PIPELINES.keys())
+
+
+def get_model_size(mlmodel: "ct.models.MLModel") -> int:
+    """Size in bytes of the model's spec and its weights."""
+    size = mlmodel._spec.ByteSize()
+    if getattr(mlmodel, "weights_dir", None) is not None:
+        size += get_path_size(mlmodel.weights_dir)
+    return size
+
+
+def get_const_names(mlmodel: "ct.models.MLModel") -> List[str]:
+    """Names of all the constants in the main block of an ML Program."""
+    spec = mlmodel._spec
+    if not spec.HasField("mlProgram"):
+        return []
+
+    names = []
+    for function in spec.mlProgram.functions.values():
+        for block in function.block_specializations.values():
+            for op in block.operations:
+                if op.type == "const":
+                    names.extend(output.name for output in op.outputs)
+    return names
+
+
+def get_layer_report(mlmodel: "ct.models.MLModel") -> List[Dict[str, Any]]:
+    """
+    For every compressed weight of an ML Program, the number of elements, the fraction of them that is pruned,
+    and the size of the compressed representation that is loaded, in bytes and in bits per element.
+
+    A compressed weight is the output of a chain of `constexpr_*` ops, such as `constexpr_lut_to_sparse`
+    followed by `constexpr_sparse_to_dense`. Its size is that of all the constants the chain reads.
+    """
+    spec = mlmodel._spec
+    if not spec.HasField("mlProgram"):
+        return []
+
+    popcounts = np.array([bin(i).count("1") for i in range(256)], dtype=np.int64)
+
+    def value_size(value) -> int:
+        if value.HasField("blobFileValue") and mlmodel.weights_dir is not None:
+            path = Path(mlmodel.weights_dir) / Path(value.blobFileValue.fileName).name
+            return _read_blob_metadata(path, value.blobFileValue.offset)[1]
+        return value.ByteSize()
+
+    def count_bits_set(value) -> Optional[int]:
+        if not value.HasField("blobFileValue") or mlmodel.weights_dir is None:
+            return None
+        path = Path(mlmodel.weights_dir) / Path(value.blobFileValue.fileName).name
+        _, size, offset = _read_blob_metadata(path, value.blobFileValue.offset)
+        return int(popcounts[np.memmap(path, dtype=np.uint8, mode="r", offset=offset, shape=(size,))].sum())
+
+    mask_names = ["mask", "indices_mask"]
+    layers = []
+    for function in spec.mlProgram.functions.values():
+        for block in function.block_specializations.values():
+            consts, sizes, nonzeros, consumed = {}, {}, {}, set()
+            block_layers = []
+            for op in block.operations:
+                if op.type == "const":
+                    if "val" in op.attributes:
+                        consts[op.outputs[0].name] = op.attributes["val"]
+                        sizes[op.outputs[0].name] = value_size(op.attributes["val"])
+                    continue
+                if not op.type.startswith("constexpr_"):
+                    continue
+
+                # Older constexpr ops hold their data in attributes, newer ones read it from const ops.
+                size, nonzero = 0, None
+                for name, value in op.attributes.items():
+                    size += value_size(value)
+                    if name in mask_names:
+                        nonzero = count_bits_set(value)
+                for name, argument in op.inputs.items():
+                    for binding in argument.arguments:
+                        if not binding.HasField("name") or binding.name not in sizes:
+                            continue
+                        consumed.add(binding.name)
+                        size += sizes[binding.name]
+                        if binding.name in nonzeros:
+                            nonzero = nonzeros[binding.name]
+                        elif name in mask_names and binding.name in consts:
+                            nonzero = count_bits_set(consts[binding.name])
+
+                # The size is counted once, on the first output.
+                for i, output in enumerate(op.outputs):
+                    sizes[output.name] = size if i == 0 else 0
+                    if nonzero is not None:
+                        nonzeros[output.name] = nonzero
+
+                output = op.outputs[0]
+                num_elements = int(np.prod([dim.constant.size for dim in output.type.tensorType.dimensions]))
+                block_layers.append({
+                    "name": output.name,
+                    "num_elements": num_elements,
+                    "sparsity": 0.0 if nonzero is None else 1.0 - nonzero / max(num_elements, 1),
+                    "load_size": sum(sizes[out.name] for out in op.outputs),
+                    "bits_per_weight": 8 * size / max(num_elements, 1),
+                })
+
+            layers.extend(layer for layer in block_layers if layer["name"] not in consumed)
+    return layers
+
+
+def resolve_op_names(op_name_configs: Dict[str, Any], const_names: List[str]) -> Dict[str, Any]:
+    """
+    Map `op_name_configs` keys that are PyTorch parameter names, such as `model.layers.0.mlp.up_proj.weight`,
+    to the names of the matching constants in the Core ML model, such as
+    `model_model_layers_0_mlp_up_proj_weight_to_fp16`. Keys that already are constant names are kept.
+
+    Raises a `ValueError` when a weight that has a config does not match exactly one constant, so that a
+    plan made for another model or conversion does not silently leave the weights uncompressed. A weight
+    that is excluded from compression with a `None` config is only skipped with a warning.
+    """
+    const_name_set = set(const_names)
+    resolved = {}
+    unresolved = []
+    for name, op_config in op_name_configs.items():
+        if name in const_name_set:
+            resolved[name] = op_config
+            continue
+
+        sanitized = re.sub(r"[^0-9a-zA-Z_]", "_", name)
+        pattern = re.compile(rf"(^|.*_){re.escape(sanitized)}(_to_fp16)?$")
+        matches = [const_name for const_name in const_names if pattern.match(const_name)]
+        if len(matches) == 1:
+            resolved[matches[0]] = op_config
+        elif op_config is None:
+            logger.warning(f"Could not find a unique weight for '{name}' in the Core ML model, ignoring it")
+        else:
+            unresolved.append(name)
+
+    if len(unresolved) > 0:
+        raise ValueError(
+            f"Could not find a unique weight in the Core ML model for {len(unresolved)} of the "
+            f"{len(op_name_configs)} op_name_configs: {', '.join(unresolved)}"
+        )
+    return resolved
+
+
+class CompressionPipeline:
+    """
+    A sequence of weight compression stages, applied one after the other to a converted model.
+
+    Every stage is an `OptimizationConfig` dictionary, in the same format as `coremltools.optimize.coreml`
+    reads from YAML: a `config_type`, plus a `global_config`, `op_type_configs`, and `op_name_configs`.
+    The keys of `op_name_configs` can be the names of the weights in the Core ML model, or the names of
+    the corresponding PyTorch parameters.
+    For example, to prune and then palettize everything except the embeddings, storing only the non-zero
+    weights and their palette indices:
+
+    ```yaml
+    compute_precision: float16
+    stages:
+      - config_type: OpMagnitudePrunerConfig
+        global_config:
+          target_sparsity: 0.25
+      - config_type: OpPalettizerConfig
+        joint_compression: true
+        global_config:
+          mode: kmeans
+          nbits: 6
+        op_type_configs:
+          gather: null
+    ```
+
+    Without `joint_compression`, a palettization stage leaves the pruned weights as they are. With it, the
+    non-zero values of the pruned weights are palettized as well. This requires coremltools 8 and produces
+    iOS 18 / macOS 15 models.
+
+    Args:
+        stages (`List[Dict[str, Any]]`, *optional*):
+            The compression stages, in order.
+        compute_precision (`str`, *optional*, defaults to `"float16"`):
+            Precision that the model is converted with before compression, `"float16"` or `"float32"`.
+        name (`str`, *optional*):
+            Name of the variant this pipeline produces, used in file names and the model metadata.
+    """
+    def __init__(
+        self,
+        stages: Optional[List[Dict[str, Any]]] = None,
+        compute_precision: str = "float16",
+        name: Optional[str] = None,
+    ):
+        self.stages = copy.deepcopy(stages or [])
+        self.compute_precision = compute_precision
+        self.name = name
+
+        if compute_precision not in COMPUTE_PRECISIONS:
+            raise ValueError(f"Unknown compute precision '{compute_precision}', expected one of {COMPUTE_PRECISIONS}")
+
+        for stage in self.stages:
+            config_type = stage.get("config_type")
+            if config_type not in STAGE_FUNCTIONS:
+                raise ValueError(
+                    f"Unsupported compression stage '{config_type}', expected one of {list(STAGE_FUNCTIONS.keys())}"
+                )
+
+        for i, stage in enumerate(self.stages):
+            if stage.get("joint_compression"):
+                if stage["config_type"] != "OpPalettizerConfig":
+                    raise ValueError(f"Joint compression is only supported for OpPalettizerConfig stages, not {stage['config_type']}")
+                if not any(previous["config_type"] in PRUNER_CONFIG_TYPES for previous in self.stages[:i]):
+                    raise ValueError("Joint compression palettizes pruned weights, but no pruning stage comes before it")
+
+    @classmethod
+    def from_dict(cls, pipeline: Dict[str, Any], name: Optional[str] = None) -> "CompressionPipeline":
+        """
+        Create a pipeline from a dictionary with a `stages` list. A single `OptimizationConfig` dictionary,
+        such as the contents of `linear_config.yaml`, is read as a pipeline with one stage.
+        """
+        if "config_type" in pipeline:
+            return cls([pipeline], name=name)
+        return cls(pipeline.get("stages", []), pipeline.get("compute_precision", "float16"), name=name)
+
+    @classmethod
+    def from_file(cls, path: Union[str, Path]) -> "CompressionPipeline":
+        """Read a pipeline from a YAML or JSON file. The variant is named after the file."""
+        return cls.from_dict(read_pipeline_file(path), name=Path(path).stem)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"compute_precision": self.compute_precision, "stages": copy.deepcopy(self.stages)}
+
+    def save(self, path: Union[str, Path]):
+        """Write the pipeline to a YAML or JSON file, so it can be passed to `--quantize`."""
+        path = Path(path)
+        with open(path, "w") as f:
+            if path.suffix in [".yaml", ".yml"]:
+                import yaml
+                yaml.safe_dump(self.to_dict(), f, sort_keys=False)
+            else:
+                json.dump(self.to_dict(), f, indent=2)
+
+    def apply(
+        self, mlmodel: "ct.models.MLModel", num_workers: Optional[int] = None
+    ) -> Tuple["ct.models.MLModel", List[Dict[str, Any]]]:
+        """
+        Run all stages on the model.
+
+        Args:
+            mlmodel (`ct.models.MLModel`):
+                The model to compress.
+            num_workers (`int`, *optional*):
+                If larger than 1, the k-means clustering of palettization stages runs in this many worker
+                processes, with [`~coreml.palettization.ParallelPalettizer`]. The result is the same.
+
+        Returns:
+            `Tuple[ct.models.MLModel, List[Dict[str, Any]]]`: the compressed model, and for every stage
+            the size of the model before and after it, and the sparsity, bits per weight, and load size of
+            every compressed weight (see [`get_layer_report`]).
+        """
+        import coremltools.optimize.coreml as cto
+
+        report = []
+        for i, stage in enumerate(self.stages):
+            config_type = stage["config_type"]
+            function = getattr(cto, STAGE_FUNCTIONS[config_type])
+            stage = copy.deepcopy(stage)
+            joint_compression = stage.pop("joint_compression", False)
+            if stage.get("op_name_configs"):
+                stage["op_name_configs"] = resolve_op_names(stage["op_name_configs"], get_const_names(mlmodel))
+            if config_type == "OpPalettizerConfig":
+                config = make_palettizer_config(stage)
+            else:
+                config = cto.OptimizationConfig.from_dict(stage)
+
+            kwargs = {}
+            if joint_compression:
+                if "joint_compression" not in inspect.signature(function).parameters:
+                    raise ValueError("Joint sparse and palettized compression requires coremltools 8 or newer")
+                kwargs["joint_compression"] = True
+
+            size_before = get_model_size(mlmodel)
+            logger.info(f"Compression stage {i + 1}/{len(self.stages)}: {config_type}")
+            stage_report = {"stage": config_type, "size_before": size_before}
+            with profile_span("compression_stage", config_type=config_type, index=i):
+                # The parallel palettizer reads uncompressed weights only, so it does not handle joint compression.
+                if config_type == "OpPalettizerConfig" and not joint_compression and num_workers is not None and num_workers > 1:
+                    palettizer = ParallelPalettizer(num_workers)
+                    mlmodel = palettizer.palettize(mlmodel, config)
+                    stage_report["clustering"] = palettizer.timings
+                else:
+                    mlmodel = function(mlmodel, config=config, **kwargs)
+            size_after = get_model_size(mlmodel)
+
+            logger.info(f"\t{size_before / 1024**2:.1f} MB -> {size_after / 1024**2:.1f} MB")
+            stage_report["size_after"] = size_after
+
+            layers = get_layer_report(mlmodel)
+            if len(layers) > 0:
+                num_elements = sum(layer["num_elements"] for layer in layers)
+                num_pruned = sum(layer["sparsity"] * layer["num_elements"] for layer in layers)
+                load_size = sum(layer["load_size"] for layer in layers)
+                logger.info(
+                    f"\t{len(layers)} compressed weights: {num_pruned / num_elements:.1%} sparsity, "
+                    f"{8 * load_size / num_elements:.2f} bits per weight"
+                )
+                stage_report["layers"] = layers
+            report.append(stage_report)
+
+        return mlmodel, report
+
+
+def is_pipeline_file(value: Union[str, Path]) -> bool:
+    """Whether the path points to a compression pipeline, rather than a list of variants."""
+    if not Path(value).is_file():
+        return False
+    contents = read_pipeline_file(value)
+    return isinstance(contents, dict) and ("stages" in contents or "config_type" in contents)
+
+
+def get_compression_pipeline(quantize: str) -> CompressionPipeline:
+    """The pipeline for a `--quantize` option: a built-in option name, or the path to a pipeline file."""
+    if quantize in BUILTIN_PIPELINES:
+        return CompressionPipeline.from_dict(BUILTIN_PIPELINES[quantize], name=quantize)
+    if is_pipeline_file(quantize):
+        return CompressionPipeline.from_file(quantize)
+    raise ValueError(f"Unknown quantization option '{quantize}', expected one of {QUANTIZE_OPTIONS} or a pipeline file")
+
+
+def get_variant_name(quantize: str) -> str:
+    """Short name of a `--quantize` option, for use in file names."""
+    return quantize if quantize in BUILTIN_PIPELINES else Path(quantize).stem
+
+
+def main(argv=None):
+    parser = ArgumentParser("Compress the weights of an exported Core ML model")
+    parser.add_argument("input", type=Path, help="The Core ML model to compress.")
+    parser.add_argument("output", type=Path, help="Where to save the compressed model.")
+    parser.add_argument(
+        "--pipeline", type=str, required=True, help=f"A compression pipeline file, or one of {', '.join(QUANTIZE_OPTIONS)}."
+    )
+    parser.add_argument("--report", type=Path, default=None, help="Where to write the per-stage size report as JSON.")
+    parser.add_argument(
+        "--workers", type=int, default=None, help="Number of processes for k-means palettization. By default, coremltools clusters the weights one after the other."
+    )
+    parser.add_argument(
+        "--benchmark_workers", type=int, nargs="+", default=None,
+        help="Time the k-means clustering of every palettization stage with these numbers of processes, for example `1 2 4 8`, and report the speedups. The model is not compressed."
+    )
+    parser.add_argument(
+        "--benchmark_clustering", type=int, default=None, metavar="NBITS",
+        help="Compare the time and error of the `kmeans` and `histogram` palettization modes on the weights of the model, with this many bits. The model is not compressed."
+    )
+    args = parser.parse_args(argv)
+
+    import coremltools as ct
+
+    pipeline = get_compression_pipeline(args.pipeline)
+    mlmodel = ct.models.MLModel(args.input.as_posix(), skip_model_load=True)
+
+    if args.benchmark_clustering is not None:
+        for result in benchmark_clustering(mlmodel, args.benchmark_clustering):
+            print(f"{result['mode']:>10}: {result['time']:8.1f} sec, MSE {result['mse']:.3e}")
+        return
+
+    if args.benchmark_workers is not None:
+        results = []
+        for stage in pipeline.stages:
+            if stage["config_type"] == "OpPalettizerConfig":
+                stage = copy.deepcopy(stage)
+                if stage.get("op_name_configs"):
+                    stage["op_name_configs"] = resolve_op_names(stage["op_name_configs"], get_const_names(mlmodel))
+                config = make_palettizer_config(stage)
+                results.extend(benchmark_palettization(mlmodel, config, args.benchmark_workers))
+        for timings in results:
+            print(
+                f"{timings['num_workers']:>4} workers: {timings['wall_time']:8.1f} sec, "
+                f"{timings['speedup_vs_first']:5.2f}x vs. {results[0]['num_workers']} worker(s)"
+            )
+        return
+
+    mlmodel, report = pipeline.apply(mlmodel, num_workers=args.workers)
+    mlmodel.save(args.output.as_posix())
+    logger.info(f"Compressed model saved at: {args.output}")
+
+    if args.report is not None:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
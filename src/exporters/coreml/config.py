@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
 import dataclasses
 from collections import OrderedDict
 from typing import TYPE_CHECKING, Any, Callable, List, Mapping, Optional, Tuple, Union
@@ -41,6 +42,17 @@ if is_vision_available():
 logger = logging.get_logger(__name__)
 
 
+# How the key / value cache of a `use_past` model is exchanged with the caller:
+# - "dynamic": the past keys and values are inputs, and the past plus the new ones are outputs.
+# - "static": the past keys and values are inputs of `max_context_length` entries, and the same tensors with
+#   the new ones written at their positions are outputs.
+# - "stateful": the cache is model state of `max_context_length` entries that persists across predictions.
+KV_CACHE_MODES = ["dynamic", "static", "stateful"]
+
+# Data types of the key / value cache inputs and outputs. "int8" stores every key and value vector with a scale.
+KV_CACHE_DTYPES = ["float32", "float16", "int8"]
+
+
 @dataclasses.dataclass
 class InputDescription:
     """
@@ -54,17 +66,19 @@ class InputDescription:
             Input description in the Core ML Model.
         is_optional (`bool`, *optional*, defaults to `False`):
             If true, this input may be omitted.
-        sequence_length (`int` or tuple, *optional*, defaults to `None`):
+        sequence_length (`int`, tuple or list, *optional*, defaults to `None`):
             Sequence length for text inputs. If this is a single value, the sequence length will be a fixed size
             in the exported model, giving the input tensor the shape `(batch_size, sequence_length)`.
             If this is a tuple `(min, max)`, the sequence length is allowed to vary between those two sizes.
+            If this is a list, such as `[32, 64, 128]`, the sequence length can be any of those sizes. Unlike a
+            range, these enumerated shapes still let the model run on the GPU and the Neural Engine.
         color_layout (`str`, *optional*, defaults to `None`):
             Channel ordering for image inputs. Either `"RGB"` or `"BGR"`.
     """
     name: str
     description: str = ""
     is_optional: bool = False
-    sequence_length: Optional[Union[int, Tuple[int, int]]] = None
+    sequence_length: Optional[Union[int, Tuple[int, int], List[int]]] = None
     color_layout: Optional[str] = None
 
 
@@ -104,6 +118,37 @@ class CoreMLConfig():
             attention blocks) for fast autoregressive decoding.
         seq2seq: `None` if not an encoder-decoder model, `"encoder"` to export the encoder
             part of a seq2seq model, `"decoder"` to export the decoder part.
+        kv_cache: How a `use_past` model exchanges its key / value cache, one of `KV_CACHE_MODES`.
+            With `"static"`, the past keys and values have room for `max_context_length` tokens, and the new
+            ones are written at the given `position`. With `"stateful"`, that cache is kept as model state,
+            and only the `input_ids`, their `position`, and the logits are inputs and outputs.
+        max_context_length: Number of tokens the key / value cache can hold, when it has a fixed size.
+            Defaults to `max_sequence_length`.
+        new_kv_only: With `use_past`, the `present_{i}_key` and `present_{i}_value` outputs only hold the keys
+            and values of the new tokens, instead of the whole cache. Use [`KeyValueCacheManager`] to append
+            them to the cache on the host.
+        stack_kv_cache: With `use_past`, the keys and values of all layers are a single `past_key_values` input
+            and `present_key_values` output of shape `(2, num_layers, batch_size, num_heads, sequence_length,
+            head_size)`, instead of an input and an output per layer for the keys and for the values.
+        kv_cache_dtype: Data type of the key / value cache inputs and outputs, one of `KV_CACHE_DTYPES`.
+            By default, this follows the compute precision of the model. With `"int8"`, every key and value
+            vector of every head is quantized with its own scale, which is an extra `..._scale` input and output.
+        sequence_lengths: The sequence lengths the `input_ids` can have, as enumerated shapes. By default,
+            the sequence length is fixed to `max_sequence_length`. Not supported with `use_past` or `seq2seq`.
+        batch_size: The batch sizes the inputs and outputs can have, either a range `(min, max)`, where a `max`
+            of -1 means no upper limit, or a list of sizes for enumerated shapes. By default, the batch size is
+            fixed to 1. Not supported for image inputs, classifiers, or with a fixed-size key / value cache.
+            Audio inputs, which have a range of sequence lengths, and `use_past` require a range.
+        prefill_length: With a fixed-size key / value cache, export a multifunction model with a `"prefill"`
+            function for a prompt of `prefill_length` tokens, and a `"decode"` function for one token at a time,
+            which share their weights.
+        num_chunks: Split a text-generation decoder into this many models, each with a contiguous range of
+            layers, which are run one after the other and pass the hidden states on. The first chunk also has
+            the embeddings, and the last one the final norm and the language modeling head. Not supported with
+            a stacked or stateful key / value cache, a `prefill_length`, or a flexible `batch_size`.
+        cross_attention_cache: For an encoder-decoder model, the encoder also outputs the keys and values of the
+            cross-attention of every decoder layer, and the decoder, which needs `use_past`, takes them as inputs
+            instead of the encoder's hidden states, so it does not compute them again for every token.
     """
     def __init__(
         self,
@@ -111,6 +156,16 @@ class CoreMLConfig():
         task: str,
         use_past: bool = False,
         seq2seq: Optional[str] = None,
+        kv_cache: str = "dynamic",
+        max_context_length: Optional[int] = None,
+        new_kv_only: bool = False,
+        stack_kv_cache: bool = False,
+        kv_cache_dtype: Optional[str] = None,
+        sequence_lengths: Optional[List[int]] = None,
+        batch_size: Optional[Union[Tuple[int, int], List[int]]] = None,
+        prefill_length: Optional[int] = None,
+        num_chunks: Optional[int] = None,
+        cross_attention_cache: bool = False,
     ):
         if not hasattr(self, "modality"):
             raise ValueError("the CoreMLConfig subclass must have a modality property")
@@ -118,10 +173,105 @@ class CoreMLConfig():
         if use_past and seq2seq == "encoder":
             raise ValueError("invalid option `use_past=True` for encoder model")
 
+        if kv_cache not in KV_CACHE_MODES:
+            raise ValueError(f"unknown key / value cache mode '{kv_cache}', expected one of {KV_CACHE_MODES}")
+
+        if kv_cache != "dynamic" and (not use_past or seq2seq is not None or task != "text-generation"):
+            raise ValueError(f"the '{kv_cache}' key / value cache requires `use_past=True` and the text-generation task")
+
+        if new_kv_only and (not use_past or kv_cache == "stateful"):
+            raise ValueError("`new_kv_only=True` requires `use_past=True` and a key / value cache that is an output")
+
+        if stack_kv_cache and (not use_past or kv_cache == "stateful"):
+            raise ValueError("`stack_kv_cache=True` requires `use_past=True` and a key / value cache that is an output")
+
+        if kv_cache_dtype is not None and kv_cache_dtype not in KV_CACHE_DTYPES:
+            raise ValueError(f"unknown key / value cache data type '{kv_cache_dtype}', expected one of {KV_CACHE_DTYPES}")
+
+        if kv_cache_dtype == "int8" and (not use_past or kv_cache == "stateful"):
+            raise ValueError("an int8 key / value cache requires `use_past=True` and a key / value cache that is an output")
+
+        if sequence_lengths is not None and (use_past or seq2seq is not None):
+            raise ValueError("enumerated sequence lengths are not supported with `use_past` or `seq2seq`")
+
+        if sequence_lengths is not None and (len(sequence_lengths) == 0 or min(sequence_lengths) < 1):
+            raise ValueError(f"invalid sequence lengths {sequence_lengths}, expected a list of positive integers")
+
+        if isinstance(batch_size, list):
+            if len(batch_size) == 0 or min(batch_size) < 1:
+                raise ValueError(f"invalid batch sizes {batch_size}, expected a list of positive integers")
+            # A range of sequence lengths cannot be combined with enumerated batch sizes.
+            if use_past:
+                raise ValueError("`use_past` requires the batch size to be a range `(min, max)`")
+            if self.modality == "audio":
+                raise ValueError(
+                    "audio inputs, which have a range of lengths, require the batch size to be a range `(min, max)`"
+                )
+        elif batch_size is not None:
+            batch_size = tuple(batch_size)
+            if len(batch_size) != 2 or batch_size[0] < 1 or (batch_size[1] != -1 and batch_size[1] < batch_size[0]):
+                raise ValueError(f"invalid batch size range {batch_size}, expected `(min, max)`")
+            if sequence_lengths is not None:
+                raise ValueError("enumerated sequence lengths require the batch sizes to be a list")
+
+        if batch_size is not None and (self.modality == "vision" or kv_cache != "dynamic"):
+            raise ValueError("a flexible batch size is not supported for image inputs or a fixed-size key / value cache")
+
+        if prefill_length is not None and (not use_past or kv_cache == "dynamic"):
+            raise ValueError("`prefill_length` requires `use_past=True` and a fixed-size key / value cache")
+
+        if prefill_length is not None and prefill_length < 2:
+            raise ValueError(f"invalid prefill length {prefill_length}, expected at least 2 tokens")
+
+        if num_chunks is not None and (task != "text-generation" or seq2seq is not None):
+            raise ValueError("`num_chunks` requires a decoder-only model and the text-generation task")
+
+        if num_chunks is not None and (
+            stack_kv_cache or kv_cache == "stateful" or prefill_length is not None or batch_size is not None
+        ):
+            raise ValueError(
+                "`num_chunks` is not supported with a stacked or stateful key / value cache, a `prefill_length`,"
+                " or a flexible `batch_size`"
+            )
+
+        if cross_attention_cache and not (seq2seq == "encoder" or (seq2seq == "decoder" and use_past)):
+            raise ValueError("`cross_attention_cache=True` requires a seq2seq encoder, or a decoder with `use_past=True`")
+
+        if cross_attention_cache and (stack_kv_cache or kv_cache_dtype == "int8"):
+            raise ValueError("`cross_attention_cache=True` is not supported with a stacked or int8 key / value cache")
+
         self._config = config
         self.task = task
         self.use_past = use_past
         self.seq2seq = seq2seq
+        self.kv_cache = kv_cache
+        self._max_context_length = max_context_length
+        self.new_kv_only = new_kv_only
+        self.stack_kv_cache = stack_kv_cache
+        self.kv_cache_dtype = kv_cache_dtype
+        self.sequence_lengths = sorted(set(sequence_lengths)) if sequence_lengths is not None else None
+        self.batch_size = sorted(set(batch_size)) if isinstance(batch_size, list) else batch_size
+        self.prefill_length = prefill_length
+        self.num_chunks = num_chunks
+        self.cross_attention_cache = cross_attention_cache
+
+        # The function of a multifunction model that this config exports, see `get_function_config`.
+        self.function = None
+
+        # The chunk of a model with `num_chunks` that this config exports, see `get_chunk_config`.
+        self.chunk = None
+
+        if prefill_length is not None and prefill_length > self.max_context_length:
+            raise ValueError(
+                f"the prefill length {prefill_length} does not fit in a cache of {self.max_context_length} tokens"
+            )
+
+        if num_chunks is not None and not 2 <= num_chunks <= self.num_layers:
+            raise ValueError(f"invalid number of chunks {num_chunks}, expected from 2 to {self.num_layers}")
+
+        # The class label and probabilities outputs of a classifier describe a single example.
+        if batch_size is not None and self.is_classifier:
+            raise ValueError("a flexible batch size is not supported for classifier models")
 
     @classmethod
     def from_model_config(
@@ -130,6 +280,7 @@ class CoreMLConfig():
         task: str = "feature-extraction",
         use_past: bool = False,
         seq2seq: Optional[str] = None,
+        **kwargs,
     ) -> "CoreMLConfig":
         """
         Instantiate a `CoreMLConfig` for a specific model.
@@ -141,11 +292,12 @@ class CoreMLConfig():
                 attention blocks) for fast autoregressive decoding.
             seq2seq: `None` if not an encoder-decoder model, `"encoder"` to export the encoder
                 part of a seq2seq model, `"decoder"` to export the decoder part.
+            kwargs: Other export options, such as `kv_cache`, see [`CoreMLConfig`].
 
         Returns:
             `CoreMLConfig` for this model
         """
-        return cls(config, task=task, use_past=use_past, seq2seq=seq2seq)
+        return cls(config, task=task, use_past=use_past, seq2seq=seq2seq, **kwargs)
 
     @classmethod
     def with_past(
@@ -153,6 +305,7 @@ class CoreMLConfig():
         config: "PretrainedConfig",
         task: str = "feature-extraction",
         seq2seq: Optional[str] = None,
+        **kwargs,
     ) -> "CoreMLConfig":
         """
         Instantiate a `CoreMLConfig` with `use_past` attribute set to True
@@ -162,11 +315,86 @@ class CoreMLConfig():
             task: The model topology that will be exported.
             seq2seq: `None` if not an encoder-decoder model, `"encoder"` to export the encoder
                 part of a seq2seq model, `"decoder"` to export the decoder part.
+            kwargs: Other export options, such as `kv_cache`, see [`CoreMLConfig`].
 
         Returns:
             `CoreMLVisionConfig` for this model with `.use_past = True`
         """
-        return cls(config, task=task, use_past=True, seq2seq=seq2seq)
+        kwargs.pop("use_past", None)
+        return cls(config, task=task, use_past=True, seq2seq=seq2seq, **kwargs)
+
+    @property
+    def export_options(self) -> Mapping[str, Any]:
+        """The export options besides `task`, `use_past`, and `seq2seq`, for example to make a cache key."""
+        return {
+            "kv_cache": self.kv_cache,
+            "max_context_length": self._max_context_length,
+            "new_kv_only": self.new_kv_only,
+            "stack_kv_cache": self.stack_kv_cache,
+            "kv_cache_dtype": self.kv_cache_dtype,
+            "sequence_lengths": self.sequence_lengths,
+            "batch_size": self.batch_size,
+            "prefill_length": self.prefill_length,
+            "function": self.function,
+            "num_chunks": self.num_chunks,
+            "chunk": self.chunk,
+            "cross_attention_cache": self.cross_attention_cache,
+        }
+
+    @property
+    def functions(self) -> List[str]:
+        """
+        The names of the functions of a multifunction model, which share their weights. With a `prefill_length`,
+        these are `"prefill"` and `"decode"`. Empty for a model with a single function, or for the config of one
+        of the functions.
+        """
+        if self.prefill_length is None or self.function is not None:
+            return []
+        return ["prefill", "decode"]
+
+    def get_function_config(self, function: str) -> "CoreMLConfig":
+        """
+        A copy of this config that describes a single function of the multifunction model, with its own
+        input shapes.
+        """
+        if function not in ["prefill", "decode"] or self.prefill_length is None:
+            raise ValueError(f"unknown function '{function}', expected one of {self.functions}")
+        config = copy.copy(self)
+        config.function = function
+        return config
+
+    @property
+    def chunk_layers(self) -> List[Tuple[int, int]]:
+        """
+        The range of layers `(start, end)` of every chunk of a model with `num_chunks`, which splits the layers
+        as evenly as possible. Empty for a model that is not split, or for the config of one of the chunks.
+        """
+        if self.num_chunks is None or self.chunk is not None:
+            return []
+        bounds = [i * self.num_layers // self.num_chunks for i in range(self.num_chunks + 1)]
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    @property
+    def layer_range(self) -> Tuple[int, int]:
+        """The range of layers `(start, end)` that this config exports: those of its chunk, or all of them."""
+        if self.chunk is None:
+            return (0, self.num_layers)
+        parent = copy.copy(self)
+        parent.chunk = None
+        return parent.chunk_layers[self.chunk]
+
+    def get_chunk_config(self, chunk: int) -> "CoreMLConfig":
+        """
+        A copy of this config that describes a single chunk of a model with `num_chunks`. The chunks after the
+        first have a `hidden_states` input instead of the `input_ids`, and the chunks before the last have a
+        `hidden_states` output instead of the logits. The key / value cache inputs and outputs are those of
+        the chunk's layers, and keep their layer numbers.
+        """
+        if self.num_chunks is None or not 0 <= chunk < self.num_chunks:
+            raise ValueError(f"unknown chunk {chunk}, expected a number from 0 to {(self.num_chunks or 1) - 1}")
+        config = copy.copy(self)
+        config.chunk = chunk
+        return config
 
     @property
     def inputs(self) -> "OrderedDict[str, InputDescription]":
@@ -175,9 +403,25 @@ class CoreMLConfig():
         """
         common_inputs = self._input_descriptions
 
-        if self.use_past:
+        if self.use_past and self.kv_cache != "dynamic":
+            self.fill_inputs_for_fixed_size_kv_cache_(common_inputs)
+        elif self.use_past:
             self.fill_inputs_with_past_key_values_(common_inputs)
 
+        if self.chunk is not None and self.chunk > 0:
+            # The hidden states of the previous chunk take the place of the tokens.
+            common_inputs = OrderedDict(
+                (
+                    "hidden_states",
+                    InputDescription(
+                        "hidden_states",
+                        "Hidden states at the output of the previous chunk",
+                        sequence_length=input_desc.sequence_length,
+                    ),
+                ) if name == "input_ids" else (name, input_desc)
+                for name, input_desc in common_inputs.items()
+            )
+
         return common_inputs
 
     @property
@@ -197,6 +441,27 @@ class CoreMLConfig():
                 return self._config.max_position_embeddings
         return 128
 
+    @property
+    def max_context_length(self) -> int:
+        """
+        The number of tokens that fit in a key / value cache of fixed size, such as the `"stateful"` cache.
+        Defaults to `max_sequence_length`.
+        """
+        return self._max_context_length or self.max_sequence_length
+
+    @property
+    def dummy_batch_size(self) -> int:
+        """
+        The batch size of the dummy inputs that the model is traced and validated with. With a flexible
+        `batch_size`, this is more than one when allowed, so that a batch of one is not baked into the trace.
+        """
+        if self.batch_size is None:
+            return 1
+        if isinstance(self.batch_size, list):
+            return next((size for size in self.batch_size if size > 1), self.batch_size[0])
+        min_size, max_size = self.batch_size
+        return min_size if min_size > 1 or max_size == 1 else 2
+
     @property
     def use_flexible_shapes(self) -> bool:
         """
@@ -207,14 +472,22 @@ class CoreMLConfig():
         return False
 
     @property
-    def input_ids_sequence_length(self) -> Union[Tuple, int]:
+    def input_ids_sequence_length(self) -> Union[Tuple, int, List[int]]:
         """
         Sequence lengths supported for the `input_ids`.
 
         - When returning a tuple, flexible shapes will be used. The tuple must contain two items,
         representing the minimum and maximum possible sequence lengths.
+        - When returning a list, enumerated shapes will be used, one for every sequence length in the list.
         - When returning an `int`, a fixed sequence length will be used.
+
+        With a key / value cache of fixed size, the model predicts one new token at a time, except for the
+        `"prefill"` function, which takes `prefill_length` tokens.
         """
+        if self.use_past and self.kv_cache != "dynamic":
+            return self.prefill_length if self.function == "prefill" else 1
+        if self.sequence_lengths is not None:
+            return list(self.sequence_lengths)
         return (1, self.max_sequence_length) if self.use_flexible_shapes else self.max_sequence_length
 
 
@@ -394,9 +667,19 @@ class CoreMLConfig():
         """
         common_outputs = self._output_descriptions
 
-        if self.use_past:
+        if (self.use_past and self.kv_cache != "stateful") or (self.seq2seq == "encoder" and self.cross_attention_cache):
             self.fill_outputs_with_past_key_values_(common_outputs)
 
+        if self.chunk is not None and self.chunk < self.num_chunks - 1:
+            # Core ML does not allow an output with the same name as an input.
+            common_outputs = OrderedDict(
+                (
+                    "hidden_states",
+                    OutputDescription("next_hidden_states", "Hidden states at the output of the chunk's last layer"),
+                ) if name == "logits" else (name, output_desc)
+                for name, output_desc in common_outputs.items()
+            )
+
         return common_outputs
 
     @property
@@ -543,7 +826,8 @@ class CoreMLConfig():
         Determines which outputs require flexible shapes and on which axes.
 
         Flexible output shapes are used when `sequence_length` on the model input is a range of
-        allowed lengths.
+        allowed lengths, or a list of them, and for the batch axis of every output with a `batch_size`.
+        With a list, the output shapes also have the allowed `"sizes"`.
         """
         output_shapes = {}
 
@@ -563,50 +847,68 @@ class CoreMLConfig():
 
             # If this model has flexible input shapes, it also needs flexible output shapes.
             min_length, max_length = None, None
-            if self.use_past or self.seq2seq:
+            sequence_length = None
+            if (self.use_past and self.kv_cache == "dynamic") or self.seq2seq:
                 min_length, max_length = 1, -1
             else:
                 sequence_length = self.get_input_sequence_length(input_descs)
                 if isinstance(sequence_length, tuple):
                     min_length, max_length = sequence_length
+                elif isinstance(sequence_length, list):
+                    min_length, max_length = min(sequence_length), max(sequence_length)
 
             if min_length is not None:
-                for key in ["last_hidden_state", "logits", "start_logits", "end_logits"]:
+                for key in ["last_hidden_state", "hidden_states", "logits", "start_logits", "end_logits"]:
                     if key in output_descs:
                         output_shapes[key] = [
-                            #{ "axis": 0, "min": 1, "max": -1 },  # batch size  # TODO
                             { "axis": 1, "min": min_length, "max": max_length },
                         ]
+                        if isinstance(sequence_length, list):
+                            output_shapes[key][0]["sizes"] = list(sequence_length)
 
-        if self.use_past:
-            # TODO: Temporarily disabled until we can solve the issue with encoder past key/values
-            #name = "decoder_present" if self.seq2seq == "decoder" else "present"
+        if self.use_past and self.kv_cache == "dynamic":
             name = "present"
-            for i in range(self.num_layers):
-                output_shapes[f"{name}_{i}_key"] = [
-                    #{ "axis": 0, "min": 1, "max": -1 },  # batch size  # TODO
+            if self.stack_kv_cache:
+                output_shapes[f"{name}_key_values"] = [
+                    { "axis": 4, "min": 1, "max": -1 },
+                ]
+            else:
+                for i in range(*self.layer_range):
+                    output_shapes[f"{name}_{i}_key"] = [
+                        { "axis": 2, "min": 1, "max": -1 },
+                    ]
+                    output_shapes[f"{name}_{i}_value"] = [
+                        { "axis": 2, "min": 1, "max": -1 },
+                    ]
+
+        if self.seq2seq == "encoder" and self.cross_attention_cache:
+            # The cross-attention keys and values have the encoder's sequence length.
+            for i in range(self.num_decoder_layers):
+                output_shapes[f"encoder_present_{i}_key"] = [
                     { "axis": 2, "min": 1, "max": -1 },
                 ]
-                output_shapes[f"{name}_{i}_value"] = [
-                    #{ "axis": 0, "min": 1, "max": -1 },  # batch size  # TODO
+                output_shapes[f"encoder_present_{i}_value"] = [
                     { "axis": 2, "min": 1, "max": -1 },
                 ]
 
-            # TODO: Temporarily disabled until we can solve the issue with encoder past key/values
-            # if self.seq2seq == "decoder":
-            #     for i in range(self.num_encoder_layers):
-            #         output_shapes[f"encoder_present_{i}_key"] = [
-            #             { "axis": 2, "min": 1, "max": -1 },
-            #         ]
-            #         output_shapes[f"encoder_present_{i}_value"] = [
-            #             { "axis": 2, "min": 1, "max": -1 },
-            #         ]
+        if self.batch_size is not None:
+            for key in self.outputs:
+                # The stacked cache has the layers first.
+                axis = 2 if key.startswith("present_key_values") else 0
+                if isinstance(self.batch_size, list):
+                    batch_shape = { "axis": axis, "min": self.batch_size[0], "max": self.batch_size[-1] }
+                    batch_shape["sizes"] = list(self.batch_size)
+                else:
+                    batch_shape = { "axis": axis, "min": self.batch_size[0], "max": self.batch_size[1] }
+                output_shapes.setdefault(key, []).insert(0, batch_shape)
 
         return output_shapes
 
     def get_input_sequence_length(self, input_descs):
         if "input_ids" in input_descs:
             return input_descs["input_ids"].sequence_length
+        elif "hidden_states" in input_descs:
+            return input_descs["hidden_states"].sequence_length
         elif "input_values" in input_descs:
             return input_descs["input_values"].sequence_length
         elif "input_features" in input_descs:
@@ -646,6 +948,14 @@ class CoreMLConfig():
         """
         return getattr(self._config, "encoder_layers", self.num_layers)
 
+    @property
+    def num_decoder_layers(self) -> int:
+        """
+        The number of decoder layers retrieved from the model config of an encoder-decoder model, which is the
+        number of cross-attention keys and values.
+        """
+        return getattr(self._config, "decoder_layers", self.num_layers)
+
     @property
     def num_attention_heads(self) -> int:
         """
@@ -665,35 +975,109 @@ class CoreMLConfig():
             )
         return self._config.num_attention_heads
 
+    @property
+    def num_key_value_heads(self) -> int:
+        """
+        The number of key / value heads in the attention blocks, which is smaller than the number of attention
+        heads for models with grouped-query or multi-query attention. Override this for model configs where
+        the attribute is not called `num_key_value_heads`.
+        """
+        return getattr(self._config, "num_key_value_heads", None) or self.num_attention_heads
+
+    def get_kv_cache_io_dtypes(self, compute_precision: str) -> Tuple[Any, Any]:
+        """
+        The numpy data types of the key / value cache inputs and outputs, and of their scales with
+        `kv_cache_dtype="int8"`, for a model converted with the given compute precision.
+        """
+        float_dtype = np.float32
+        if self.kv_cache_dtype == "float16" or (self.kv_cache_dtype != "float32" and compute_precision == "float16"):
+            float_dtype = np.float16
+        return (np.int8 if self.kv_cache_dtype == "int8" else float_dtype), float_dtype
+
+    @property
+    def head_dim(self) -> int:
+        """The size of the keys and values of every attention head."""
+        return getattr(self._config, "head_dim", None) or self._config.hidden_size // self.num_attention_heads
+
     def fill_inputs_with_past_key_values_(self, inputs: "OrderedDict[str, InputDescription]"):
-        # TODO: Temporarily disabled until we can solve the issue with encoder past key/values
-        #name = "decoder_past_key_values" if self.seq2seq == "decoder" else "past_key_values"
         name = "past_key_values"
-        for i in range(self.num_layers):
+        if self.stack_kv_cache:
+            inputs[name] = InputDescription(name, "Keys and values of all layers, stacked", is_optional=True)
+            if self.kv_cache_dtype == "int8":
+                inputs[f"{name}_scale"] = InputDescription(f"{name}_scale", is_optional=True)
+            return
+
+        for i in range(*self.layer_range):
             inputs[f"{name}_{i}_key"] = InputDescription(f"{name}_{i}_key", is_optional=True)
             inputs[f"{name}_{i}_value"] = InputDescription(f"{name}_{i}_value", is_optional=True)
-
-        # TODO: Temporarily disabled until we can solve the issue with encoder past key/values
-        # if self.seq2seq == "decoder":
-        #     name = "encoder_past_key_values"
-        #     for i in range(self.num_encoder_layers):
-        #         inputs[f"{name}_{i}_key"] = InputDescription(f"{name}_{i}_key", is_optional=True)
-        #         inputs[f"{name}_{i}_value"] = InputDescription(f"{name}_{i}_value", is_optional=True)
+            if self.kv_cache_dtype == "int8":
+                inputs[f"{name}_{i}_key_scale"] = InputDescription(f"{name}_{i}_key_scale", is_optional=True)
+                inputs[f"{name}_{i}_value_scale"] = InputDescription(f"{name}_{i}_value_scale", is_optional=True)
+
+        if self.seq2seq == "decoder" and self.cross_attention_cache:
+            # The keys and values of the cross-attention, from the encoder's `encoder_present` outputs, take the
+            # place of the encoder's hidden states. There is one for every decoder layer.
+            inputs.pop("encoder_outputs", None)
+            name = "encoder_past_key_values"
+            for i in range(self.num_layers):
+                inputs[f"{name}_{i}_key"] = InputDescription(f"{name}_{i}_key", "Cross-attention keys from the encoder")
+                inputs[f"{name}_{i}_value"] = InputDescription(f"{name}_{i}_value", "Cross-attention values from the encoder")
 
     def fill_outputs_with_past_key_values_(self, outputs: "OrderedDict[str, OutputDescription]"):
-        # TODO: Temporarily disabled until we can solve the issue with encoder past key/values
-        # name = "decoder_present" if self.seq2seq == "decoder" else "present"
+        if self.seq2seq == "encoder":
+            # The keys and values of the cross-attention of every decoder layer only depend on the encoder's
+            # output, so the encoder computes them once, for the decoder's `encoder_past_key_values` inputs.
+            name = "encoder_present"
+            for i in range(self.num_decoder_layers):
+                outputs[f"{name}_{i}_key"] = OutputDescription(f"{name}_{i}_key", "Cross-attention keys for the decoder")
+                outputs[f"{name}_{i}_value"] = OutputDescription(f"{name}_{i}_value", "Cross-attention values for the decoder")
+            return
+
         name = "present"
-        for i in range(self.num_layers):
+        if self.stack_kv_cache:
+            outputs[f"{name}_key_values"] = OutputDescription(f"{name}_key_values", "Keys and values of all layers, stacked")
+            if self.kv_cache_dtype == "int8":
+                outputs[f"{name}_key_values_scale"] = OutputDescription(f"{name}_key_values_scale")
+            return
+
+        for i in range(*self.layer_range):
             outputs[f"{name}_{i}_key"] = OutputDescription(f"{name}_{i}_key")
             outputs[f"{name}_{i}_value"] = OutputDescription(f"{name}_{i}_value")
+            if self.kv_cache_dtype == "int8":
+                outputs[f"{name}_{i}_key_scale"] = OutputDescription(f"{name}_{i}_key_scale")
+                outputs[f"{name}_{i}_value_scale"] = OutputDescription(f"{name}_{i}_value_scale")
+
 
-        # TODO: Temporarily disabled until we can solve the issue with encoder past key/values
-        # if self.seq2seq == "decoder":
-        #     name = "encoder_present"
-        #     for i in range(self.num_encoder_layers):
-        #         outputs[f"{name}_{i}_key"] = OutputDescription(f"{name}_{i}_key")
-        #         outputs[f"{name}_{i}_value"] = OutputDescription(f"{name}_{i}_value")
+    def fill_inputs_for_fixed_size_kv_cache_(self, inputs: "OrderedDict[str, InputDescription]"):
+        # The attention mask follows from the position: everything before it is in the cache.
+        inputs.pop("attention_mask", None)
+        inputs["position"] = InputDescription(
+            "position",
+            "Position of the first of the input_ids in the sequence, which is the number of tokens already in the cache",
+        )
+        if self.kv_cache == "static":
+            self.fill_inputs_with_past_key_values_(inputs)
+
+    @property
+    def kv_cache_shape(self) -> Tuple[int, int, int, int]:
+        """
+        Shape of the key or the value cache of one layer: batch size, key / value heads, `max_context_length`,
+        head size.
+        """
+        return (1, self.num_key_value_heads, self.max_context_length, self.head_dim)
+
+    @property
+    def states(self) -> "OrderedDict[str, Tuple[int, ...]]":
+        """
+        Names and shapes of the tensors that the model keeps as state across predictions. These are the
+        `key_cache_{i}` and `value_cache_{i}` of every layer with `kv_cache="stateful"`.
+        """
+        states = OrderedDict()
+        if self.use_past and self.kv_cache == "stateful":
+            for i in range(self.num_layers):
+                states[f"key_cache_{i}"] = self.kv_cache_shape
+                states[f"value_cache_{i}"] = self.kv_cache_shape
+        return states
 
     @property
     def values_override(self) -> Optional[Mapping[str, Any]]:
@@ -828,6 +1212,8 @@ class CoreMLConfig():
             if sequence_length == -1:
                 sequence_length = default_length
             return sequence_length
+        elif isinstance(input_desc.sequence_length, list):
+            return max(input_desc.sequence_length)
         else:
             return input_desc.sequence_length
 
@@ -843,6 +1229,7 @@ class CoreMLConfig():
         self,
         preprocessor: Union["PreTrainedTokenizerBase", "ImageProcessingMixin", "ProcessorMixin"],
         framework: Optional[TensorType] = None,
+        sequence_length: Optional[int] = None,
     ) -> Mapping[str, Tuple[Any, Any]]:
         """
         Generate dummy input data to provide to the Core ML exporter.
@@ -852,6 +1239,9 @@ class CoreMLConfig():
                 The preprocessor associated with this model configuration.
             framework (`TensorType`, *optional*, defaults to `None`):
                 The framework (PyTorch or TensorFlow) that the preprocessor will generate tensors for.
+            sequence_length (`int`, *optional*, defaults to `None`):
+                The sequence length of text and audio inputs, such as one of their enumerated lengths. By default,
+                the maximum sequence length is used.
 
         Returns:
             `Mapping[str, Tuple[Any, Any]]` holding tuples containing the reference and
@@ -861,7 +1251,7 @@ class CoreMLConfig():
         from transformers.tokenization_utils_base import PreTrainedTokenizerBase
         from transformers.processing_utils import ProcessorMixin
 
-        batch_size = 1
+        batch_size = self.dummy_batch_size
         input_descs = self.inputs
         dummy_inputs = {}
 
@@ -873,10 +1263,11 @@ class CoreMLConfig():
                 input_ids_name = "input_ids"
                 attention_mask_name = "attention_mask"
 
-            input_desc = input_descs[input_ids_name]
+            input_desc = input_descs["hidden_states" if "hidden_states" in input_descs else input_ids_name]
 
-            # the dummy input will always use the maximum sequence length
-            sequence_length = self._get_max_sequence_length(input_desc, 64)
+            # the dummy input uses the maximum sequence length, unless another one is given
+            if sequence_length is None:
+                sequence_length = self._get_max_sequence_length(input_desc, 64)
 
             # don't want encoder and decoder to use same sequence length
             # (unless shapes are fixed)
@@ -941,12 +1332,14 @@ class CoreMLConfig():
                     # TODO: some models (e.g. Whisper) may put the mel bins on another axis
 
                     input_desc = input_descs["input_features"]  # mel filterbanks
-                    sequence_length = self._get_max_sequence_length(input_desc, 200)
+                    if sequence_length is None:
+                        sequence_length = self._get_max_sequence_length(input_desc, 200)
                     input_features = np.random.rand(batch_size, sequence_length, mel_bins).astype(np.float32)
                     dummy_inputs["input_features"] = (input_features, input_features)
                 else:
                     input_desc = input_descs["input_values"]  # raw audio
-                    sequence_length = self._get_max_sequence_length(input_desc, 50000)
+                    if sequence_length is None:
+                        sequence_length = self._get_max_sequence_length(input_desc, 50000)
                     input_features = np.random.rand(batch_size, sequence_length).astype(np.float32) * 2.0 - 1.0
                     dummy_inputs["input_values"] = (input_features, input_features)
 
@@ -979,27 +1372,34 @@ class CoreMLConfig():
                 "Unable to generate dummy inputs for the model. Please provide a tokenizer or a preprocessor."
             )
 
-        if self.use_past:
+        if self.use_past and self.kv_cache != "dynamic":
+            batch, sequence_length = dummy_inputs[input_ids_name][0].shape
+
+            # The tokens before the position are in the cache, the rest of it is unused.
+            position = np.array([min(sequence_length + 2, self.max_context_length - sequence_length)], dtype=np.int64)
+            dummy_inputs["position"] = (position, position.astype(np.int32))
+            dummy_inputs.pop(attention_mask_name, None)
+
+            if self.kv_cache == "static":
+                for i in range(*self.layer_range):
+                    for kind in ["key", "value"]:
+                        past = np.zeros(self.kv_cache_shape, dtype=np.float32)
+                        dummy_inputs[f"past_key_values_{i}_{kind}"] = (past, past)
+
+        elif self.use_past:
             batch, sequence_length = dummy_inputs[input_ids_name][0].shape
 
             # Not using the same length for past_key_values
             past_key_values_length = sequence_length + 2
-            shape = (
-                batch,
-                self.num_attention_heads,
-                past_key_values_length,
-                self._config.hidden_size // self.num_attention_heads,
-            )
+            shape = (batch, self.num_key_value_heads, past_key_values_length, self.head_dim)
 
             # Resize the attention mask to include the past
             if attention_mask_name in dummy_inputs:
                 attention_mask = np.ones((batch, sequence_length + past_key_values_length), dtype=np.int64)
                 dummy_inputs[attention_mask_name] = (attention_mask, attention_mask.astype(np.int32))
 
-            # TODO: Temporarily disabled until we can solve the issue with encoder past key/values
-            # name = "decoder_past_key_values" if self.seq2seq == "decoder" else "past_key_values"
             name = "past_key_values"
-            for i in range(self.num_layers):
+            for i in range(*self.layer_range):
                 dummy_inputs[f"{name}_{i}_key"] = (
                     np.zeros(shape, dtype=np.float32), np.zeros(shape, dtype=np.float32)
                 )
@@ -1007,24 +1407,45 @@ class CoreMLConfig():
                     np.zeros(shape, dtype=np.float32), np.zeros(shape, dtype=np.float32)
                 )
 
-            # TODO: Temporarily disabled until we can solve the issue with encoder past key/values
-            # Encoder-decoder model also needs past_key_values for encoder sequence
-            # if self.seq2seq == "decoder":
-            #     encoder_sequence_length = sequence_length + 7
-            #     shape = (
-            #         batch,
-            #         self.num_attention_heads,
-            #         encoder_sequence_length,
-            #         self._config.hidden_size // self.num_attention_heads,
-            #     )
-            #     name = "encoder_past_key_values"
-            #     for i in range(self.num_encoder_layers):
-            #         dummy_inputs[f"{name}_{i}_key"] = (
-            #             np.zeros(shape, dtype=np.float32), np.zeros(shape, dtype=np.float32)
-            #         )
-            #         dummy_inputs[f"{name}_{i}_value"] = (
-            #             np.zeros(shape, dtype=np.float32), np.zeros(shape, dtype=np.float32)
-            #         )
+            # The cross-attention keys and values have the length of the encoder's sequence.
+            if self.seq2seq == "decoder" and self.cross_attention_cache:
+                if "attention_mask" in dummy_inputs:
+                    encoder_sequence_length = dummy_inputs["attention_mask"][0].shape[-1]
+                else:
+                    encoder_sequence_length = sequence_length + 7
+                shape = (batch, self.num_key_value_heads, encoder_sequence_length, self.head_dim)
+                name = "encoder_past_key_values"
+                for i in range(self.num_layers):
+                    dummy_inputs[f"{name}_{i}_key"] = (
+                        np.random.rand(*shape).astype(np.float32), np.random.rand(*shape).astype(np.float32)
+                    )
+                    dummy_inputs[f"{name}_{i}_value"] = (
+                        np.random.rand(*shape).astype(np.float32), np.random.rand(*shape).astype(np.float32)
+                    )
+                dummy_inputs.pop("encoder_outputs", None)
+
+        if self.use_past and self.stack_kv_cache:
+            keys, values = [], []
+            for i in range(self.num_layers):
+                keys.append(dummy_inputs.pop(f"past_key_values_{i}_key")[0])
+                values.append(dummy_inputs.pop(f"past_key_values_{i}_value")[0])
+            past_key_values = np.stack([np.stack(keys), np.stack(values)])
+            dummy_inputs["past_key_values"] = (past_key_values, past_key_values)
+
+        # The dummy cache is empty, so its quantized values and scales are zeros.
+        if self.use_past and self.kv_cache_dtype == "int8":
+            for name in [name for name in dummy_inputs if name.startswith("past_key_values")]:
+                past = dummy_inputs[name][0]
+                quantized = np.zeros(past.shape, dtype=np.int8)
+                scale = np.zeros(past.shape[:-1] + (1,), dtype=np.float32)
+                dummy_inputs[name] = (quantized, quantized)
+                dummy_inputs[f"{name}_scale"] = (scale, scale)
+
+        # A chunk after the first gets the hidden states of the previous chunk instead of the tokens.
+        if "hidden_states" in input_descs:
+            batch, sequence_length = dummy_inputs.pop("input_ids")[0].shape
+            hidden_states = np.random.randn(batch, sequence_length, self._config.hidden_size).astype(np.float32)
+            dummy_inputs["hidden_states"] = (hidden_states, hidden_states)
 
         return self._convert_dummy_inputs_to_framework(dummy_inputs, framework)
 
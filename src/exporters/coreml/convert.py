@@ -13,13 +13,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
+import inspect
+import itertools
 import json
-from typing import TYPE_CHECKING, List, Union, Mapping
+import os
+import tempfile
+from typing import TYPE_CHECKING, Dict, List, Optional, Union, Mapping
 
 import coremltools as ct
 from coremltools.converters.mil.frontend.torch.torch_op_registry import _TORCH_OPS_REGISTRY
 import coremltools as ct
-import coremltools.optimize.coreml as cto
 
 import numpy as np
 
@@ -28,7 +32,16 @@ from transformers.utils import (
     is_torch_available,
     is_tf_available,
 )
+from .compression import (
+    QUANTIZE_OPTIONS,
+    CompressionPipeline,
+    get_compression_pipeline,
+    palettize_stage,
+)
+from .chunks import ChunkedModel, get_chunk_manifest
 from .config import CoreMLConfig
+from .dedup import deduplicate_weights
+from .profiling import profile_span
 from ..utils import logging
 
 
@@ -42,33 +55,24 @@ if TYPE_CHECKING:
     from transformers.feature_extraction_utils import FeatureExtractionMixin
     from transformers.processing_utils import ProcessorMixin
     from transformers.tokenization_utils import PreTrainedTokenizer
+    from .cache import ExportCache
 
 
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
 
 
-from coremltools.optimize.coreml import (
-    OpThresholdPrunerConfig,
-    OpMagnitudePrunerConfig,
-    OptimizationConfig,
-    prune_weights,
-)
-
 # OpThresholdPrunerConfig: Sets all weight values below a certain value.
 def prune_weights_threshold(mlmodel, min_sparsity_percentile=0.75, threshold=0.05, weight_threshold=1024):
-
-  logger.info(f"Threshold  Pruning...{min_sparsity_percentile}, {threshold}, {weight_threshold}")
-
-  op_config = OpThresholdPrunerConfig(
-    threshold=threshold,
-    minimum_sparsity_percentile=min_sparsity_percentile,
-    weight_threshold=weight_threshold,
-  )
-  config = OptimizationConfig(global_config=op_config)
-  model_compressed = prune_weights(mlmodel, config=config)
-  logger.info("Done")
-
-  return model_compressed
+    logger.info(f"Threshold  Pruning...{min_sparsity_percentile}, {threshold}, {weight_threshold}")
+    stage = {
+        "config_type": "OpThresholdPrunerConfig",
+        "global_config": {
+            "threshold": threshold,
+            "minimum_sparsity_percentile": min_sparsity_percentile,
+            "weight_threshold": weight_threshold,
+        },
+    }
+    return CompressionPipeline([stage]).apply(mlmodel)[0]
 
 # OpMagnitudePrunerConfig: Prune the weights with a constant sparsity percentile.
 """OpThresholdPrunerConfig works by setting all weight values below a certain value, as specified by threshold, to zero. In the resulting weight tensor, sparse representation is used only if the proportion of values that are zero is greater than a level, as specified by minimum_sparsity_percentile. Otherwise dense format will be used.
@@ -80,53 +84,78 @@ Unless the weights in your Core ML model are known to have a lot of zeros, using
 """
 
 def prune_weights_magnitude(mlmodel, target_sparsity=0.25, weight_threshold=1024):
+    logger.info(f"Magnitude Pruning...{target_sparsity}, {weight_threshold}")
+    stage = {
+        "config_type": "OpMagnitudePrunerConfig",
+        "global_config": {"target_sparsity": target_sparsity, "weight_threshold": weight_threshold},
+    }
+    return CompressionPipeline([stage]).apply(mlmodel)[0]
+
+def quantize_weights(mlmodel, config_file):
+    logger.info(f"Quantizing... {config_file}")
+    return CompressionPipeline.from_file(config_file).apply(mlmodel)[0]
 
-  logger.info(f"Magnitude Pruning...{target_sparsity}, {weight_threshold}")
+def palettize_weights(mlmodel, nbits, nbits_linear):
+    logger.info(f"Palettizing... {nbits}")
+    return CompressionPipeline([palettize_stage(nbits, nbits_linear)]).apply(mlmodel)[0]
 
-  op_config = OpMagnitudePrunerConfig(
-    target_sparsity=target_sparsity,
-    weight_threshold=weight_threshold,
-  )
-  config = OptimizationConfig(global_config=op_config)
-  model_compressed = prune_weights(mlmodel, config=config)
-  logger.info("Done")
 
-  return model_compressed
+def get_compute_precision(quantize: str) -> str:
+    """The compute precision that the model is converted with for the given quantization option."""
+    return get_compression_pipeline(quantize).compute_precision
 
-def quantize_weights(mlmodel, config_file):
-  logger.info(f"Quantizing... {config_file}")
-  config = cto.OptimizationConfig.from_yaml(config_file)
-  compressed_mlmodel = cto.linear_quantize_weights(mlmodel, config)
-  logger.info("Done")
-  return compressed_mlmodel
 
-def palettize_weights(mlmodel, nbits, nbits_linear):
+def compress_weights(mlmodel, config, quantize, num_workers: Optional[int] = None):
+    """
+    Compress the weights of a converted model according to the quantization option, which is either
+    one of `QUANTIZE_OPTIONS` or the path to a compression pipeline file. With `num_workers`, palettization
+    is done in that many processes.
+    """
+    pipeline = get_compression_pipeline(quantize)
+
+    if config.use_legacy_format:
+        nbits = {"float32": 32, "float16": 16, "int8": 8, "int4": 4}.get(quantize)
+        if nbits is None:
+            raise ValueError(f"Quantization option '{quantize}' is not supported for the legacy format")
+        if nbits < 32:
+            from coremltools.models.neural_network import quantization_utils
+            mlmodel = quantization_utils.quantize_weights(mlmodel, nbits=nbits)
+    else:
+        mlmodel, _ = pipeline.apply(mlmodel, num_workers=num_workers)
 
-  logger.info(f"Palettizing... {nbits}")
-  mlmodel = ct.models.MLModel(mlmodel._spec, weights_dir=mlmodel.weights_dir, compute_units=ct.ComputeUnit.CPU_ONLY)
+    mlmodel.user_defined_metadata["co.huggingface.exporters.precision"] = pipeline.name
+    if len(pipeline.stages) > 0:
+        mlmodel.user_defined_metadata["co.huggingface.exporters.compression"] = json.dumps(pipeline.to_dict())
+    return mlmodel
 
-  global_config = ct.optimize.coreml.OpPalettizerConfig(
-    mode="kmeans",
-    nbits=nbits,
-  )
 
-  linear_config = ct.optimize.coreml.OpPalettizerConfig(
-    mode="kmeans",
-    nbits=nbits_linear,
-  )
+def compress_variants(mlmodel, config, variants: List[str], num_workers: Optional[int] = None):
+    """
+    Compress the weights of one converted model for every variant that uses its compute precision.
 
-  config = ct.optimize.coreml.OptimizationConfig(
-    global_config=global_config,
-    op_type_configs={
-      "gather": None # avoid quantizing the embedding table
-    },
-    op_name_configs={"linear": linear_config},
-  )
+    A variant without compression stages is the converted model itself, so these variants are done last, when the
+    other variants no longer need the converted model, and all but the very last get their own copy of it.
+    Otherwise, setting their metadata and deduplicating their weights would also change the other variants.
 
-  model = ct.optimize.coreml.palettize_weights(mlmodel, config=config)
-  logger.info("Done")
+    Returns a dictionary of variant name to model.
+    """
+    variants = sorted(variants, key=lambda variant: len(get_compression_pipeline(variant).stages) == 0)
+    mlmodels = {}
+    for i, variant in enumerate(variants):
+        source = mlmodel
+        if i < len(variants) - 1 and len(get_compression_pipeline(variant).stages) == 0:
+            source = ct.models.MLModel(
+                copy.deepcopy(mlmodel._spec), weights_dir=mlmodel.weights_dir, skip_model_load=True
+            )
+        with profile_span("compress_weights", quantize=variant):
+            mlmodels[variant] = compress_weights(source, config, variant, num_workers=num_workers)
+        if not config.use_legacy_format:
+            # Tied weights, such as the embeddings and the language modeling head, are converted
+            # to separate constants. This shares their data in the weight file.
+            with profile_span("deduplicate_weights", quantize=variant):
+                deduplicate_weights(mlmodels[variant])
+    return mlmodels
 
-  return model
 
 def get_output_names(spec):
     """Return a list of all output names in the Core ML model."""
@@ -165,31 +194,61 @@ def is_image_std_same(preprocessor: "FeatureExtractionMixin") -> bool:
     return preprocessor.image_std[0] == preprocessor.image_std[1] == preprocessor.image_std[2]
 
 
-def get_shape(config, input_desc, dummy_input, axis=-1):
+def make_shape(config, default_shape, flexible_axes=None, batch_axis=0):
     """
-    Returns the ct.Shape object for the given input.
+    Returns the ct.Shape or ct.EnumeratedShapes object for an input of the given default shape.
+
+    `flexible_axes` maps an axis to a range `(min, max)` or to a list of sizes, and the `batch_size` of the
+    config is added on `batch_axis`. Lists on several axes are enumerated in every combination. Core ML
+    cannot mix ranges and enumerated sizes in one input.
     """
-    default_shape = dummy_input[0].shape
+    default_shape = list(default_shape)
+    flexible_axes = {axis % len(default_shape): sizes for axis, sizes in (flexible_axes or {}).items()}
+    if config.batch_size is not None and batch_axis is not None:
+        flexible_axes[batch_axis] = config.batch_size
+
+    ranges = {axis: sizes for axis, sizes in flexible_axes.items() if isinstance(sizes, tuple)}
+    enumerated = {axis: sizes for axis, sizes in flexible_axes.items() if isinstance(sizes, list)}
+    if ranges and enumerated:
+        raise ValueError("an input cannot have both a range of sizes and enumerated sizes")
+
+    if enumerated:
+        # The dummy input has one of the enumerated shapes, which becomes the default.
+        shapes = []
+        for sizes in itertools.product(*enumerated.values()):
+            shape = list(default_shape)
+            for axis, size in zip(enumerated.keys(), sizes):
+                shape[axis] = size
+            shapes.append(shape)
+        return ct.EnumeratedShapes(shapes=shapes, default=default_shape)
+
     shape = list(default_shape)
+    for axis, (min_size, max_size) in ranges.items():
+        shape[axis] = ct.RangeDim(min_size, max_size)
+    return ct.Shape(shape, default=None if ranges else default_shape)
+
+
+def get_shape(config, input_desc, dummy_input, axis=-1):
+    """
+    Returns the ct.Shape object for the given input, or a ct.EnumeratedShapes object when the input
+    has a list of sequence lengths or batch sizes.
+    """
+    flexible_axes = {}
 
     # Does the input shape need to be flexible?
-    if config.use_past:
-        #shape[0] = ct.RangeDim()  # batch size  #TODO
-        shape[axis] = ct.RangeDim()
-        default_shape = None
-    elif isinstance(input_desc.sequence_length, tuple):
-        min_length, max_length = input_desc.sequence_length
-        #shape[0] = ct.RangeDim()  # batch size  #TODO
-        shape[axis] = ct.RangeDim(min_length, max_length)
-        default_shape = None
+    if config.use_past and config.kv_cache == "dynamic":
+        flexible_axes[axis] = (1, -1)
+    elif isinstance(input_desc.sequence_length, (tuple, list)):
+        flexible_axes[axis] = input_desc.sequence_length
 
-    return ct.Shape(shape, default=default_shape)
+    return make_shape(config, dummy_input[0].shape, flexible_axes)
 
 
 def get_input_types(
     preprocessor: Union["PreTrainedTokenizer", "FeatureExtractionMixin", "ProcessorMixin"],
     config: CoreMLConfig,
     dummy_inputs: Mapping[str, np.ndarray],
+    compute_precision: str = "float32",
 ) -> List[Union[ct.ImageType, ct.TensorType]]:
     """
     Create the ct.InputType objects that describe the inputs to the Core ML model.
@@ -201,6 +260,8 @@ def get_input_types(
             The Core ML configuration associated with the exported model.
         dummy_inputs (`Mapping[str, np.ndarray]`):
             The dummy input tensors that describe the expected shapes of the inputs.
+        compute_precision (`str`, *optional*, defaults to `"float32"`):
+            The compute precision of the conversion, which the key / value cache inputs follow by default.
 
     Returns:
         `List[Union[ct.ImageType, ct.TensorType]]`: ordered list of input types
@@ -216,12 +277,24 @@ def get_input_types(
             input_ids_name = "input_ids"
             attention_mask_name = "attention_mask"
 
-        input_desc = input_descs[input_ids_name]
-        dummy_input = dummy_inputs[input_ids_name]
-        shape = get_shape(config, input_desc, dummy_input)
-        input_types.append(
-            ct.TensorType(name=input_desc.name, shape=shape, dtype=np.int32)
-        )
+        if "hidden_states" in input_descs:
+            # A chunk after the first gets the hidden states of the previous chunk instead of the tokens.
+            input_desc = input_descs["hidden_states"]
+            shape = get_shape(config, input_desc, dummy_inputs["hidden_states"], axis=1)
+            input_types.append(
+                ct.TensorType(name=input_desc.name, shape=shape, dtype=np.float32)
+            )
+            input_desc = input_descs.get(attention_mask_name)
+            dummy_input = dummy_inputs.get(attention_mask_name)
+            if input_desc is not None:
+                shape = get_shape(config, input_desc, dummy_input)
+        else:
+            input_desc = input_descs[input_ids_name]
+            dummy_input = dummy_inputs[input_ids_name]
+            shape = get_shape(config, input_desc, dummy_input)
+            input_types.append(
+                ct.TensorType(name=input_desc.name, shape=shape, dtype=np.int32)
+            )
 
         if attention_mask_name in input_descs:
             input_desc = input_descs[attention_mask_name]
@@ -241,12 +314,11 @@ def get_input_types(
 
         if "encoder_outputs" in input_descs:
             input_desc = input_descs["encoder_outputs"]
-            shape = list(dummy_inputs["encoder_outputs"][0].shape)
-            #shape[0] = ct.RangeDim()  # batch size  #TODO
             # TODO: only disable if we are using fixed shapes (which could be part of the configuration)
             # shape[1] = ct.RangeDim()
+            shape = make_shape(config, dummy_inputs["encoder_outputs"][0].shape)
             input_types.append(
-                ct.TensorType(name=input_desc.name, shape=ct.Shape(shape), dtype=np.float32)
+                ct.TensorType(name=input_desc.name, shape=shape, dtype=np.float32)
             )
 
         if config.seq2seq == "decoder" and "attention_mask" in input_descs:
@@ -269,31 +341,34 @@ def get_input_types(
                 ct.TensorType(name=input_desc.name, shape=shape, dtype=np.int32)
             )
 
-        if config.use_past:
-            # TODO: Temporarily disabled until we can solve the issue with encoder past key/values
-            # name = "decoder_past_key_values" if config.seq2seq == "decoder" else "past_key_values"
-            name = "past_key_values"
-            shape = list(dummy_inputs[f"{name}_0_key"][1].shape)
-            #shape[0] = ct.RangeDim()  # batch size  #TODO
-            shape[2] = ct.RangeDim(0, -1)
-            shape = ct.Shape(shape)
-
-            for i in range(config.num_layers):
-                input_types.append(ct.TensorType(name=f"{name}_{i}_key", shape=shape))
-                input_types.append(ct.TensorType(name=f"{name}_{i}_value", shape=shape))
-
-            # TODO: Temporarily disabled until we can solve the issue with encoder past key/values
-            # if config.seq2seq == "decoder":
-            #     name = "encoder_past_key_values"
-            #     shape = list(dummy_inputs[f"{name}_0_key"][1].shape)
-            #     #shape[0] = ct.RangeDim()  # batch size  #TODO
-            #     shape[2] = ct.RangeDim(0, -1)
-            #     shape = ct.Shape(shape)
+        if "position" in input_descs:
+            input_desc = input_descs["position"]
+            input_types.append(
+                ct.TensorType(name=input_desc.name, shape=(1,), dtype=np.int32)
+            )
 
-            #     for i in range(config.num_encoder_layers):
-            #         input_types.append(ct.TensorType(name=f"{name}_{i}_key", shape=shape))
-            #         input_types.append(ct.TensorType(name=f"{name}_{i}_value", shape=shape))
+        if config.use_past and config.kv_cache != "stateful":
+            name = "past_key_values"
+            dtype, scale_dtype = config.get_kv_cache_io_dtypes(compute_precision)
+            # The stacked cache has the layers first.
+            batch_axis, sequence_axis = (2, 4) if config.stack_kv_cache else (0, 2)
+            for key, input_desc in input_descs.items():
+                if not key.startswith(name):
+                    continue
+                flexible_axes = {sequence_axis: (0, -1)} if config.kv_cache == "dynamic" else None
+                shape = make_shape(config, dummy_inputs[key][1].shape, flexible_axes, batch_axis=batch_axis)
+                input_types.append(ct.TensorType(
+                    name=input_desc.name,
+                    shape=shape,
+                    dtype=scale_dtype if key.endswith("_scale") else dtype,
+                ))
 
+            # The cross-attention keys and values have the length of the encoder's sequence.
+            for key, input_desc in input_descs.items():
+                if not key.startswith("encoder_past_key_values"):
+                    continue
+                shape = make_shape(config, dummy_inputs[key][1].shape, {2: (1, -1)})
+                input_types.append(ct.TensorType(name=input_desc.name, shape=shape, dtype=dtype))
 
     elif config.modality == "vision":
         if hasattr(preprocessor, "image_mean"):
@@ -356,12 +431,20 @@ def get_input_types(
         if "attention_mask" in input_descs:
             input_desc = input_descs["attention_mask"]
             attn_shape = list(dummy_inputs["attention_mask"][0].shape)
-            if isinstance(shape.shape[1], ct.RangeDim):
-                #attn_shape[0] = shape.shape[0]  # batch size  #TODO
-                attn_shape[-1] = shape.shape[1]
+            if isinstance(shape, ct.EnumeratedShapes):
+                attn_shape = ct.EnumeratedShapes(
+                    shapes=[[enumerated.shape[0], enumerated.shape[1]] for enumerated in shape.shapes],
+                    default=attn_shape,
+                )
+            else:
+                # Share the flexible dimensions with the audio input.
+                attn_shape[0] = shape.shape[0]
+                if isinstance(shape.shape[1], ct.RangeDim):
+                    attn_shape[-1] = shape.shape[1]
+                attn_shape = ct.Shape(attn_shape)
 
             input_types.append(
-                ct.TensorType(name=input_desc.name, shape=ct.Shape(attn_shape), dtype=np.int32)
+                ct.TensorType(name=input_desc.name, shape=attn_shape, dtype=np.int32)
             )
         else:
             logger.info("Skipping attention_mask input")
@@ -372,6 +455,35 @@ def get_input_types(
 if is_torch_available():
     import torch
 
+    def get_cross_attention_cache(model, encoder_hidden_states):
+        """
+        Compute the keys and values of the cross-attention of every decoder layer of an encoder-decoder model,
+        which only depend on the encoder's hidden states.
+
+        This runs the decoder on a single dummy token and takes the cross-attention keys and values from its cache.
+        When traced, only their projections of the encoder's hidden states are used, and Core ML removes the rest
+        of the decoder as dead code.
+
+        Args:
+            model (`PreTrainedModel`):
+                The encoder-decoder model.
+            encoder_hidden_states (`torch.Tensor`):
+                The encoder's last hidden state, of shape `(batch_size, sequence_length, hidden_size)`.
+
+        Returns:
+            `List[Tuple[torch.Tensor, torch.Tensor]]`: the keys and values of every decoder layer, of shape
+            `(batch_size, num_heads, sequence_length, head_dim)`.
+        """
+        batch_size = encoder_hidden_states.shape[0]
+        input_ids = torch.zeros((batch_size, 1), dtype=torch.long, device=encoder_hidden_states.device)
+        outputs = model.get_decoder()(
+            input_ids=input_ids,
+            encoder_hidden_states=encoder_hidden_states,
+            use_cache=True,
+            return_dict=False,
+        )
+        return [(layer_past[2], layer_past[3]) for layer_past in outputs[1]]
+
     class Wrapper(torch.nn.Module):
         def __init__(self, preprocessor, model, config):
             super().__init__()
@@ -379,7 +491,172 @@ if is_torch_available():
             self.model = model.eval()
             self.config = config
 
+            # With a stateful key / value cache, the caches are buffers that the traced
+            # model updates in place, which Core ML turns into the model's state.
+            for name, shape in config.states.items():
+                self.register_buffer(name, torch.zeros(shape, dtype=model.dtype))
+
+            if config.chunk is not None and not all(
+                hasattr(model.base_model, name) for name in ["embed_tokens", "layers", "norm"]
+            ):
+                raise ValueError(
+                    f"cannot split {type(model).__name__} into chunks, which needs a base model with"
+                    " `embed_tokens`, `layers`, and `norm` modules"
+                )
+
+        def reset_kv_cache(self):
+            """Empty the stateful key / value cache, to start a new sequence."""
+            for name in self.config.states:
+                getattr(self, name).zero_()
+
+        def _run_model(self, inputs, **model_kwargs):
+            """
+            Run the model on `inputs`. With `num_chunks`, only the layers of the config's chunk are run: the
+            chunks after the first take the hidden states of the previous chunk instead of the tokens, and the
+            chunks before the last return their hidden states instead of the logits.
+            """
+            if self.config.chunk is None:
+                return self.model(inputs, **model_kwargs)
+
+            start, end = self.config.layer_range
+            base_model = self.model.base_model
+            layers, norm = base_model.layers, base_model.norm
+            layer_indices = [getattr(layer.self_attn, "layer_idx", None) for layer in layers]
+            if start > 0:
+                model_kwargs["inputs_embeds"], inputs = inputs, None
+
+            try:
+                # The model numbers the layers it runs from zero, and so does the past of the chunk.
+                base_model.layers = torch.nn.ModuleList(layers[start:end])
+                for i, layer in enumerate(base_model.layers):
+                    if layer_indices[start + i] is not None:
+                        layer.self_attn.layer_idx = i
+
+                if end < self.config.num_layers:
+                    base_model.norm = torch.nn.Identity()
+                    return base_model(inputs, **model_kwargs)
+                return self.model(inputs, **model_kwargs)
+            finally:
+                base_model.layers, base_model.norm = layers, norm
+                for layer, layer_idx in zip(layers, layer_indices):
+                    if layer_idx is not None:
+                        layer.self_attn.layer_idx = layer_idx
+
+        def _forward_with_kv_cache(self, input_ids, position, key_caches, value_caches):
+            """
+            Run the model on `input_ids` that start at `position`, using key / value caches of a fixed size
+            `max_context_length`. The caches hold the keys and values of the tokens before `position`, and
+            the slots from `position` onwards are unused.
+
+            Returns the logits, and the caches with the new keys and values written at their positions. With
+            `new_kv_only`, returns the new keys and values instead of the caches.
+            """
+            sequence_length = input_ids.shape[1]
+            slots = torch.arange(self.config.max_context_length)
+            positions = position + torch.arange(sequence_length)
+
+            # The model appends the new keys and values to the cache it is given, so the mask has an
+            # entry for every slot followed by the new tokens.
+            attention_mask = torch.cat([
+                (slots < position).to(torch.long),
+                torch.ones(sequence_length, dtype=torch.long),
+            ]).unsqueeze(0)
+
+            model_kwargs = {
+                "return_dict": False,
+                "use_cache": True,
+                "attention_mask": attention_mask,
+                "past_key_values": tuple(zip(key_caches, value_caches)),
+            }
+            if "position_ids" in inspect.signature(self.model.forward).parameters:
+                model_kwargs["position_ids"] = positions.unsqueeze(0)
+
+            outputs = self._run_model(input_ids, **model_kwargs)
+
+            # Write the new keys and values into their slots. A scatter, rather than slicing with the
+            # position, keeps the traced graph independent of the position's value.
+            index = positions.reshape(1, 1, -1, 1)
+            updated_keys, updated_values = [], []
+            for (key, value), past_key, past_value in zip(outputs[-1], key_caches, value_caches):
+                key, value = key[:, :, -sequence_length:], value[:, :, -sequence_length:]
+                if self.config.new_kv_only:
+                    updated_keys.append(key)
+                    updated_values.append(value)
+                    continue
+                updated_keys.append(past_key.scatter(2, index.expand_as(key), key))
+                updated_values.append(past_value.scatter(2, index.expand_as(value), value))
+
+            logits = outputs[0]
+            if "logits" in self.config.outputs and self.config.outputs["logits"].do_softmax:
+                logits = torch.nn.functional.softmax(logits, dim=-1)
+            return logits, updated_keys, updated_values
+
+        def _unpack_past(self, past_inputs):
+            """
+            The keys and values of every layer from the cache inputs, which are in the order of the config's
+            inputs: stacked or per layer, and with the scales of an int8 cache after the quantized values.
+            """
+            quantized = self.config.kv_cache_dtype == "int8"
+            if self.config.stack_kv_cache:
+                past = past_inputs[0]
+                if quantized:
+                    past = past.to(self.model.dtype) * past_inputs[1]
+                num_layers = self.config.num_layers
+                return [past[0, i] for i in range(num_layers)], [past[1, i] for i in range(num_layers)]
+
+            keys, values = [], []
+            step = 4 if quantized else 2
+            for i in range(0, len(past_inputs), step):
+                key, value = past_inputs[i], past_inputs[i + 1]
+                if quantized:
+                    key = key.to(self.model.dtype) * past_inputs[i + 2]
+                    value = value.to(self.model.dtype) * past_inputs[i + 3]
+                keys.append(key)
+                values.append(value)
+            return keys, values
+
+        def _quantize(self, x):
+            """Quantize every vector along the last axis to int8, with its own scale."""
+            scale = x.abs().amax(dim=-1, keepdim=True) / 127
+            safe_scale = torch.where(scale > 0, scale, torch.ones_like(scale))
+            return torch.round(x / safe_scale).to(torch.int8), scale
+
+        def _flatten_presents(self, keys, values):
+            """The output keys and values of all layers, in the order of the config's outputs."""
+            quantized = self.config.kv_cache_dtype == "int8"
+            if self.config.stack_kv_cache:
+                present = torch.stack([torch.stack(keys), torch.stack(values)])
+                return self._quantize(present) if quantized else (present,)
+
+            presents = ()
+            for key, value in zip(keys, values):
+                if quantized:
+                    (key, key_scale), (value, value_scale) = self._quantize(key), self._quantize(value)
+                    presents = presents + (key, value, key_scale, value_scale)
+                else:
+                    presents = presents + (key, value)
+            return presents
+
         def forward(self, *all_inputs):
+            if self.config.use_past and self.config.kv_cache == "stateful":
+                input_ids, position = all_inputs[:2]
+                key_caches = [getattr(self, f"key_cache_{i}") for i in range(self.config.num_layers)]
+                value_caches = [getattr(self, f"value_cache_{i}") for i in range(self.config.num_layers)]
+                logits, updated_keys, updated_values = self._forward_with_kv_cache(
+                    input_ids, position, key_caches, value_caches
+                )
+                for cache, updated in zip(key_caches + value_caches, updated_keys + updated_values):
+                    cache[:] = updated
+                return logits
+
+            if self.config.use_past and self.config.kv_cache == "static":
+                input_ids, position = all_inputs[:2]
+                key_caches, value_caches = self._unpack_past(all_inputs[2:])
+                logits, updated_keys, updated_values = self._forward_with_kv_cache(
+                    input_ids, position, key_caches, value_caches
+                )
+                return (logits,) + self._flatten_presents(updated_keys, updated_values)
+
             remaining = len(all_inputs)
             inputs = all_inputs[0]
 
@@ -401,40 +678,43 @@ if is_torch_available():
             # Convert the past_key_values_x_key and _value inputs back into tuples,
             # as that is what the original model expects.
             # Assumes past_key_values are always the last inputs to the Wrapper.
-            # An encoder-decoder model first gets all the decoder past_key_values
-            # tensors, followed by the encoder ones, but they get combined into the
-            # same 4-tuples.
+            # With `cross_attention_cache`, a seq2seq decoder first gets all the
+            # decoder past_key_values tensors, followed by the cross-attention ones
+            # from the encoder, but they get combined into the same 4-tuples.
             if self.config.use_past:
-                # TODO: Temporarily disabled until we can solve the issue with encoder past key/values
-                if False and self.config.seq2seq == "decoder":
-                    num_decoder_layers = self.config.num_layers
-                    num_encoder_layers = self.config.num_encoder_layers
-                    remaining -= (num_decoder_layers + num_encoder_layers) * 2
+                if self.config.seq2seq == "decoder" and self.config.cross_attention_cache:
+                    num_layers = self.config.num_layers
+                    remaining -= num_layers * 4
                     past_key_values = []
-                    for i in range(min(num_decoder_layers, num_encoder_layers)):
+                    for i in range(num_layers):
                         past_key_values.append((
                             all_inputs[remaining + i*2],
                             all_inputs[remaining + i*2 + 1],
-                            all_inputs[remaining + num_decoder_layers*2 + i*2],
-                            all_inputs[remaining + num_decoder_layers*2 + i*2 + 1],
+                            all_inputs[remaining + num_layers*2 + i*2],
+                            all_inputs[remaining + num_layers*2 + i*2 + 1],
                         ))
                     model_kwargs["past_key_values"] = past_key_values
                 else:
-                    remaining -= self.config.num_layers * 2
-                    past_key_values = []
-                    for i in range(self.config.num_layers):
-                        past_key_values.append((
-                            all_inputs[remaining + i*2],
-                            all_inputs[remaining + i*2 + 1],
-                        ))
-                    model_kwargs["past_key_values"] = past_key_values
+                    remaining -= sum(name.startswith("past_key_values") for name in self.config.inputs)
+                    keys, values = self._unpack_past(all_inputs[remaining:])
+                    model_kwargs["past_key_values"] = list(zip(keys, values))
 
             if self.config.seq2seq == "decoder":
-                model_kwargs["decoder_input_ids"] = all_inputs[0]
-                model_kwargs["decoder_attention_mask"] = all_inputs[1]
-                model_kwargs["encoder_outputs"] = (all_inputs[2],)
-                if remaining >= 4:
-                    model_kwargs["attention_mask"] = all_inputs[3]
+                decoder_inputs = dict(zip(self.config.inputs.keys(), all_inputs[:remaining]))
+                model_kwargs["decoder_input_ids"] = decoder_inputs["decoder_input_ids"]
+                model_kwargs["decoder_attention_mask"] = decoder_inputs.get("decoder_attention_mask")
+                if "encoder_outputs" in decoder_inputs:
+                    model_kwargs["encoder_outputs"] = (decoder_inputs["encoder_outputs"],)
+                else:
+                    # The cross-attention uses the keys and values from the encoder, but the model only
+                    # takes them from the cache when it gets encoder hidden states, which are not used.
+                    cross_key = model_kwargs["past_key_values"][0][2]
+                    hidden_states = cross_key.new_zeros(
+                        (cross_key.shape[0], cross_key.shape[2], self.model.config.hidden_size)
+                    )
+                    model_kwargs["encoder_outputs"] = (hidden_states,)
+                if "attention_mask" in decoder_inputs:
+                    model_kwargs["attention_mask"] = decoder_inputs["attention_mask"]
             elif self.config.modality == "text":
                 if remaining >= 2:
                     model_kwargs["attention_mask"] = all_inputs[1]
@@ -451,10 +731,13 @@ if is_torch_available():
             # Run the model with the provided inputs.
             if self.config.seq2seq == "encoder":
                 outputs = self.model.get_encoder()(inputs, **model_kwargs)
+                if self.config.cross_attention_cache:
+                    cross_attention_cache = get_cross_attention_cache(self.model, outputs[0])
+                    return (outputs[0],) + tuple(tensor for layer in cross_attention_cache for tensor in layer)
             elif self.config.seq2seq == "decoder":
                 outputs = self.model(**model_kwargs)
             else:
-                outputs = self.model(inputs, **model_kwargs)
+                outputs = self._run_model(inputs, **model_kwargs)
 
             # Unpack the output `past_key_values` into a single tuple.
             presents = ()
@@ -465,20 +748,17 @@ if is_torch_available():
                 past_key_values_index = -2 if self.config.seq2seq == "decoder" else -1
                 past_key_values = outputs[past_key_values_index]
 
-                # TODO: Temporarily disabled until we can solve the issue with encoder past key/values
-                if False and self.config.seq2seq == "decoder":
-                    decoder_presents = ()
-                    encoder_presents = ()
-                    for i in range(len(past_key_values)):
-                        for j in range(2):
-                            decoder_presents = decoder_presents + (past_key_values[i][j],)
-                            encoder_presents = encoder_presents + (past_key_values[i][j + 2],)
-
-                    presents = decoder_presents + encoder_presents
-                else:
-                    for i in range(len(past_key_values)):
-                        for j in range(2):
-                            presents = presents + (past_key_values[i][j],)
+                keys, values = [], []
+                for layer_past in past_key_values:
+                    # The cross-attention keys and values of a seq2seq decoder come after these,
+                    # and do not change.
+                    key, value = layer_past[0], layer_past[1]
+                    if self.config.new_kv_only:
+                        # The new keys and values are appended at the end of the past ones.
+                        key, value = key[:, :, -inputs.shape[1]:], value[:, :, -inputs.shape[1]:]
+                    keys.append(key)
+                    values.append(value)
+                presents = self._flatten_presents(keys, values)
 
             output_descs = self.config.outputs
 
@@ -505,7 +785,8 @@ if is_torch_available():
                 "speech-seq2seq",
                 "token-classification",
             ]:
-                output_desc = output_descs["logits"]
+                # A chunk before the last outputs its hidden states instead of the logits.
+                output_desc = output_descs["logits" if "logits" in output_descs else "hidden_states"]
                 if output_desc.do_softmax:
                     prediction = torch.nn.functional.softmax(outputs[0], dim=-1)
                 else:
@@ -550,12 +831,53 @@ if is_torch_available():
             raise AssertionError(f"Cannot compute outputs for unknown task '{self.config.task}'")
 
 
+def get_output_types(config: CoreMLConfig, num_outputs: int, compute_precision: str = "float32") -> List[ct.TensorType]:
+    """
+    Create the ct.TensorType objects that name the outputs of the Core ML model. The key / value cache outputs
+    get the same data type as the cache inputs, and so do the cross-attention keys and values of an encoder
+    with `cross_attention_cache`.
+    """
+    dtype, scale_dtype = config.get_kv_cache_io_dtypes(compute_precision)
+    output_types = []
+    for key, output_desc in list(config.outputs.items())[:num_outputs]:
+        output_dtype = None
+        if config.use_past and key.startswith("present"):
+            output_dtype = scale_dtype if key.endswith("_scale") else dtype
+        elif config.cross_attention_cache and key.startswith("encoder_present"):
+            output_dtype = dtype
+        # Leave the default float32 alone, which does not need a newer deployment target.
+        if output_dtype == np.float32:
+            output_dtype = None
+        output_types.append(ct.TensorType(name=output_desc.name, dtype=output_dtype))
+    return output_types
+
+
+def get_minimum_deployment_target(config: CoreMLConfig, compute_precision: str) -> Optional[ct.target]:
+    """The oldest OS that supports the model's inputs, outputs and state, or `None` for the default."""
+    if config.states or config.function is not None:
+        # Core ML only supports state and multifunction models from iOS 18 on.
+        return ct.target.iOS18
+
+    if config.use_past or config.cross_attention_cache:
+        dtype, scale_dtype = config.get_kv_cache_io_dtypes(compute_precision)
+        if dtype == np.int8:
+            return ct.target.iOS18
+        if dtype == np.float16 or scale_dtype == np.float16:
+            return ct.target.iOS16
+
+    return None
+
+
 def export_pytorch(
     preprocessor: Union["PreTrainedTokenizer", "FeatureExtractionMixin", "ProcessorMixin"],
     model: "PreTrainedModel",
     config: CoreMLConfig,
-    quantize: str = "float32",
+    quantize: Union[str, List[str]] = "float32",
     compute_units: ct.ComputeUnit = ct.ComputeUnit.ALL,
+    cache: Optional["ExportCache"] = None,
+    skip_model_load: bool = False,
+    print_artifacts: bool = False,
+    compression_workers: Optional[int] = None,
 ) -> ct.models.MLModel:
     """
     Export a PyTorch model to Core ML format.
@@ -567,17 +889,58 @@ def export_pytorch(
             The model to export.
         config ([`~coreml.config.CoreMLConfig`]):
             The Core ML configuration associated with the exported model.
-        quantize (`str`, *optional*, defaults to `"float32"`):
-            Quantization options. Possible values: `"float32"`, `"float16"`.
+        quantize (`str` or `List[str]`, *optional*, defaults to `"float32"`):
+            Quantization options. Possible values: `"float32"`, `"float16"`, `"int8"` (linear quantization),
+            `"int4"` (4-bit palettization), `"mixed-6-4"` (6-bit palettization with 4-bit linear layers).
+            When a list is given, every variant is produced from a single trace and a single conversion
+            per compute precision, and a dictionary of variant name to model is returned.
         compute_units (`ct.ComputeUnit`, *optional*, defaults to `ct.ComputeUnit.ALL`):
             Whether to optimize the model for CPU, GPU, and/or Neural Engine.
+        cache ([`~coreml.cache.ExportCache`], *optional*):
+            If provided, the TorchScript trace is loaded from this cache when possible, and stored
+            in it otherwise.
+        skip_model_load (`bool`, *optional*, defaults to `False`):
+            Do not compile and load the exported model. The model can still be saved, but not used
+            for predictions. Intermediate models are never loaded, regardless of this option.
+        print_artifacts (`bool`, *optional*, defaults to `False`):
+            Print the dummy inputs, the PyTorch model, its outputs, and the Core ML spec. These can be
+            very large for big models.
+        compression_workers (`int`, *optional*):
+            Number of processes for the k-means clustering of palettized variants. By default, this is done
+            serially by coremltools.
 
     Returns:
-        `ct.models.MLModel`: the Core ML model object
+        `ct.models.MLModel`: the Core ML model object, or `Dict[str, ct.models.MLModel]` if `quantize` is a list
     """
     if not issubclass(type(model), PreTrainedModel):
         raise ValueError(f"Cannot convert unknown model type: {type(model)}")
 
+    if config.chunk_layers:
+        return export_chunks(
+            preprocessor,
+            model,
+            config,
+            quantize,
+            compute_units,
+            cache=cache,
+            skip_model_load=skip_model_load,
+            print_artifacts=print_artifacts,
+            compression_workers=compression_workers,
+        )
+
+    if config.functions:
+        return export_multifunction(
+            preprocessor,
+            model,
+            config,
+            quantize,
+            compute_units,
+            cache=cache,
+            skip_model_load=skip_model_load,
+            print_artifacts=print_artifacts,
+            compression_workers=compression_workers,
+        )
+
     logger.info(f"Using framework PyTorch: {torch.__version__}")
 
     # Check if we need to override certain configuration items
@@ -588,50 +951,92 @@ def export_pytorch(
             setattr(model.config, override_config_key, override_config_value)
 
     # Create dummy input data for doing the JIT trace.
-    dummy_inputs = config.generate_dummy_inputs(preprocessor, framework=TensorType.PYTORCH)
+    with profile_span("generate_dummy_inputs"):
+        dummy_inputs = config.generate_dummy_inputs(preprocessor, framework=TensorType.PYTORCH)
+
+    # A model loaded in half precision (see `--low_memory`) is traced with floating point
+    # inputs of the same dtype, so the weights never need to be upcast to float32.
+    if model.dtype != torch.float32:
+        logger.info(f"Tracing the model in {model.dtype}")
+        for name, (ref_value, coreml_value) in dummy_inputs.items():
+            if isinstance(ref_value, torch.Tensor) and ref_value.is_floating_point():
+                dummy_inputs[name] = (ref_value.to(model.dtype), coreml_value)
 
-    print(f"dummy inputs =  {dummy_inputs}")
     # Put the inputs in the order from the config.
     example_input = [dummy_inputs[key][0] for key in list(config.inputs.keys())]
 
-    print(model)
+    if print_artifacts:
+        print(f"dummy inputs =  {dummy_inputs}")
+        print(model)
+        print(f"example inputs =  {example_input}")
+
+    # The trace does not depend on the quantization or compression options, so a
+    # re-export with different options can start directly at the conversion step.
+    cached_trace = None
+    if cache is not None:
+        with profile_span("trace_cache_lookup"):
+            trace_key = cache.get_trace_key(model, config, dummy_inputs, preprocessor)
+            cached_trace = cache.lookup_trace(trace_key)
+
+    if cached_trace is not None:
+        logger.info("Using TorchScript trace from the export cache")
+        traced_model, example_output = cached_trace
+    else:
+        wrapper = Wrapper(preprocessor, model, config).eval()
 
-    print(f"example inputs =  {example_input}")
-    wrapper = Wrapper(preprocessor, model, config).eval()
+        # Running the model once with gradients disabled prevents an error during JIT tracing
+        # that happens with certain models such as LeViT. The error message is: "Cannot insert
+        # a Tensor that requires grad as a constant."
+        with profile_span("eager_forward"), torch.no_grad():
+            dummy_output = wrapper(*example_input)
 
-    # Running the model once with gradients disabled prevents an error during JIT tracing
-    # that happens with certain models such as LeViT. The error message is: "Cannot insert
-    # a Tensor that requires grad as a constant."
-    with torch.no_grad():
-        dummy_output = wrapper(*example_input)
+        if print_artifacts:
+            print(f"dummy output =  {dummy_output}")
 
-    print(f"dummy output =  {dummy_output}")
-    traced_model = torch.jit.trace(wrapper, example_input, strict=True)
+        with profile_span("trace"):
+            traced_model = torch.jit.trace(wrapper, example_input, strict=True)
 
-    # Run the traced PyTorch model to get the shapes of the output tensors.
-    with torch.no_grad():
-        example_output = traced_model(*example_input)
+        # Run the traced PyTorch model to get the shapes of the output tensors.
+        with profile_span("traced_forward"), torch.no_grad():
+            example_output = traced_model(*example_input)
 
-    print(f"example output =  {example_output}")
-    if isinstance(example_output, (tuple, list)):
-        example_output = [x.numpy() for x in example_output]
-    else:
-        example_output = [example_output.numpy()]
+        if print_artifacts:
+            print(f"example output =  {example_output}")
+        if isinstance(example_output, (tuple, list)):
+            example_output = [x.numpy() for x in example_output]
+        else:
+            example_output = [example_output.numpy()]
+
+        if cache is not None:
+            with profile_span("trace_cache_store"):
+                cache.store_trace(trace_key, traced_model, example_output)
 
     convert_kwargs = {}
-    if not config.use_legacy_format:
-        convert_kwargs["compute_precision"] = ct.precision.FLOAT16 if quantize == "float16" else ct.precision.FLOAT32
 
     # For classification models, add the labels into the Core ML model and
     # designate it as the special "classifier" model type.
     if config.is_classifier:
         convert_kwargs['classifier_config'] = ct.ClassifierConfig(config.get_class_labels())
-
-    input_tensors = get_input_types(preprocessor, config, dummy_inputs)
+    # All variants that use the same compute precision share a single conversion,
+    # and only fork when the weights get compressed.
+    variants = [quantize] if isinstance(quantize, str) else list(quantize)
+
+    if config.use_legacy_format and config.kv_cache_dtype not in (None, "float32"):
+        raise ValueError(f"the neuralnetwork format does not support a {config.kv_cache_dtype} key / value cache")
+
+    if config.states:
+        # Core ML keeps the state in float16 and only supports it from iOS 18 on.
+        if any(get_compute_precision(variant) != "float16" for variant in variants):
+            raise ValueError(f"the '{config.kv_cache}' key / value cache requires float16 compute precision")
+        convert_kwargs["states"] = [
+            ct.StateType(wrapped_type=ct.TensorType(shape=shape, dtype=np.float16), name=name)
+            for name, shape in config.states.items()
+        ]
 
     patched_ops = config.patch_pytorch_ops()
 
-    print(f"patched {patched_ops}")
+    if print_artifacts:
+        print(f"patched {patched_ops}")
     restore_ops = {}
     if patched_ops is not None:
         for name, func in patched_ops.items():
@@ -641,25 +1046,199 @@ def export_pytorch(
                 del _TORCH_OPS_REGISTRY[name]
             _TORCH_OPS_REGISTRY[name] = func
 
-    #print(f"{traced_model}")
-    print(f"input_tensors {input_tensors}")
-    print(f"convert kwargs {convert_kwargs}")
-
-    mlmodel = ct.convert(
-        traced_model,
-        inputs=input_tensors,
-        convert_to="neuralnetwork" if config.use_legacy_format else "mlprogram",
-        compute_units=compute_units,
-        **convert_kwargs,
-    )
-
-    #print(f"{restore_ops}")
-    if restore_ops is not None:
-        for name, func in restore_ops.items():
-            if func is not None:
-                logger.info(f"Restoring PyTorch conversion op '{name}' to {func}")
-                _TORCH_OPS_REGISTRY[name] = func
+    mlmodels = {}
+
+    try:
+        for precision in sorted(set(get_compute_precision(variant) for variant in variants)):
+            # The neuralnetwork format only has float32 inputs and outputs.
+            io_precision = "float32" if config.use_legacy_format else precision
+            input_tensors = get_input_types(preprocessor, config, dummy_inputs, compute_precision=io_precision)
+            if not config.is_classifier:
+                # Name the outputs during conversion, so they don't need to be renamed afterwards.
+                convert_kwargs["outputs"] = get_output_types(config, len(example_output), io_precision)
+
+            convert_kwargs.pop("minimum_deployment_target", None)
+            if not config.use_legacy_format:
+                convert_kwargs["compute_precision"] = ct.precision.FLOAT16 if precision == "float16" else ct.precision.FLOAT32
+                target = get_minimum_deployment_target(config, precision)
+                if target is not None:
+                    convert_kwargs["minimum_deployment_target"] = target
+
+            #print(f"{traced_model}")
+            if print_artifacts:
+                print(f"input_tensors {input_tensors}")
+                print(f"convert kwargs {convert_kwargs}")
+
+            # This covers the PyTorch frontend, the MIL optimization passes, and the backend.
+            with profile_span("ct.convert", compute_precision=precision):
+                mlmodel = ct.convert(
+                    traced_model,
+                    inputs=input_tensors,
+                    convert_to="neuralnetwork" if config.use_legacy_format else "mlprogram",
+                    compute_units=compute_units,
+                    # The converted model is only used as input for the compression step, so
+                    # it is not worth compiling it. This is slow and costly for large models.
+                    skip_model_load=True,
+                    **convert_kwargs,
+                )
+            _set_model_metadata(mlmodel, model, config)
+
+            if print_artifacts:
+                print(f"{mlmodel._spec}")
+
+            precision_variants = [variant for variant in variants if get_compute_precision(variant) == precision]
+            mlmodels.update(compress_variants(mlmodel, config, precision_variants, num_workers=compression_workers))
+    finally:
+        #print(f"{restore_ops}")
+        if restore_ops is not None:
+            for name, func in restore_ops.items():
+                if func is not None:
+                    logger.info(f"Restoring PyTorch conversion op '{name}' to {func}")
+                    _TORCH_OPS_REGISTRY[name] = func
+
+    if not skip_model_load:
+        for variant, mlmodel in mlmodels.items():
+            if mlmodel.__proxy__ is None:
+                with profile_span("load_model", quantize=variant):
+                    mlmodels[variant] = ct.models.MLModel(
+                        mlmodel._spec, weights_dir=mlmodel.weights_dir, compute_units=compute_units
+                    )
+
+    if isinstance(quantize, str):
+        return mlmodels[quantize]
+    return {variant: mlmodels[variant] for variant in variants}
+
+
+def export_multifunction(
+    preprocessor: Union["PreTrainedTokenizer", "FeatureExtractionMixin", "ProcessorMixin"],
+    model: "PreTrainedModel",
+    config: CoreMLConfig,
+    quantize: Union[str, List[str]] = "float32",
+    compute_units: ct.ComputeUnit = ct.ComputeUnit.ALL,
+    skip_model_load: bool = False,
+    **kwargs,
+) -> ct.models.MLModel:
+    """
+    Export a PyTorch model to a multifunction Core ML model, such as one with the `"prefill"` and `"decode"`
+    functions of a config with a `prefill_length`.
+
+    Every function is traced and converted separately with its own input shapes, and the functions are then
+    saved in a single ML Program package, which stores the weights they have in common only once. The last
+    function is the default one.
+
+    Args:
+        preprocessor ([`PreTrainedTokenizer`], [`FeatureExtractionMixin`] or [`ProcessorMixin`]):
+            The preprocessor used for encoding the data.
+        model ([`PreTrainedModel`]):
+            The model to export.
+        config ([`~coreml.config.CoreMLConfig`]):
+            The Core ML configuration, which has more than one function.
+        quantize (`str` or `List[str]`, *optional*, defaults to `"float32"`):
+            Quantization options, see [`export_pytorch`].
+        compute_units (`ct.ComputeUnit`, *optional*, defaults to `ct.ComputeUnit.ALL`):
+            Whether to optimize the model for CPU, GPU, and/or Neural Engine.
+        skip_model_load (`bool`, *optional*, defaults to `False`):
+            Do not compile and load the exported model.
+        kwargs:
+            Other options for [`export_pytorch`], such as `cache`.
+
+    Returns:
+        `ct.models.MLModel`: the Core ML model object, or `Dict[str, ct.models.MLModel]` if `quantize` is a list
+    """
+    if config.use_legacy_format:
+        raise ValueError("multifunction models require the mlprogram format")
+
+    variants = [quantize] if isinstance(quantize, str) else list(quantize)
+    descriptors = {variant: ct.utils.MultiFunctionDescriptor() for variant in variants}
+    mlmodels = {}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for function in config.functions:
+            with profile_span("export_function", function=function):
+                function_mlmodels = export_pytorch(
+                    preprocessor,
+                    model,
+                    config.get_function_config(function),
+                    variants,
+                    compute_units,
+                    skip_model_load=True,
+                    **kwargs,
+                )
+
+            for i, variant in enumerate(variants):
+                path = os.path.join(tmp_dir, f"{function}-{i}.mlpackage")
+                function_mlmodels[variant].save(path)
+                descriptors[variant].add_function(path, src_function_name="main", target_function_name=function)
+            del function_mlmodels
+
+        for variant, descriptor in descriptors.items():
+            descriptor.default_function_name = config.functions[-1]
+
+            # The package outlives the temporary directory, and is deleted with the model object.
+            path = tempfile.mkdtemp(suffix=".mlpackage")
+            with profile_span("save_multifunction", quantize=variant):
+                ct.utils.save_multifunction(descriptor, path)
+            mlmodels[variant] = ct.models.MLModel(
+                path, compute_units=compute_units, skip_model_load=skip_model_load, is_temp_package=True
+            )
+
+    if isinstance(quantize, str):
+        return mlmodels[quantize]
+    return mlmodels
+
 
+def export_chunks(
+    preprocessor: Union["PreTrainedTokenizer", "FeatureExtractionMixin", "ProcessorMixin"],
+    model: "PreTrainedModel",
+    config: CoreMLConfig,
+    quantize: Union[str, List[str]] = "float32",
+    compute_units: ct.ComputeUnit = ct.ComputeUnit.ALL,
+    **kwargs,
+) -> ChunkedModel:
+    """
+    Export a decoder split into the chunks of a config with `num_chunks`, each with a contiguous range of
+    layers. Every chunk is traced and converted separately, so it can be loaded and compiled on its own.
+
+    Args:
+        preprocessor ([`PreTrainedTokenizer`], [`FeatureExtractionMixin`] or [`ProcessorMixin`]):
+            The preprocessor used for encoding the data.
+        model ([`PreTrainedModel`]):
+            The model to export.
+        config ([`~coreml.config.CoreMLConfig`]):
+            The Core ML configuration, which has a `num_chunks`.
+        quantize (`str` or `List[str]`, *optional*, defaults to `"float32"`):
+            Quantization options, see [`export_pytorch`].
+        compute_units (`ct.ComputeUnit`, *optional*, defaults to `ct.ComputeUnit.ALL`):
+            Whether to optimize the model for CPU, GPU, and/or Neural Engine.
+        kwargs:
+            Other options for [`export_pytorch`], such as `cache`.
+
+    Returns:
+        [`~coreml.chunks.ChunkedModel`]: the chunks, which are run and saved like a single model, or
+        `Dict[str, ChunkedModel]` if `quantize` is a list
+    """
+    variants = [quantize] if isinstance(quantize, str) else list(quantize)
+    chunk_models = {variant: [] for variant in variants}
+
+    for chunk, (start, end) in enumerate(config.chunk_layers):
+        logger.info(f"Converting chunk {chunk} with layers {start} to {end - 1}")
+        with profile_span("export_chunk", chunk=chunk):
+            mlmodels = export_pytorch(preprocessor, model, config.get_chunk_config(chunk), variants, compute_units, **kwargs)
+        for variant in variants:
+            chunk_models[variant].append(mlmodels[variant])
+        del mlmodels
+
+    manifest = get_chunk_manifest(config)
+    if isinstance(quantize, str):
+        return ChunkedModel(chunk_models[quantize], manifest)
+    return {variant: ChunkedModel(models, manifest) for variant, models in chunk_models.items()}
+
+
+def _set_model_metadata(mlmodel, model, config):
+    """
+    Fill in the input and output descriptions, and the model's metadata. This only edits the model's
+    spec in place, so the model does not need to be reloaded afterwards.
+    """
     spec = mlmodel._spec
 
     #[print(f"{spec}")
@@ -677,7 +1256,6 @@ def export_pytorch(
         "co.huggingface.exporters.task": config.task,
         "co.huggingface.exporters.architecture": next(iter(model.config.architectures), ""),
         "co.huggingface.exporters.framework": "pytorch",
-        "co.huggingface.exporters.precision": quantize,
     }
     if model.config.transformers_version:
         user_defined_metadata["transformers_version"] = model.config.transformers_version
@@ -693,10 +1271,10 @@ def export_pytorch(
         spec.description.predictedFeatureName = output_desc.name
         mlmodel.output_description[output_desc.name] = output_desc.description
     else:
-        for i, (key, output_desc) in enumerate(output_descs.items()):
-            if i < len(example_output):
-                output = spec.description.output[i]
-                ct.utils.rename_feature(spec, output.name, output_desc.name, rename_inputs=False)
+        # The outputs were already given their names by ct.convert().
+        output_names = get_output_names(spec)
+        for output_desc in output_descs.values():
+            if output_desc.name in output_names:
                 mlmodel.output_description[output_desc.name] = output_desc.description
 
         if config.task in ["object-detection", "semantic-segmentation", "token-classification"]:
@@ -717,31 +1295,18 @@ def export_pytorch(
     #print(f"mlmodel.output_description =  {mlmodel.output_description}")
     #print(f"mlmodel._spec =  {mlmodel._spec}")
     #print(f"mlmodel.wei =  {mlmodel.weights_dir}")
-    print(f"{spec}")
-    # Reload the model in case any input / output names were changed.
-    mlmodel = ct.models.MLModel(mlmodel._spec, weights_dir=mlmodel.weights_dir)
-
-    #if config.use_legacy_format and quantize == "float16":
-    #    mlmodel = ct.models.neural_network.quantization_utils.quantize_weights(mlmodel, nbits=16)
-    #if config.use_legacy_format and quantize == "int8":
-
-    #mlmodel = quantize_weights(mlmodel, "/home/kamil/convert/linear_config.yaml")
-    mlmodel = palettize_weights(mlmodel, 6, 4)
-    #mlmodel = prune_weights_magnitude(mlmodel)
-    print(mlmodel)
-    #mlmodel = ct.models.neural_network.quantization_utils.quantize_weights(mlmodel, nbits=8)
-    #if config.use_legacy_format and quantize == "int4":
-    #mlmodel = ct.models.neural_network.quantization_utils.quantize_weights(mlmodel, nbits=4)
-
-    return mlmodel
 
 
 def export(
     preprocessor: Union["PreTrainedTokenizer", "FeatureExtractionMixin", "ProcessorMixin"],
     model: Union["PreTrainedModel", "TFPreTrainedModel"],
     config: CoreMLConfig,
-    quantize: str = "float32",
+    quantize: Union[str, List[str]] = "float32",
     compute_units: ct.ComputeUnit = ct.ComputeUnit.ALL,
+    cache: Optional["ExportCache"] = None,
+    skip_model_load: bool = False,
+    print_artifacts: bool = False,
+    compression_workers: Optional[int] = None,
 ) -> ct.models.MLModel:
     """
     Export a Pytorch or TensorFlow model to Core ML format.
@@ -753,13 +1318,24 @@ def export(
             The model to export.
         config ([`~coreml.config.CoreMLConfig`]):
             The Core ML configuration associated with the exported model.
-        quantize (`str`, *optional*, defaults to `"float32"`):
-            Quantization options. Possible values: `"float32"`, `"float16"`.
+        quantize (`str` or `List[str]`, *optional*, defaults to `"float32"`):
+            Quantization options. Possible values: `"float32"`, `"float16"`, `"int8"` (linear quantization),
+            `"int4"` (4-bit palettization), `"mixed-6-4"` (6-bit palettization with 4-bit linear layers).
+            When a list is given, every variant is produced from a single trace and a single conversion
+            per compute precision, and a dictionary of variant name to model is returned.
         compute_units (`ct.ComputeUnit`, *optional*, defaults to `ct.ComputeUnit.ALL`):
             Whether to optimize the model for CPU, GPU, and/or Neural Engine.
+        cache ([`~coreml.cache.ExportCache`], *optional*):
+            Cache for intermediate artifacts such as the TorchScript trace.
+        skip_model_load (`bool`, *optional*, defaults to `False`):
+            Do not compile and load the exported model, for example when it is only going to be saved.
+        print_artifacts (`bool`, *optional*, defaults to `False`):
+            Print intermediate artifacts such as the PyTorch model and the Core ML spec, for debugging.
+        compression_workers (`int`, *optional*):
+            Number of processes for the k-means clustering of palettized variants.
 
     Returns:
-        `ct.models.MLModel`: the Core ML model object
+        `ct.models.MLModel`: the Core ML model object, or `Dict[str, ct.models.MLModel]` if `quantize` is a list
     """
     if not (is_torch_available() or is_tf_available()):
         raise ImportError(
@@ -768,6 +1344,16 @@ def export(
         )
 
     if is_torch_available() and issubclass(type(model), PreTrainedModel):
-        return export_pytorch(preprocessor, model, config, quantize, compute_units)
+        return export_pytorch(
+            preprocessor,
+            model,
+            config,
+            quantize,
+            compute_units,
+            cache=cache,
+            skip_model_load=skip_model_load,
+            print_artifacts=print_artifacts,
+            compression_workers=compression_workers,
+        )
     else:
         raise ValueError(f"Cannot convert unknown model type: {type(model)}")
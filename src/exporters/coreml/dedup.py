@@ -0,0 +1,148 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Sharing identical weight blobs in the weight file of an ML Program."""
+
+import hashlib
+import os
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Tuple
+
+import numpy as np
+
+from ..utils import logging
+
+
+if TYPE_CHECKING:
+    import coremltools as ct
+
+
+logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
+
+
+# The weight file starts with a 64-byte header, and every blob with 64 bytes of metadata. Blobs are 64-byte aligned.
+_HEADER_SIZE = 64
+_METADATA_SIZE = 64
+_ALIGNMENT = 64
+_SENTINEL = 0xDEADBEEF
+
+
+def _iter_blob_values(block) -> Iterator[Any]:
+    """All the values in a MIL block, including nested blocks, that are stored in a weight file."""
+    for op in block.operations:
+        for value in op.attributes.values():
+            if value.HasField("blobFileValue"):
+                yield value
+        for nested_block in op.blocks:
+            yield from _iter_blob_values(nested_block)
+
+
+def get_blob_values(mlmodel: "ct.models.MLModel") -> List[Any]:
+    """The protobuf values of all the constants of an ML Program that are stored in its weight files."""
+    spec = mlmodel._spec
+    if not spec.HasField("mlProgram"):
+        return []
+
+    values = []
+    for function in spec.mlProgram.functions.values():
+        for block in function.block_specializations.values():
+            values.extend(_iter_blob_values(block))
+    return values
+
+
+def _read_metadata(data: np.ndarray, offset: int) -> Tuple[int, int]:
+    """The size in bytes and the data offset of the blob whose metadata is at `offset`."""
+    sentinel = int(data[offset:offset + 4].view(np.uint32)[0])
+    if sentinel != _SENTINEL:
+        raise ValueError(f"Invalid weight blob at offset {offset}")
+    size, data_offset = (int(x) for x in data[offset + 8:offset + 24].view(np.uint64))
+    return size, data_offset
+
+
+def deduplicate_weights(mlmodel: "ct.models.MLModel") -> Dict[str, int]:
+    """
+    Store identical constants only once in the weight file of an ML Program, such as an embedding matrix that
+    is tied to the language modeling head, or weights that repeat across layers.
+
+    Every blob in the weight file is hashed by content. The constants that point to a duplicate are made to point
+    to the first copy, and the weight file is rewritten with the blobs that are still referenced. The model's
+    spec and weights are edited in place.
+
+    Args:
+        mlmodel (`ct.models.MLModel`):
+            The model, which must be an ML Program with its weights on disk.
+
+    Returns:
+        `Dict[str, int]`: the number of blobs and unique blobs, and the size of the weight files before and after.
+    """
+    report = {"num_blobs": 0, "num_unique_blobs": 0, "bytes_before": 0, "bytes_after": 0}
+    if getattr(mlmodel, "weights_dir", None) is None:
+        return report
+
+    values_by_file = {}
+    for value in get_blob_values(mlmodel):
+        path = os.path.join(mlmodel.weights_dir, os.path.basename(value.blobFileValue.fileName))
+        values_by_file.setdefault(path, []).append(value)
+
+    for path, values in values_by_file.items():
+        data = np.memmap(path, dtype=np.uint8, mode="r")
+        report["num_blobs"] += len(set(value.blobFileValue.offset for value in values))
+        report["bytes_before"] += data.size
+
+        # The first blob with a given content is kept, in the order of the weight file.
+        canonical = {}
+        first_by_content = {}
+        for offset in sorted(set(value.blobFileValue.offset for value in values)):
+            size, data_offset = _read_metadata(data, offset)
+            digest = hashlib.blake2b(data[data_offset:data_offset + size], digest_size=32).digest()
+            # The data type and the padding of sub-byte types are part of the content.
+            key = (bytes(data[offset + 4:offset + 8]), bytes(data[offset + 24:offset + 32]), size, digest)
+            canonical[offset] = first_by_content.setdefault(key, offset)
+
+        kept = sorted(set(canonical.values()))
+        report["num_unique_blobs"] += len(kept)
+        if len(kept) == len(canonical):
+            report["bytes_after"] += data.size
+            continue
+
+        new_offsets = {}
+        tmp_path = path + ".dedup"
+        with open(tmp_path, "wb") as f:
+            header = np.array(data[:_HEADER_SIZE])
+            header[:4].view(np.uint32)[0] = len(kept)
+            f.write(header.tobytes())
+
+            for offset in kept:
+                size, data_offset = _read_metadata(data, offset)
+                new_offset = f.tell()
+                metadata = np.array(data[offset:offset + _METADATA_SIZE])
+                metadata[16:24].view(np.uint64)[0] = new_offset + _METADATA_SIZE
+                f.write(metadata.tobytes())
+                f.write(data[data_offset:data_offset + size])
+                f.write(b"\0" * (-f.tell() % _ALIGNMENT))
+                new_offsets[offset] = new_offset
+
+        del data
+        os.replace(tmp_path, path)
+
+        for value in values:
+            value.blobFileValue.offset = new_offsets[canonical[value.blobFileValue.offset]]
+        report["bytes_after"] += os.path.getsize(path)
+
+    saved = report["bytes_before"] - report["bytes_after"]
+    if report["num_unique_blobs"] < report["num_blobs"]:
+        logger.info(
+            f"Shared {report['num_blobs'] - report['num_unique_blobs']} duplicate weight blobs, "
+            f"saving {saved / 1024**2:.1f} MB"
+        )
+    return report
@@ -22,6 +22,7 @@ from ..utils import logging
 
 
 if TYPE_CHECKING:
+    import torch
     from transformers import PreTrainedModel, TFPreTrainedModel
 
 
@@ -467,7 +468,12 @@ class FeaturesManager:
 
     @staticmethod
     def get_model_from_feature(
-        feature: str, model: str, framework: str = "pt", cache_dir: str = None
+        feature: str,
+        model: str,
+        framework: str = "pt",
+        cache_dir: str = None,
+        low_memory: bool = False,
+        torch_dtype: Optional["torch.dtype"] = None,
     ) -> Union["PreTrainedModel", "TFPreTrainedModel"]:
         """
         Attempts to retrieve a model from a model's name and the feature to be enabled.
@@ -479,17 +485,29 @@ class FeaturesManager:
                 The name of the model to export.
             framework (`str`, *optional*, defaults to `"pt"`):
                 The framework to use for the export.
+            low_memory (`bool`, *optional*, defaults to `False`):
+                Load the PyTorch weights directly into the model instead of first allocating randomly
+                initialized weights. Weights stored as safetensors are memory-mapped, so the checkpoint is
+                never held in memory next to the model.
+            torch_dtype (`torch.dtype`, *optional*):
+                Load the PyTorch weights in this dtype, for example `torch.float16`, instead of float32.
 
         Returns:
             The instance of the model.
 
         """
         model_class = FeaturesManager.get_model_class_for_feature(feature, framework)
+        load_kwargs = {}
+        if framework == "pt":
+            if low_memory:
+                load_kwargs["low_cpu_mem_usage"] = True
+            if torch_dtype is not None:
+                load_kwargs["torch_dtype"] = torch_dtype
         try:
-            model = model_class.from_pretrained(model, cache_dir=cache_dir, torchscript=True)
+            model = model_class.from_pretrained(model, cache_dir=cache_dir, torchscript=True, **load_kwargs)
         except OSError:
             if framework == "pt":
-                model = model_class.from_pretrained(model, from_tf=True, cache_dir=cache_dir)
+                model = model_class.from_pretrained(model, from_tf=True, cache_dir=cache_dir, **load_kwargs)
             else:
                 model = model_class.from_pretrained(model, from_pt=True, cache_dir=cache_dir, torchscript=True)
         return model
@@ -0,0 +1,178 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Host-side key / value cache for Core ML models exported with `use_past`."""
+
+from typing import TYPE_CHECKING, Any, Dict, Mapping, Optional, Tuple
+
+import numpy as np
+
+
+if TYPE_CHECKING:
+    from .config import CoreMLConfig
+
+
+class KeyValueCacheManager:
+    """
+    Keeps the key / value cache of a text-generation model exported with `use_past` in buffers that are allocated
+    once, and makes the inputs of every prediction from them.
+
+    With `new_kv_only=True` in the [`CoreMLConfig`], the model only outputs the keys and values of the new tokens,
+    which are appended to the buffers, so the size of the outputs does not grow with the context. Models that
+    output the whole cache are supported too, the new keys and values are then copied out of it.
+
+    With `kv_cache_dtype="int8"`, the buffers hold the int8 keys and values, and `scales` holds their scales.
+
+    Args:
+        config ([`CoreMLConfig`]):
+            The Core ML configuration the model was exported with.
+        max_context_length (`int`, *optional*):
+            Number of tokens the buffers can hold. A `kv_cache="static"` model always uses its own
+            `max_context_length`. Defaults to `config.max_context_length`.
+        dtype (`np.dtype`, *optional*, defaults to `np.float32`):
+            Data type of the buffers, which should be that of the model's cache inputs. For an int8 cache, this
+            is the data type of the scales.
+        batch_size (`int`, *optional*, defaults to 1):
+            Number of sequences that are generated together, for a model exported with a flexible `batch_size`.
+
+    Example:
+
+    ```python
+    cache = KeyValueCacheManager(coreml_config)
+    for token in tokens:
+        outputs = mlmodel.predict(cache.get_inputs([[token]]))
+        cache.update(outputs)
+    ```
+    """
+
+    def __init__(
+        self,
+        config: "CoreMLConfig",
+        max_context_length: Optional[int] = None,
+        dtype: Any = np.float32,
+        batch_size: int = 1,
+    ):
+        if not config.use_past or config.kv_cache == "stateful" or config.seq2seq is not None:
+            raise ValueError(
+                "KeyValueCacheManager needs a decoder-only model with the key / value cache as inputs and outputs"
+            )
+
+        self.config = config
+        if config.kv_cache == "static" or max_context_length is None:
+            max_context_length = config.max_context_length
+        self.max_context_length = max_context_length
+
+        self.batch_size = batch_size
+
+        # The keys and values of all layers are in one buffer, which is the input of a model with
+        # `stack_kv_cache=True`, and of which `keys` and `values` are views.
+        _, num_heads, _, head_dim = config.kv_cache_shape
+        shape = (2, config.num_layers, batch_size, num_heads, max_context_length, head_dim)
+        self.quantized = config.kv_cache_dtype == "int8"
+        self.cache = np.zeros(shape, dtype=np.int8 if self.quantized else dtype)
+        self.keys, self.values = self.cache[0], self.cache[1]
+
+        # Every key and value vector has its own scale.
+        self.scales = None
+        if self.quantized:
+            self.scales = np.zeros(shape[:-1] + (1,), dtype=dtype)
+
+        self.length = 0
+        self._num_new_tokens = None
+
+    def reset(self):
+        """Empty the cache, to start a new sequence."""
+        self.length = 0
+        self._num_new_tokens = None
+
+    def get_inputs(self, input_ids: Any) -> Dict[str, np.ndarray]:
+        """
+        Make the inputs of the next prediction.
+
+        Args:
+            input_ids (`np.ndarray`):
+                The new tokens, of shape `(batch_size, sequence_length)`.
+
+        Returns:
+            `Dict[str, np.ndarray]`: the model's inputs, by their names in the Core ML model.
+        """
+        input_ids = np.asarray(input_ids, dtype=np.int32)
+        if input_ids.shape[0] != self.batch_size:
+            raise ValueError(f"expected a batch of {self.batch_size} sequences, got {input_ids.shape[0]}")
+        num_new_tokens = input_ids.shape[-1]
+        if self.length + num_new_tokens > self.max_context_length:
+            raise ValueError(
+                f"{self.length + num_new_tokens} tokens do not fit in a cache of {self.max_context_length} tokens"
+            )
+
+        input_descs = self.config.inputs
+        inputs = {input_descs["input_ids"].name: input_ids}
+
+        # A static cache always has all its slots, and the model masks the ones at or after the position.
+        if self.config.kv_cache == "static":
+            inputs[input_descs["position"].name] = np.array([self.length], dtype=np.int32)
+            past_length = self.max_context_length
+        else:
+            if "attention_mask" in input_descs:
+                attention_mask = np.ones((self.batch_size, self.length + num_new_tokens), dtype=np.int32)
+                inputs[input_descs["attention_mask"].name] = attention_mask
+            past_length = self.length
+
+        for name, (buffer, index) in self._get_buffers("past_key_values").items():
+            inputs[input_descs[name].name] = buffer[index][..., :past_length, :]
+
+        self._num_new_tokens = num_new_tokens
+        return inputs
+
+    def update(self, outputs: Mapping[str, np.ndarray]):
+        """
+        Append the keys and values of the new tokens to the cache.
+
+        Args:
+            outputs (`Mapping[str, np.ndarray]`):
+                The outputs of the prediction made with the last `get_inputs`, by their names in the Core ML model.
+        """
+        if self._num_new_tokens is None:
+            raise ValueError("update must follow a prediction with the inputs from get_inputs")
+
+        start, end = self.length, self.length + self._num_new_tokens
+        output_descs = self.config.outputs
+
+        # A whole cache has the new keys and values at the same slots as the buffers.
+        for name, (buffer, index) in self._get_buffers("present").items():
+            present = outputs[output_descs[name].name]
+            if not self.config.new_kv_only:
+                present = present[..., start:end, :]
+            buffer[index][..., start:end, :] = present
+
+        self.length = end
+        self._num_new_tokens = None
+
+    def _get_buffers(self, prefix: str) -> Dict[str, Tuple[np.ndarray, Any]]:
+        """The buffer and the index into it of every cache input (`"past_key_values"`) or output (`"present"`)."""
+        buffers = {}
+        if self.config.stack_kv_cache:
+            name = "past_key_values" if prefix == "past_key_values" else "present_key_values"
+            buffers[name] = (self.cache, Ellipsis)
+            if self.quantized:
+                buffers[f"{name}_scale"] = (self.scales, Ellipsis)
+            return buffers
+
+        for i in range(self.config.num_layers):
+            for j, kind in enumerate(["key", "value"]):
+                buffers[f"{prefix}_{i}_{kind}"] = (self.cache, (j, i))
+            if self.quantized:
+                for j, kind in enumerate(["key", "value"]):
+                    buffers[f"{prefix}_{i}_{kind}_scale"] = (self.scales, (j, i))
+        return buffers
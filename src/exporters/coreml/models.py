@@ -14,6 +14,7 @@
 # limitations under the License.
 
 from collections import OrderedDict
+from typing import TYPE_CHECKING
 
 from .config import (
     CoreMLConfig,
@@ -22,6 +23,10 @@ from .config import (
 )
 
 
+if TYPE_CHECKING:
+    from transformers.configuration_utils import PretrainedConfig
+
+
 def patch_common_pytorch_ops():
     """
     Workarounds for issues that haven't been fixed yet in coremltools that
@@ -201,6 +206,12 @@ class ErnieCoreMLConfig(CoreMLConfig):
 class FalconCoreMLConfig(CoreMLConfig):
     modality = "text"
 
+    @property
+    def num_key_value_heads(self) -> int:
+        if self._config.new_decoder_architecture:
+            return self._config.num_kv_heads
+        return 1 if self._config.multi_query else self.num_attention_heads
+
     def patch_pytorch_ops(self):
         # Copied from https://github.com/apple/coremltools/blob/b2f719075dc5bc19280a3045c1762d7d32bd3fdc/coremltools/converters/mil/frontend/torch/ops.py#L4326
         # with fallback of `bfloat16` to `float32`.
@@ -309,6 +320,13 @@ class GPT2CoreMLConfig(CoreMLConfig):
 class GPTBigcodeCoreMLConfig(CoreMLConfig):
     modality = "text"
 
+    def __init__(self, config: "PretrainedConfig", task: str, use_past: bool = False, **kwargs):
+        # GPTBigCode keeps the keys and values of a layer in one tensor, concatenated on the last axis, which
+        # does not have the shape of the past_key_values inputs and outputs.
+        if use_past:
+            raise ValueError("`use_past=True` is not supported for GPTBigCode, which has a fused key / value cache")
+        super().__init__(config, task, use_past=use_past, **kwargs)
+
 
 class GPTJCoreMLConfig(CoreMLConfig):
     modality = "text"
@@ -0,0 +1,572 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Parallel and histogram-based k-means palettization.
+
+`coremltools.optimize.coreml.palettize_weights` clusters the weight tensors one after the other. Here, the
+lookup tables are computed up front by a pool of worker processes, which read the weights straight from
+the memory-mapped weight file of the model. The results are then handed to coremltools through a `custom`
+palettizer config, so that coremltools still writes the lookup table and index constants into the MIL
+program. The clustering itself is coremltools' own, so the output is identical to the serial path. This calls
+a private coremltools function, so with other versions of coremltools than those in
+`KMEANS_COREMLTOOLS_VERSIONS`, the `kmeans` mode falls back to coremltools' serial clustering.
+
+The `histogram` palettization mode is an exporter-side alternative to coremltools' `kmeans` mode. It finds the
+optimal 1-D k-means clustering of the histogram of the distinct weight values rather than iterating over every
+element, so its cost depends on the number of distinct values, at most 65536 for float16 weights, instead of the
+number of weights.
+"""
+
+import copy
+import hashlib
+import multiprocessing
+import os
+import pickle
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from ..utils import logging
+
+
+if TYPE_CHECKING:
+    import coremltools as ct
+
+
+logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
+
+
+# Data types in the Core ML weight file, see coremltools' MIL blob storage.
+_BLOB_DTYPES = {1: np.float16, 2: np.float32}
+_BLOB_SENTINEL = 0xDEADBEEF
+
+
+@dataclass
+class WeightBlob:
+    """A constant stored in the weight file of an ML Program."""
+    name: str
+    path: str
+    offset: int
+    dtype: Any
+    shape: Tuple[int, ...]
+    child_op_types: List[str]
+
+    @property
+    def size(self) -> int:
+        return int(np.prod(self.shape))
+
+
+def _read_blob_metadata(weight_file, offset: int) -> Tuple[Any, int, int]:
+    """Return the dtype, size in bytes, and data offset of the blob whose metadata is at `offset`."""
+    metadata = np.fromfile(weight_file, dtype=np.uint32, count=2, offset=offset)
+    sizes = np.fromfile(weight_file, dtype=np.uint64, count=2, offset=offset + 8)
+    if metadata[0] != _BLOB_SENTINEL:
+        raise ValueError(f"Invalid weight blob at offset {offset} in {weight_file}")
+    return _BLOB_DTYPES.get(int(metadata[1])), int(sizes[0]), int(sizes[1])
+
+
+def get_weight_blobs(mlmodel: "ct.models.MLModel") -> List[WeightBlob]:
+    """Find the constants of an ML Program that are stored in its weight file, and the ops that use them."""
+    spec = mlmodel._spec
+    if not spec.HasField("mlProgram") or mlmodel.weights_dir is None:
+        return []
+
+    blobs = []
+    for function in spec.mlProgram.functions.values():
+        for block in function.block_specializations.values():
+            child_op_types = {}
+            for op in block.operations:
+                for argument in op.inputs.values():
+                    for binding in argument.arguments:
+                        if binding.HasField("name"):
+                            child_op_types.setdefault(binding.name, []).append(op.type)
+
+            for op in block.operations:
+                if op.type != "const" or "val" not in op.attributes:
+                    continue
+                value = op.attributes["val"]
+                if not value.HasField("blobFileValue"):
+                    continue
+
+                name = op.outputs[0].name
+                path = os.path.join(mlmodel.weights_dir, os.path.basename(value.blobFileValue.fileName))
+                dtype, _, data_offset = _read_blob_metadata(path, value.blobFileValue.offset)
+                if dtype is None:
+                    continue
+                shape = tuple(dim.constant.size for dim in op.outputs[0].type.tensorType.dimensions)
+                blobs.append(WeightBlob(name, path, data_offset, dtype, shape, child_op_types.get(name, [])))
+    return blobs
+
+
+def _get_op_config(op_config, blob: WeightBlob):
+    """The op config that coremltools applies to a constant: by name, then by the type of op using it, then global."""
+    if blob.name in op_config.op_name_configs:
+        return op_config.op_name_configs[blob.name]
+    op_types = set(blob.child_op_types)
+    if len(op_types) == 1 and next(iter(op_types)) in op_config.op_type_configs:
+        return op_config.op_type_configs[next(iter(op_types))]
+    return op_config.global_config
+
+
+def _weight_key(weight: np.ndarray) -> Tuple[Tuple[int, ...], str]:
+    digest = hashlib.blake2b(np.ascontiguousarray(weight).view(np.uint8), digest_size=16).hexdigest()
+    return tuple(weight.shape), digest
+
+
+# The major versions of coremltools whose private k-means function `kmeans_lut` can call, with the
+# `(nbits, weight)` signature and the flat per-tensor lookup table of coremltools 7.
+KMEANS_COREMLTOOLS_VERSIONS = (7,)
+
+
+def is_kmeans_lut_supported() -> bool:
+    """Whether `kmeans_lut` gives the same result as coremltools' `kmeans` mode, with the installed coremltools."""
+    import coremltools as ct
+
+    try:
+        major_version = int(ct.__version__.split(".")[0])
+    except ValueError:
+        return False
+    return major_version in KMEANS_COREMLTOOLS_VERSIONS
+
+
+def kmeans_lut(nbits: int, weight: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """The same clustering as coremltools' `kmeans` palettizer mode, see `is_kmeans_lut_supported`."""
+    from coremltools.optimize.coreml._quantization_passes import palettize_weights as palettize_pass
+
+    lut, indices = palettize_pass._get_kmeans_lookup_table_and_weight(nbits, weight)
+    return lut.astype(weight.dtype), indices.astype(np.uint8).reshape(-1)
+
+
+def _get_histogram(flat: np.ndarray) -> Tuple[np.ndarray, np.ndarray, Callable[[np.ndarray], np.ndarray]]:
+    """
+    The distinct values of a flat array in increasing order, how often each occurs, and a function that maps a
+    label per distinct value to a label per element.
+    """
+    if flat.dtype == np.float16:
+        # Counting the bit patterns is a single pass, with no sort of the elements.
+        codes = flat.view(np.uint16)
+        counts = np.bincount(codes, minlength=65536)
+        present = np.nonzero(counts)[0]
+        values = present.astype(np.uint16).view(np.float16).astype(np.float64)
+        order = np.argsort(values, kind="stable")
+        present, values, counts = present[order], values[order], counts[present[order]]
+
+        def expand(labels):
+            table = np.zeros(65536, dtype=labels.dtype)
+            table[present] = labels
+            return table[codes]
+    else:
+        values, inverse, counts = np.unique(flat, return_inverse=True, return_counts=True)
+        values = values.astype(np.float64)
+
+        def expand(labels):
+            return labels[inverse]
+
+    return values, counts.astype(np.float64), expand
+
+
+# The largest number of distinct values that `histogram_kmeans` clusters optimally, which covers every float16
+# weight. With more distinct values, it runs Lloyd iterations instead.
+MAX_OPTIMAL_CLUSTERING_VALUES = 65536
+
+
+def _segment_costs(cum_counts, cum_sums, cum_squares, starts, ends):
+    """The sum of squared distances to their mean of the values in `[starts, ends)`, from the cumulative sums."""
+    totals = cum_counts[ends] - cum_counts[starts]
+    sums = cum_sums[ends] - cum_sums[starts]
+    return cum_squares[ends] - cum_squares[starts] - sums * sums / totals
+
+
+def _optimal_splits(cum_counts, cum_sums, cum_squares, num_clusters: int) -> np.ndarray:
+    """
+    The split points of the clustering of the sorted values with the smallest sum of squared errors.
+
+    `cost[k][j]` is the smallest error of `k` clusters of the first `j` values, and the last of these clusters
+    starts at `best[k][j]`, which does not decrease with `j`. So every row is computed with divide and conquer:
+    the best start of the middle `j` of a range bounds those of the two halves. All the ranges at the same depth
+    are evaluated together, so a row takes `log2(num_values)` vectorized steps over about `2 * num_values`
+    candidates.
+    """
+    num_values = len(cum_counts) - 1
+    costs = np.full(num_values + 1, np.inf)
+    ends = np.arange(1, num_values + 1)
+    costs[1:] = _segment_costs(cum_counts, cum_sums, cum_squares, np.zeros_like(ends), ends)
+    best_starts = []
+
+    for k in range(2, num_clusters + 1):
+        # Every cluster has at least one value, and only the whole range is needed for the last cluster.
+        first = k if k < num_clusters else num_values
+        last = num_values - (num_clusters - k)
+        new_costs = np.full(num_values + 1, np.inf)
+        best = np.zeros(num_values + 1, dtype=np.uint16)
+
+        # The ranges of `j` to compute, and the range of candidate starts of their last cluster.
+        lo_j, hi_j = np.array([first]), np.array([last])
+        lo_start, hi_start = np.array([k - 1]), np.array([last - 1])
+        while len(lo_j) > 0:
+            mid = (lo_j + hi_j) // 2
+            hi = np.minimum(hi_start, mid - 1)
+            lengths = hi - lo_start + 1
+            offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+
+            # The candidate starts of every range, one after the other.
+            segment = np.repeat(np.arange(len(mid)), lengths)
+            starts = lo_start[segment] + np.arange(lengths.sum()) - offsets[segment]
+            ends = mid[segment]
+            candidates = costs[starts] + _segment_costs(cum_counts, cum_sums, cum_squares, starts, ends)
+
+            # The first candidate with the smallest cost in every range.
+            minima = np.minimum.reduceat(candidates, offsets)
+            positions = np.where(candidates <= minima[segment], np.arange(len(candidates)), len(candidates))
+            argmins = starts[np.minimum.reduceat(positions, offsets)]
+            new_costs[mid] = minima
+            best[mid] = argmins
+
+            left = mid - 1 >= lo_j
+            right = mid + 1 <= hi_j
+            lo_j, hi_j, lo_start, hi_start = (
+                np.concatenate([lo_j[left], mid[right] + 1]),
+                np.concatenate([mid[left] - 1, hi_j[right]]),
+                np.concatenate([lo_start[left], argmins[right]]),
+                np.concatenate([argmins[left], hi_start[right]]),
+            )
+
+        costs = new_costs
+        best_starts.append(best)
+
+    splits = [num_values]
+    for best in reversed(best_starts):
+        splits.append(int(best[splits[-1]]))
+    return np.array([0] + splits[::-1])
+
+
+def _lloyd_splits(values, cum_counts, cum_sums, num_clusters: int, max_iterations: int) -> np.ndarray:
+    """The split points of Lloyd iterations from equal-count quantiles, until they no longer move."""
+    num_values = len(values)
+
+    # Initial split points at the quantiles, made strictly increasing so that no cluster is empty.
+    targets = np.arange(1, num_clusters) * (cum_counts[-1] / num_clusters)
+    splits = np.searchsorted(cum_counts, targets, side="left")
+    offsets = np.clip(np.maximum.accumulate(splits - np.arange(1, num_clusters)), 0, num_values - num_clusters)
+    splits = np.concatenate([[0], offsets + np.arange(1, num_clusters), [num_values]])
+
+    centers = None
+    for _ in range(max_iterations):
+        totals = cum_counts[splits[1:]] - cum_counts[splits[:-1]]
+        sums = cum_sums[splits[1:]] - cum_sums[splits[:-1]]
+        new_centers = np.divide(sums, totals, out=np.zeros_like(sums), where=totals > 0)
+        if centers is not None:
+            # An empty cluster keeps its previous center.
+            new_centers = np.where(totals > 0, new_centers, centers)
+        centers = new_centers
+
+        boundaries = (centers[:-1] + centers[1:]) / 2
+        new_splits = np.concatenate([[0], np.searchsorted(values, boundaries, side="right"), [num_values]])
+        if np.array_equal(new_splits, splits):
+            break
+        splits = new_splits
+    return splits
+
+
+def histogram_kmeans(nbits: int, weight: np.ndarray, max_iterations: int = 300) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    K-means clustering of a weight tensor into `2**nbits` values, on the histogram of its distinct values.
+
+    In one dimension, every cluster of the optimal clustering is a contiguous range of the sorted values, so a
+    clustering is given by `2**nbits - 1` split points. With cumulative sums of the counts, the values and their
+    squares, the error of any range is computed in constant time, and dynamic programming finds the split
+    points with the smallest sum of squared errors, see `_optimal_splits`. Weights with more than
+    `MAX_OPTIMAL_CLUSTERING_VALUES` distinct values, which can only be float32, are clustered with Lloyd
+    iterations on the histogram instead, which reach a local optimum.
+
+    Args:
+        nbits (`int`):
+            Number of bits per index.
+        weight (`np.ndarray`):
+            The weight to cluster.
+        max_iterations (`int`, *optional*, defaults to 300):
+            Maximum number of Lloyd iterations, for weights with too many distinct values to cluster optimally.
+
+    Returns:
+        `Tuple[np.ndarray, np.ndarray]`: the lookup table, with the dtype of the weight, and the flat uint8
+        index of every element. Like coremltools' `custom` palettizer mode expects.
+    """
+    num_clusters = 2 ** nbits
+    values, counts, expand = _get_histogram(weight.reshape(-1))
+    num_values = len(values)
+
+    if num_values <= num_clusters:
+        lut = np.concatenate([values, np.full(num_clusters - num_values, values[-1])])
+        indices = expand(np.arange(num_values, dtype=np.uint8))
+        return lut.astype(weight.dtype), indices
+
+    # Centering the values keeps the squares, and the differences of their cumulative sums, accurate.
+    shift = np.sum(counts * values) / np.sum(counts)
+    centered = values - shift
+    cum_counts = np.concatenate([[0.0], np.cumsum(counts)])
+    cum_sums = np.concatenate([[0.0], np.cumsum(counts * centered)])
+
+    if num_values <= MAX_OPTIMAL_CLUSTERING_VALUES:
+        cum_squares = np.concatenate([[0.0], np.cumsum(counts * centered * centered)])
+        splits = _optimal_splits(cum_counts, cum_sums, cum_squares, num_clusters)
+    else:
+        splits = _lloyd_splits(centered, cum_counts, cum_sums, num_clusters, max_iterations)
+
+    totals = cum_counts[splits[1:]] - cum_counts[splits[:-1]]
+    sums = cum_sums[splits[1:]] - cum_sums[splits[:-1]]
+    centers = np.divide(sums, totals, out=np.zeros_like(sums), where=totals > 0) + shift
+    labels = (np.searchsorted(splits[1:-1], np.arange(num_values), side="right")).astype(np.uint8)
+    return centers.astype(weight.dtype), expand(labels)
+
+
+# Palettization modes that are implemented by the exporter instead of coremltools, by their clustering function.
+CLUSTERING_MODES = {"histogram": histogram_kmeans}
+
+
+def make_palettizer_config(stage: Dict[str, Any]):
+    """
+    Create the `OptimizationConfig` for an `OpPalettizerConfig` stage dictionary. Op configs that use one of the
+    `CLUSTERING_MODES` become coremltools `custom` configs that call the exporter's clustering function.
+    """
+    import coremltools.optimize.coreml as cto
+
+    stage = copy.deepcopy(stage)
+    exporter_modes = {}
+
+    def replace(key, op_config):
+        if isinstance(op_config, dict) and op_config.get("mode") in CLUSTERING_MODES:
+            exporter_modes[key] = op_config
+            return {**op_config, "mode": "kmeans"}
+        return op_config
+
+    if stage.get("global_config") is not None:
+        stage["global_config"] = replace(("global",), stage["global_config"])
+    for field in ["op_type_configs", "op_name_configs"]:
+        for name, op_config in (stage.get(field) or {}).items():
+            stage[field][name] = replace((field, name), op_config)
+
+    config = cto.OptimizationConfig.from_dict(stage)
+
+    for key, op_config in exporter_modes.items():
+        custom_config = cto.OpPalettizerConfig(
+            mode="custom",
+            lut_function=partial(CLUSTERING_MODES[op_config["mode"]], op_config["nbits"]),
+            weight_threshold=op_config.get("weight_threshold", 2048),
+        )
+        if key[0] == "global":
+            config.global_config = custom_config
+        else:
+            getattr(config, key[0])[key[1]] = custom_config
+    return config
+
+
+def _get_lut_function(op_config) -> Optional[Callable[[np.ndarray], Tuple[np.ndarray, np.ndarray]]]:
+    """The clustering function of a palettizer op config, if it can run in a worker process."""
+    mode = str(getattr(op_config, "mode", "")).lower()
+    if mode == "kmeans":
+        # Otherwise coremltools clusters these weights itself, one after the other.
+        return partial(kmeans_lut, op_config.nbits) if is_kmeans_lut_supported() else None
+    if mode == "custom":
+        try:
+            pickle.dumps(op_config.lut_function)
+        except Exception:
+            return None
+        return op_config.lut_function
+    return None
+
+
+def _palettize_blob(blob: WeightBlob, lut_function, indices_path: str, indices_offset: int):
+    """Worker: cluster one weight read from the memory-mapped weight file, and write its indices to the shared output file."""
+    start_time = time.perf_counter()
+    weight = np.memmap(blob.path, dtype=blob.dtype, mode="r", offset=blob.offset, shape=blob.shape)
+    weight = np.array(weight)
+    key = _weight_key(weight)
+    lut, indices = lut_function(weight)
+    indices = np.asarray(indices, dtype=np.uint8).reshape(-1)
+
+    output = np.memmap(indices_path, dtype=np.uint8, mode="r+", offset=indices_offset, shape=(indices.size,))
+    output[:] = indices
+    output.flush()
+    return key, lut, time.perf_counter() - start_time
+
+
+class ParallelPalettizer:
+    """
+    Computes the k-means lookup tables for all the weights a palettizer config applies to, in parallel.
+
+    Args:
+        num_workers (`int`, *optional*):
+            Number of worker processes. Defaults to the number of CPU cores.
+
+    The workers are started with the `forkserver` method, or `spawn` where that is not available, as forking a
+    process that already runs PyTorch, OpenMP or Core ML threads is not safe.
+    """
+    def __init__(self, num_workers: Optional[int] = None):
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self.timings = {}
+
+    def _get_jobs(self, mlmodel, op_config) -> Tuple[List[Tuple[WeightBlob, int]], List[Any]]:
+        """The weights to cluster, with the index of their op config, and the distinct op configs."""
+        jobs = []
+        configs = []
+        for blob in get_weight_blobs(mlmodel):
+            config = _get_op_config(op_config, blob)
+            if config is None or _get_lut_function(config) is None:
+                continue
+            if blob.size <= getattr(config, "weight_threshold", 2048):
+                continue
+            index = next((i for i, other in enumerate(configs) if other is config), None)
+            if index is None:
+                index = len(configs)
+                configs.append(config)
+            jobs.append((blob, index))
+        return jobs, configs
+
+    def compute_luts(
+        self, jobs: Sequence[Tuple[WeightBlob, int]], configs: Sequence[Any], tmp_dir: str
+    ) -> List[Dict[Any, Tuple[np.ndarray, np.ndarray]]]:
+        """
+        Cluster all the weights. For every op config, returns the lookup tables and indices by weight. The indices
+        are views into a memory-mapped file in `tmp_dir`.
+        """
+        indices_path = os.path.join(tmp_dir, "indices.bin")
+        offsets = np.cumsum([0] + [blob.size for blob, _ in jobs])
+        with open(indices_path, "wb") as f:
+            f.truncate(int(offsets[-1]) or 1)
+
+        lut_functions = [_get_lut_function(config) for config in configs]
+        results = [{} for _ in configs]
+        start_time = time.perf_counter()
+        serial_time = 0.0
+
+        # Start with the largest weights, so that a big tensor doesn't end up running on its own at the end.
+        order = sorted(range(len(jobs)), key=lambda i: -jobs[i][0].size)
+        context = multiprocessing.get_context(
+            "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        )
+        with ProcessPoolExecutor(max_workers=self.num_workers, mp_context=context) as executor:
+            futures = {
+                executor.submit(_palettize_blob, jobs[i][0], lut_functions[jobs[i][1]], indices_path, int(offsets[i])): i
+                for i in order
+            }
+            for future, i in futures.items():
+                key, lut, elapsed = future.result()
+                blob, config_index = jobs[i]
+                indices = np.memmap(indices_path, dtype=np.uint8, mode="r", offset=int(offsets[i]), shape=(blob.size,))
+                results[config_index][key] = (lut, indices)
+                serial_time += elapsed
+
+        wall_time = time.perf_counter() - start_time
+        self.timings = {
+            "num_workers": self.num_workers,
+            "num_weights": len(jobs),
+            "wall_time": wall_time,
+            "serial_time": serial_time,
+            "speedup": serial_time / wall_time if wall_time > 0 else 1.0,
+        }
+        logger.info(
+            f"Clustered {len(jobs)} weights with {self.num_workers} workers in {wall_time:.1f} sec "
+            f"({serial_time:.1f} sec of clustering, {self.timings['speedup']:.1f}x speedup)"
+        )
+        return results
+
+    def palettize(self, mlmodel: "ct.models.MLModel", op_config) -> "ct.models.MLModel":
+        """
+        Palettize the model like `coremltools.optimize.coreml.palettize_weights(mlmodel, op_config)`, with the
+        clustering done in parallel.
+        """
+        import coremltools.optimize.coreml as cto
+
+        jobs, configs = self._get_jobs(mlmodel, op_config)
+        if len(jobs) == 0:
+            logger.info("No weights to cluster in parallel, palettizing with coremltools")
+            return cto.palettize_weights(mlmodel, config=op_config)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            results = self.compute_luts(jobs, configs, tmp_dir)
+
+            def make_custom_config(config):
+                index = next((i for i, other in enumerate(configs) if other is config), None)
+                if index is None:
+                    return config
+                lut_function = _get_lut_function(config)
+
+                def lookup(weight):
+                    result = results[index].get(_weight_key(weight))
+                    if result is None:
+                        # Not clustered up front, for example because coremltools selected it differently.
+                        return lut_function(weight)
+                    return result
+
+                return cto.OpPalettizerConfig(mode="custom", lut_function=lookup, weight_threshold=config.weight_threshold)
+
+            custom_config = cto.OptimizationConfig(
+                global_config=make_custom_config(op_config.global_config),
+                op_type_configs={key: make_custom_config(value) for key, value in op_config.op_type_configs.items()},
+                op_name_configs={key: make_custom_config(value) for key, value in op_config.op_name_configs.items()},
+            )
+            return cto.palettize_weights(mlmodel, config=custom_config)
+
+
+def benchmark_palettization(
+    mlmodel: "ct.models.MLModel", op_config, worker_counts: Sequence[int] = (1, 2, 4, 8)
+) -> List[Dict[str, float]]:
+    """Time the parallel clustering of the model's weights for several numbers of workers."""
+    results = []
+    for num_workers in worker_counts:
+        palettizer = ParallelPalettizer(num_workers)
+        jobs, configs = palettizer._get_jobs(mlmodel, op_config)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            palettizer.compute_luts(jobs, configs, tmp_dir)
+        results.append(palettizer.timings)
+
+    base_time = results[0]["wall_time"] if results else 0.0
+    for timings in results:
+        timings["speedup_vs_first"] = base_time / timings["wall_time"] if timings["wall_time"] > 0 else 1.0
+    return results
+
+
+def benchmark_clustering(
+    mlmodel: "ct.models.MLModel", nbits: int, modes: Sequence[str] = ("kmeans", "histogram")
+) -> List[Dict[str, float]]:
+    """
+    Compare palettization modes on the weights of a model: the total clustering time, and the mean squared
+    error of the palettized weights.
+    """
+    functions = {"kmeans": partial(kmeans_lut, nbits)}
+    functions.update({mode: partial(function, nbits) for mode, function in CLUSTERING_MODES.items()})
+
+    results = []
+    for mode in modes:
+        if mode not in functions:
+            raise ValueError(f"Unknown palettization mode '{mode}', expected one of {list(functions.keys())}")
+        elapsed, squared_error, num_elements = 0.0, 0.0, 0
+        for blob in get_weight_blobs(mlmodel):
+            if blob.size <= 2048:
+                continue
+            weight = np.array(np.memmap(blob.path, dtype=blob.dtype, mode="r", offset=blob.offset, shape=blob.shape))
+            start_time = time.perf_counter()
+            lut, indices = functions[mode](weight)
+            elapsed += time.perf_counter() - start_time
+            error = lut.astype(np.float64)[indices] - weight.reshape(-1).astype(np.float64)
+            squared_error += float(np.sum(error ** 2))
+            num_elements += weight.size
+        results.append({"mode": mode, "time": elapsed, "mse": squared_error / max(num_elements, 1)})
+    return results
@@ -0,0 +1,158 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Timing and peak-memory spans for the stages of an export."""
+
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Union
+
+from ..utils import logging
+
+
+logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
+
+
+_active_profiler = None
+
+
+def get_peak_rss() -> int:
+    """Peak resident set size of the current process so far, in bytes."""
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux but in bytes on macOS.
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+class Profiler:
+    """
+    Records named spans with their wall time, CPU time, and peak memory.
+
+    The profiler is activated with a `with` block. While it is active, [`profile_span`] records into it;
+    otherwise spans cost nothing. Spans may be nested and may be recorded from several threads.
+
+    CPU time is the CPU time of the whole process, so it includes work done by other threads during the
+    span. The peak RSS of a process only ever goes up, so every span records the peak at its end, and
+    how much the span raised it.
+    """
+    def __init__(self):
+        self.spans = []
+        self.start_time = time.perf_counter()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._previous = None
+
+    def __enter__(self):
+        global _active_profiler
+        self._previous = _active_profiler
+        _active_profiler = self
+        return self
+
+    def __exit__(self, *exc_info):
+        global _active_profiler
+        _active_profiler = self._previous
+        self._previous = None
+
+    @contextmanager
+    def span(self, name: str, **metadata):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        start_peak_rss = get_peak_rss()
+        stack.append(name)
+        try:
+            yield
+        finally:
+            stack.pop()
+            peak_rss = get_peak_rss()
+            span = {
+                "name": name,
+                "parent": stack[-1] if stack else None,
+                "start": start_wall - self.start_time,
+                "wall_time": time.perf_counter() - start_wall,
+                "cpu_time": time.process_time() - start_cpu,
+                "peak_rss": peak_rss,
+                "peak_rss_increase": peak_rss - start_peak_rss,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+            }
+            if metadata:
+                span["metadata"] = metadata
+            with self._lock:
+                self.spans.append(span)
+            logger.info(f"{name}: {span['wall_time']:.2f} sec, peak RSS {peak_rss / 1024**3:.2f} GB")
+
+    def add_spans(self, spans: List[Dict[str, Any]], offset: float = 0.0):
+        """Merge spans recorded by another profiler, for example in a worker process."""
+        with self._lock:
+            for span in spans:
+                self.spans.append({**span, "start": span["start"] + offset})
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "total_wall_time": time.perf_counter() - self.start_time,
+            "peak_rss": max([get_peak_rss()] + [span["peak_rss"] for span in self.spans]),
+            "spans": sorted(self.spans, key=lambda span: span["start"]),
+        }
+
+    def save(self, path: Union[str, Path]):
+        """Write the report as JSON."""
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2, default=str)
+
+    def save_chrome_trace(self, path: Union[str, Path]):
+        """Write the spans in the Chrome trace event format, for viewing in chrome://tracing or Perfetto."""
+        events = []
+        for span in self.spans:
+            args = {
+                "cpu_time": span["cpu_time"],
+                "peak_rss": span["peak_rss"],
+                "peak_rss_increase": span["peak_rss_increase"],
+                **span.get("metadata", {}),
+            }
+            events.append({
+                "name": span["name"],
+                "ph": "X",
+                "ts": span["start"] * 1e6,
+                "dur": span["wall_time"] * 1e6,
+                "pid": span["pid"],
+                "tid": span["tid"],
+                "args": args,
+            })
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, default=str)
+
+
+def get_profiler() -> Optional[Profiler]:
+    """The active profiler, or `None`."""
+    return _active_profiler
+
+
+@contextmanager
+def profile_span(name: str, **metadata):
+    """Record a span in the active profiler, if there is one."""
+    profiler = _active_profiler
+    if profiler is None:
+        yield
+    else:
+        with profiler.span(name, **metadata):
+            yield
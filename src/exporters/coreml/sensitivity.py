@@ -0,0 +1,358 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Search for a per-layer palettization bit width, based on how sensitive each layer is to compression."""
+
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Tuple
+
+from transformers.utils import TensorType
+
+from .compression import CompressionPipeline
+from .config import CoreMLConfig
+from ..utils import logging
+
+
+if TYPE_CHECKING:
+    import torch
+    from transformers.modeling_utils import PreTrainedModel
+
+
+logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
+
+
+DEFAULT_BITS = (2, 3, 4, 6, 8)
+
+# Layers that stay in float16 are stored with 16 bits per parameter.
+UNCOMPRESSED_BITS = 16
+
+
+def palettize_tensor(weight: "torch.Tensor", nbits: int, iterations: int = 10, max_samples: int = 1 << 18) -> "torch.Tensor":
+    """
+    Approximate the k-means palettization that Core ML applies to a weight tensor: the values are clustered
+    into `2**nbits` centroids and every value is replaced by its nearest centroid. The centroids are fit on
+    a random sample of the values, which is plenty for a 1-D clustering.
+    """
+    import torch
+
+    values = weight.detach().reshape(-1).float()
+    sample = values
+    if values.numel() > max_samples:
+        generator = torch.Generator().manual_seed(0)
+        sample = values[torch.randint(values.numel(), (max_samples,), generator=generator)]
+
+    num_clusters = min(2**nbits, sample.numel())
+    centroids = torch.quantile(sample, torch.linspace(0, 1, num_clusters))
+    for _ in range(iterations):
+        assignment = torch.bucketize(sample, (centroids[1:] + centroids[:-1]) / 2)
+        sums = torch.zeros(num_clusters).index_add_(0, assignment, sample)
+        counts = torch.bincount(assignment, minlength=num_clusters)
+        centroids = torch.where(counts > 0, sums / counts.clamp(min=1), centroids).sort().values
+
+    assignment = torch.bucketize(values, (centroids[1:] + centroids[:-1]) / 2)
+    return centroids[assignment].reshape(weight.shape).to(weight.dtype)
+
+
+def palettized_size(num_parameters: int, nbits: int) -> float:
+    """Size in bytes of a weight tensor palettized with `nbits`, including its float16 lookup table."""
+    if nbits >= UNCOMPRESSED_BITS:
+        return num_parameters * 2
+    return num_parameters * nbits / 8 + 2**nbits * 2
+
+
+def get_compressible_weights(model: "PreTrainedModel", weight_threshold: int = 2048) -> Dict[str, "torch.nn.Parameter"]:
+    """
+    The weights of the linear and convolution layers, by parameter name. Embedding tables are skipped, just
+    like the built-in palettization options skip `gather` ops, and so are weights shared with them.
+    """
+    import torch
+    from transformers.pytorch_utils import Conv1D
+
+    embeddings = set(id(module.weight) for module in model.modules() if isinstance(module, torch.nn.Embedding))
+
+    weights = {}
+    seen = set()
+    for module_name, module in model.named_modules():
+        if not isinstance(module, (torch.nn.Linear, torch.nn.Conv1d, torch.nn.Conv2d, Conv1D)):
+            continue
+        weight = module.weight
+        if id(weight) in embeddings or id(weight) in seen or weight.numel() < weight_threshold:
+            continue
+        seen.add(id(weight))
+        weights[f"{module_name}.weight"] = weight
+    return weights
+
+
+def make_calibration_inputs(
+    preprocessor,
+    model: "PreTrainedModel",
+    config: CoreMLConfig,
+    num_batches: int = 4,
+    seed: int = 0,
+) -> List[List["torch.Tensor"]]:
+    """
+    Calibration batches in the order of `config.inputs`. The first batch is the regular dummy input; the
+    others use random token IDs, or add noise to floating point inputs.
+    """
+    import torch
+
+    dummy_inputs = config.generate_dummy_inputs(preprocessor, framework=TensorType.PYTORCH)
+    example_input = []
+    for name in config.inputs.keys():
+        value = dummy_inputs[name][0]
+        if value.is_floating_point():
+            value = value.to(model.dtype)
+        example_input.append(value)
+
+    generator = torch.Generator().manual_seed(seed)
+    vocab_size = getattr(model.config, "vocab_size", None)
+
+    batches = [example_input]
+    for _ in range(num_batches - 1):
+        batch = []
+        for name, value in zip(config.inputs.keys(), example_input):
+            if name in ["input_ids", "decoder_input_ids"] and vocab_size is not None:
+                value = torch.randint(vocab_size, value.shape, generator=generator, dtype=value.dtype)
+            elif value.is_floating_point() and not name.startswith("past_key_values"):
+                noise = torch.randn(value.shape, generator=generator) * 0.1 * value.float().std()
+                value = value + noise.to(value.dtype)
+            batch.append(value)
+        batches.append(batch)
+    return batches
+
+
+def _run_outputs(wrapper, batches) -> List[List["torch.Tensor"]]:
+    import torch
+
+    outputs = []
+    with torch.no_grad():
+        for batch in batches:
+            output = wrapper(*batch)
+            if not isinstance(output, (tuple, list)):
+                output = [output]
+            outputs.append([x.float() for x in output])
+    return outputs
+
+
+def _max_abs_error(outputs, reference) -> float:
+    error = 0.0
+    for batch_outputs, batch_reference in zip(outputs, reference):
+        for x, y in zip(batch_outputs, batch_reference):
+            error = max(error, (x - y).abs().max().item())
+    return error
+
+
+def compute_sensitivity(
+    preprocessor,
+    model: "PreTrainedModel",
+    config: CoreMLConfig,
+    bits: Sequence[int] = DEFAULT_BITS,
+    num_batches: int = 4,
+    weight_threshold: int = 2048,
+) -> Dict[str, Dict[int, float]]:
+    """
+    Measure, for every compressible weight and bit width, the maximum absolute error in the model's
+    outputs when only that weight is palettized. The error is measured on the outputs of the Core ML
+    wrapper, so it is comparable to `config.atol_for_validation`.
+
+    Returns:
+        `Dict[str, Dict[int, float]]`: the output error, by parameter name and number of bits.
+    """
+    from .convert import Wrapper
+
+    wrapper = Wrapper(preprocessor, model, config).eval()
+    batches = make_calibration_inputs(preprocessor, model, config, num_batches=num_batches)
+    reference = _run_outputs(wrapper, batches)
+
+    weights = get_compressible_weights(model, weight_threshold=weight_threshold)
+    sensitivity = {}
+    for i, (name, weight) in enumerate(weights.items()):
+        original = weight.data
+        sensitivity[name] = {}
+        try:
+            for nbits in bits:
+                weight.data = palettize_tensor(original, nbits)
+                sensitivity[name][nbits] = _max_abs_error(_run_outputs(wrapper, batches), reference)
+        finally:
+            weight.data = original
+
+        errors = ", ".join(f"{nbits}-bit: {error:.2e}" for nbits, error in sensitivity[name].items())
+        logger.info(f"[{i + 1}/{len(weights)}] {name}: {errors}")
+
+    return sensitivity
+
+
+def solve_bit_allocation(
+    sensitivity: Dict[str, Dict[int, float]],
+    num_parameters: Dict[str, int],
+    max_size: Optional[float] = None,
+    max_error: Optional[float] = None,
+    fixed_size: float = 0,
+) -> Tuple[Dict[str, int], float, float]:
+    """
+    Choose a bit width for every weight. With `max_size`, this minimizes the total output error while the
+    model fits in `max_size` bytes. Otherwise, this minimizes the size while the total output error stays
+    below `max_error`. Errors of different layers are assumed to add up.
+
+    This is a multiple-choice knapsack problem, solved with a Lagrangian relaxation: for a given trade-off
+    `lam`, every layer independently picks the bit width that minimizes `error + lam * size`, and `lam` is
+    found by bisection. Leaving a layer in float16 (`UNCOMPRESSED_BITS`) is always one of the choices.
+
+    Returns:
+        `Tuple[Dict[str, int], float, float]`: the number of bits per weight, the predicted size in bytes
+        (including `fixed_size`), and the predicted output error.
+    """
+    if (max_size is None) == (max_error is None):
+        raise ValueError("Specify exactly one of max_size or max_error")
+
+    options = {
+        name: {**errors, UNCOMPRESSED_BITS: 0.0}
+        for name, errors in sensitivity.items()
+    }
+
+    def allocate(lam):
+        plan = {}
+        for name, errors in options.items():
+            plan[name] = min(
+                errors.keys(),
+                key=lambda nbits: (errors[nbits] + lam * palettized_size(num_parameters[name], nbits), nbits),
+            )
+        size = fixed_size + sum(palettized_size(num_parameters[name], nbits) for name, nbits in plan.items())
+        error = sum(options[name][nbits] for name, nbits in plan.items())
+        return plan, size, error
+
+    def is_feasible(size, error):
+        return size <= max_size if max_size is not None else error <= max_error
+
+    # A larger trade-off gives smaller models with larger errors.
+    low, high = -40.0, 10.0
+    smallest, largest = allocate(10**high), allocate(10**low)
+
+    if max_size is not None:
+        if not is_feasible(*smallest[1:]):
+            logger.warning(
+                f"Cannot fit the model in {max_size / 1024**2:.1f} MB, the smallest plan is {smallest[1] / 1024**2:.1f} MB"
+            )
+            return smallest
+        if is_feasible(*largest[1:]):
+            return largest
+        best = smallest
+    else:
+        if is_feasible(*smallest[1:]):
+            return smallest
+        best = largest
+
+    for _ in range(100):
+        middle = (low + high) / 2
+        plan, size, error = allocate(10**middle)
+        if max_size is not None:
+            # Find the smallest trade-off that fits in the budget, as it has the smallest error.
+            if is_feasible(size, error):
+                best, high = (plan, size, error), middle
+            else:
+                low = middle
+        else:
+            # Find the largest trade-off that stays within the error, as it gives the smallest model.
+            if is_feasible(size, error):
+                best, low = (plan, size, error), middle
+            else:
+                high = middle
+
+    return best
+
+
+def search_palettization(
+    preprocessor,
+    model: "PreTrainedModel",
+    config: CoreMLConfig,
+    target_size: Optional[int] = None,
+    bits_per_parameter: Optional[float] = None,
+    max_error: Optional[float] = None,
+    bits: Sequence[int] = DEFAULT_BITS,
+    num_batches: int = 4,
+    weight_threshold: int = 2048,
+    name: Optional[str] = None,
+) -> CompressionPipeline:
+    """
+    Find the per-layer palettization that gives the smallest output error within a size budget, or the
+    smallest model whose predicted output error stays within `max_error`.
+
+    Args:
+        preprocessor ([`PreTrainedTokenizer`], [`FeatureExtractionMixin`] or [`ProcessorMixin`]):
+            The preprocessor used for encoding the data.
+        model ([`PreTrainedModel`]):
+            The model to export.
+        config ([`~coreml.config.CoreMLConfig`]):
+            The Core ML configuration associated with the exported model.
+        target_size (`int`, *optional*):
+            Size budget for the weights of the model, in bytes.
+        bits_per_parameter (`float`, *optional*):
+            Size budget, as an average number of bits per parameter.
+        max_error (`float`, *optional*):
+            Maximum predicted output error. Only used without a size budget. Defaults to `config.atol_for_validation`.
+        bits (`Sequence[int]`, *optional*, defaults to `(2, 3, 4, 6, 8)`):
+            The bit widths to choose from.
+        num_batches (`int`, *optional*, defaults to 4):
+            Number of calibration batches.
+        weight_threshold (`int`, *optional*, defaults to 2048):
+            Weights with fewer elements are not compressed.
+        name (`str`, *optional*):
+            Name of the resulting variant.
+
+    Returns:
+        [`~coreml.compression.CompressionPipeline`]: a single palettization stage with a config for every
+        searched weight. The weights are named by their PyTorch parameter names, which are matched to the
+        Core ML weights when the pipeline is applied.
+    """
+    if target_size is not None and bits_per_parameter is not None:
+        raise ValueError("Specify at most one of target_size or bits_per_parameter")
+
+    weights = get_compressible_weights(model, weight_threshold=weight_threshold)
+    num_parameters = {name: weight.numel() for name, weight in weights.items()}
+    total_parameters = sum(p.numel() for p in model.parameters())
+    fixed_size = (total_parameters - sum(num_parameters.values())) * 2
+
+    max_size = None
+    if bits_per_parameter is not None:
+        max_size = total_parameters * bits_per_parameter / 8
+    elif target_size is not None:
+        max_size = target_size
+
+    # A size budget takes precedence over the error bound.
+    if max_size is not None:
+        max_error = None
+    elif max_error is None:
+        max_error = config.atol_for_validation
+
+    sensitivity = compute_sensitivity(
+        preprocessor, model, config, bits=bits, num_batches=num_batches, weight_threshold=weight_threshold
+    )
+    plan, size, error = solve_bit_allocation(
+        sensitivity, num_parameters, max_size=max_size, max_error=max_error, fixed_size=fixed_size
+    )
+
+    logger.info(
+        f"Palettization plan: {size / 1024**2:.1f} MB ({size * 8 / total_parameters:.2f} bits per parameter), "
+        f"predicted output error {error:.2e}"
+    )
+    if error > config.atol_for_validation:
+        logger.warning(
+            f"The predicted output error {error:.2e} is larger than the validation tolerance {config.atol_for_validation}"
+        )
+
+    op_name_configs = {
+        weight_name: None if nbits >= UNCOMPRESSED_BITS else {"mode": "kmeans", "nbits": nbits}
+        for weight_name, nbits in plan.items()
+    }
+    stage = {"config_type": "OpPalettizerConfig", "op_type_configs": {"gather": None}, "op_name_configs": op_name_configs}
+    return CompressionPipeline([stage], compute_precision="float16", name=name)
@@ -13,7 +13,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Tuple, Union
+import copy
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Tuple, Union
 
 import coremltools as ct
 import numpy as np
@@ -22,9 +23,14 @@ from transformers.utils import TensorType, is_torch_available
 from transformers.modeling_utils import PreTrainedModel
 
 from .config import CoreMLConfig
+from .profiling import profile_span
 from ..utils import logging
 
 
+if is_torch_available():
+    import torch
+
+
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
 
 
@@ -55,7 +61,39 @@ def validate_model_outputs(
             The exported Core ML model.
         atol (`float`):
             Absolute tolerance. Differences larger than this value are considered problematic.
+
+    A model with enumerated sequence lengths is validated with every one of them, and a multifunction model
+    with every one of its functions. The chunks of a model with `num_chunks` are validated together, as a
+    [`~coreml.chunks.ChunkedModel`].
     """
+    if config.functions:
+        for function in config.functions:
+            logger.info(f"Validating function '{function}':")
+            function_mlmodel = ct.models.MLModel(
+                mlmodel.package_path, compute_units=mlmodel.compute_unit, function_name=function
+            )
+            function_config = config.get_function_config(function)
+            validate_model_outputs(function_config, preprocessor, reference_model, function_mlmodel, atol)
+        return
+
+    sequence_lengths = config.get_input_sequence_length(config.inputs)
+    if not isinstance(sequence_lengths, list):
+        _validate_model_outputs(config, preprocessor, reference_model, mlmodel, atol)
+        return
+
+    for sequence_length in sequence_lengths:
+        logger.info(f"Validating sequence length {sequence_length}:")
+        _validate_model_outputs(config, preprocessor, reference_model, mlmodel, atol, sequence_length=sequence_length)
+
+
+def _validate_model_outputs(
+    config: CoreMLConfig,
+    preprocessor: Union["PreTrainedTokenizer", "FeatureExtractionMixin", "ProcessorMixin"],
+    reference_model: Union["PreTrainedModel", "TFPreTrainedModel"],
+    mlmodel: ct.models.MLModel,
+    atol: float,
+    sequence_length: Optional[int] = None,
+):
     logger.info("Validating Core ML model...")
 
     input_descs = config.inputs
@@ -66,46 +104,131 @@ def validate_model_outputs(
     else:
         framework = TensorType.TENSORFLOW
 
-    dummy_inputs = config.generate_dummy_inputs(preprocessor, framework)
+    with profile_span("validate.generate_dummy_inputs"):
+        dummy_inputs = config.generate_dummy_inputs(preprocessor, framework, sequence_length=sequence_length)
 
     reference_model_inputs = {}
     past_key_values = []
+    cross_attention_cache = []
     coreml_inputs = {}
 
     # Put the dummy inputs into Core ML and reference model input dictionaries.
     # The separate past_key_values inputs are combined into a tuple of tuples.
     for name in input_descs.keys():
         ref_value, coreml_value = dummy_inputs[name]
-        if name.startswith("past_key_values_"):
+        coreml_inputs[input_descs[name].name] = coreml_value
+        if name.endswith("_scale"):
+            # The reference model gets the dequantized int8 cache instead.
+            continue
+        if f"{name}_scale" in input_descs:
+            ref_value = ref_value.to(reference_model.dtype) * dummy_inputs[f"{name}_scale"][0].to(reference_model.dtype)
+        if framework == TensorType.PYTORCH and ref_value.is_floating_point():
+            ref_value = ref_value.to(reference_model.dtype)
+        if name == "past_key_values":
+            # The keys and values of all layers stacked in one tensor.
+            past_key_values = [(ref_value[0, i], ref_value[1, i]) for i in range(config.num_layers)]
+        elif name.startswith("past_key_values_"):
             if name.endswith("_key"):
                 past_key_values.append((ref_value,))
             else:
                 past_key_values[-1] += (ref_value,)
+        elif name.startswith("encoder_past_key_values_"):
+            if name.endswith("_key"):
+                cross_attention_cache.append((ref_value,))
+            else:
+                cross_attention_cache[-1] += (ref_value,)
         elif name == "encoder_outputs":
             reference_model_inputs[name] = (ref_value,)
         else:
             reference_model_inputs[name] = ref_value
-        coreml_inputs[input_descs[name].name] = coreml_value
+
+    # The reference decoder gets the cross-attention keys and values in its cache, which it only uses when it
+    # also gets encoder hidden states. These have the encoder's sequence length, but are not used.
+    if len(cross_attention_cache) > 0:
+        past_key_values = [layer_past + cross for layer_past, cross in zip(past_key_values, cross_attention_cache)]
+        cross_key = cross_attention_cache[0][0]
+        reference_model_inputs["encoder_outputs"] = (
+            cross_key.new_zeros((cross_key.shape[0], cross_key.shape[2], reference_model.config.hidden_size)),
+        )
 
     if len(past_key_values) > 0:
         reference_model_inputs["past_key_values"] = past_key_values
 
+    # A model with a fixed-size key / value cache starts from an empty cache, and all the tokens before
+    # the position are zeros. The reference model gets the same cache as past_key_values.
+    if "position" in reference_model_inputs:
+        position = int(reference_model_inputs.pop("position")[0])
+        input_ids = reference_model_inputs["input_ids"]
+        batch_size, sequence_length = input_ids.shape
+        shape = config.kv_cache_shape[:2] + (position,) + config.kv_cache_shape[3:]
+        past = torch.zeros(shape, dtype=reference_model.dtype)
+        reference_model_inputs["past_key_values"] = tuple((past, past) for _ in range(config.num_layers))
+        reference_model_inputs["attention_mask"] = torch.ones((batch_size, position + sequence_length), dtype=torch.long)
+
     # Compute outputs from the reference model
     if is_torch_available() and issubclass(type(reference_model), PreTrainedModel):
         reference_model.to("cpu").eval()
+    encoder_decoder_model = reference_model
     if config.seq2seq == "encoder":
         reference_model = reference_model.get_encoder()
-    ref_outputs_dict = reference_model(**reference_model_inputs, return_dict=True)
+    with profile_span("validate.reference_forward"):
+        ref_outputs_dict = reference_model(**reference_model_inputs, return_dict=True)
+
+    # The encoder's cross-attention keys and values for every decoder layer.
+    if config.seq2seq == "encoder" and config.cross_attention_cache:
+        from .convert import get_cross_attention_cache
+
+        with torch.no_grad():
+            cache = get_cross_attention_cache(encoder_decoder_model, ref_outputs_dict["last_hidden_state"])
+        for i, (key, value) in enumerate(cache):
+            ref_outputs_dict[f"encoder_present_{i}_key"] = key
+            ref_outputs_dict[f"encoder_present_{i}_value"] = value
 
     # Unpack the past_key_values output into separate outputs, as that is also
     # how the Core ML mdel does it.
     if "past_key_values" in ref_outputs_dict:
+        input_ids_name = "decoder_input_ids" if config.seq2seq == "decoder" else "input_ids"
+        num_new_tokens = dummy_inputs[input_ids_name][0].shape[-1]
         for i in range(len(ref_outputs_dict["past_key_values"])):
             ref_outputs_dict[f"present_{i}_key"] = ref_outputs_dict["past_key_values"][i][0]
             ref_outputs_dict[f"present_{i}_value"] = ref_outputs_dict["past_key_values"][i][1]
 
+            for name in [f"present_{i}_key", f"present_{i}_value"]:
+                present = ref_outputs_dict[name]
+                if config.new_kv_only:
+                    # Only the keys and values of the new tokens, which are at the end.
+                    ref_outputs_dict[name] = present[:, :, -num_new_tokens:]
+                elif config.kv_cache == "static":
+                    # The rest of a static cache stays empty.
+                    padding = config.max_context_length - present.shape[2]
+                    ref_outputs_dict[name] = torch.nn.functional.pad(present, (0, 0, 0, padding))
+
+        if config.stack_kv_cache:
+            num_layers = len(ref_outputs_dict["past_key_values"])
+            ref_outputs_dict["present_key_values"] = torch.stack([
+                torch.stack([ref_outputs_dict[f"present_{i}_{kind}"] for i in range(num_layers)])
+                for kind in ["key", "value"]
+            ])
+
     # Compute outputs from the Core ML model
-    coreml_outputs = mlmodel.predict(coreml_inputs)
+    with profile_span("validate.predict"):
+        if config.states:
+            state = mlmodel.make_state()
+            for name, shape in config.states.items():
+                state.write_state(name, np.zeros(shape, dtype=np.float16))
+            coreml_outputs = mlmodel.predict(coreml_inputs, state=state)
+        else:
+            coreml_outputs = mlmodel.predict(coreml_inputs)
+
+    # An int8 cache is compared after dequantizing it, and may be off by half a quantization step.
+    quantization_scales = {}
+    for name, desc in output_descs.items():
+        if name.endswith("_scale") and desc.name in coreml_outputs:
+            scale = coreml_outputs.pop(desc.name).astype(np.float32)
+            values_name = name[:-len("_scale")]
+            coreml_name = output_descs[values_name].name
+            coreml_outputs[coreml_name] = coreml_outputs[coreml_name].astype(np.float32) * scale
+            quantization_scales[values_name] = scale
 
     # Map the Core ML output names back to the names used by the reference model
     coreml_output_names = list(coreml_outputs.keys())
@@ -114,11 +237,10 @@ def validate_model_outputs(
         if desc.name in coreml_output_names:
             coreml_output_internal_names.append(name)
 
-    spec = mlmodel._spec
-
     # Classifier models are special in Core ML
     if config.is_classifier:
         logger.info("\t- Core ML model is classifier, validating output")
+        spec = mlmodel._spec
 
         if is_torch_available() and issubclass(type(reference_model), PreTrainedModel):
             ref_logits = ref_outputs_dict["logits"].detach().numpy()
@@ -215,7 +337,11 @@ def validate_model_outputs(
             logger.info(f"\t\t-[✓] {coreml_value.shape} matches {ref_value.shape}")
 
         # Values
-        if not np.allclose(ref_value, coreml_value, atol=atol):
+        if name in quantization_scales:
+            close = np.all(np.abs(ref_value - coreml_value) <= atol + quantization_scales[name] / 2)
+        else:
+            close = np.allclose(ref_value, coreml_value, atol=atol)
+        if not close:
             logger.info(f"\t\t-[x] values not close enough (atol: {atol})")
             raise ValueError(
                 "Output values do not match between reference model and Core ML exported model: "
@@ -223,3 +349,275 @@ def validate_model_outputs(
             )
         else:
             logger.info(f"\t\t-[✓] all values close (atol: {atol})")
+
+
+def validate_kv_cache(
+    config: CoreMLConfig,
+    reference_model: "PreTrainedModel",
+    input_ids: "torch.Tensor",
+    atol: float,
+    trace: bool = True,
+) -> float:
+    """
+    Validate that a model exported with a key / value cache option, such as `kv_cache="static"`, `"stateful"`,
+    `new_kv_only`, `stack_kv_cache`, or an int8 `kv_cache_dtype`, predicts the same logits as the model with
+    `past_key_values` inputs and outputs, when generating one token at a time. A cache that is an input and
+    output is kept by a [`KeyValueCacheManager`]. With a `prefill_length`, the first `prefill_length` tokens
+    go through the `"prefill"` function in one step, and the others through the `"decode"` function.
+
+    This runs the (traced) PyTorch `Wrapper` that the Core ML model is converted from, so it does not need
+    Core ML and can be used on any platform.
+
+    Args:
+        config ([`~coreml.config.CoreMLConfig`]):
+            The Core ML configuration with the key / value cache option.
+        reference_model ([`PreTrainedModel`]):
+            The model to export.
+        input_ids (`torch.Tensor`):
+            The tokens to feed one by one, of shape `(1, sequence_length)`. The sequence must fit in the cache,
+            and be at least `prefill_length` tokens long.
+        atol (`float`):
+            Absolute tolerance. Differences larger than this value are considered problematic.
+        trace (`bool`, *optional*, defaults to `True`):
+            Compare the TorchScript trace of the wrapper, which is what gets converted, instead of running
+            it eagerly. Only a fixed-size cache is traced, as its shapes do not change from token to token.
+
+    Returns:
+        `float`: the maximum absolute difference between the logits of both models.
+    """
+    from .convert import Wrapper
+    from .kv_cache import KeyValueCacheManager
+
+    if config.kv_cache == "dynamic" and not (
+        config.new_kv_only or config.stack_kv_cache or config.kv_cache_dtype == "int8"
+    ):
+        raise ValueError("validate_kv_cache needs a CoreMLConfig with a key / value cache option")
+
+    sequence_length = input_ids.shape[-1]
+    if sequence_length > config.max_context_length:
+        raise ValueError(
+            f"{sequence_length} tokens do not fit in a cache of max_context_length {config.max_context_length}"
+        )
+    if config.prefill_length is not None and sequence_length < config.prefill_length:
+        raise ValueError(f"{sequence_length} tokens are fewer than the prefill length {config.prefill_length}")
+
+    reference_model.to("cpu").eval()
+    dynamic_config = type(config)(reference_model.config, task=config.task, use_past=True)
+    dynamic_wrapper = Wrapper(None, reference_model, dynamic_config).eval()
+
+    # Every step runs a function on the tokens from `start` to `end`.
+    if config.functions:
+        wrappers = {
+            function: Wrapper(None, reference_model, config.get_function_config(function)).eval()
+            for function in config.functions
+        }
+        steps = [("prefill", 0, config.prefill_length)]
+        steps += [("decode", position, position + 1) for position in range(config.prefill_length, sequence_length)]
+    else:
+        wrappers = {None: Wrapper(None, reference_model, config).eval()}
+        steps = [(None, position, position + 1) for position in range(sequence_length)]
+
+    # The stateful cache is kept in the wrapper, the others on the host.
+    manager = None
+    if config.kv_cache != "stateful":
+        manager = KeyValueCacheManager(config, max_context_length=sequence_length)
+
+    def get_wrapper_inputs(token, position):
+        if manager is None:
+            return [token, torch.tensor([position])]
+        inputs = manager.get_inputs(token.numpy())
+        wrapper_inputs = []
+        for input_desc in config.inputs.values():
+            value = torch.from_numpy(np.asarray(inputs[input_desc.name]))
+            if value.is_floating_point():
+                value = value.to(reference_model.dtype)
+            elif value.dtype == torch.int32:
+                value = value.long()
+            wrapper_inputs.append(value)
+        return wrapper_inputs
+
+    if trace and config.kv_cache != "dynamic":
+        for function, wrapper in wrappers.items():
+            num_tokens = config.prefill_length if function == "prefill" else 1
+            with torch.no_grad():
+                example_inputs = get_wrapper_inputs(input_ids[:, :num_tokens], 0)
+                wrappers[function] = torch.jit.trace(wrapper, example_inputs, strict=True)
+
+    # Tracing runs the model, so the state needs to be emptied after it.
+    for wrapper in wrappers.values():
+        for name in config.states:
+            getattr(wrapper, name).zero_()
+    if manager is not None:
+        manager.reset()
+
+    shape = config.kv_cache_shape[:2] + (0,) + config.kv_cache_shape[3:]
+    empty = torch.zeros(shape, dtype=reference_model.dtype)
+    presents = [empty] * (config.num_layers * 2)
+
+    max_diff = 0.0
+    logger.info(f"Validating the '{config.kv_cache}' key / value cache for {sequence_length} tokens...")
+    with torch.no_grad():
+        for i, (function, start, end) in enumerate(steps):
+            tokens = input_ids[:, start:end]
+            attention_mask = torch.ones((1, end), dtype=torch.long)
+            ref_logits, *presents = dynamic_wrapper(tokens, attention_mask, *presents)
+
+            # The functions of a stateful model share the state.
+            wrapper = wrappers[function]
+            if i > 0 and steps[i - 1][0] != function:
+                for name in config.states:
+                    getattr(wrapper, name).copy_(getattr(wrappers[steps[i - 1][0]], name))
+
+            outputs = wrapper(*get_wrapper_inputs(tokens, start))
+            if manager is not None:
+                logits, outputs = outputs[0], outputs[1:]
+                output_names = [output_desc.name for output_desc in config.outputs.values()][1:]
+                outputs = [value.float() if value.is_floating_point() else value for value in outputs]
+                manager.update({name: value.numpy() for name, value in zip(output_names, outputs)})
+            else:
+                logits = outputs
+            max_diff = max(max_diff, (logits - ref_logits).abs().max().item())
+
+    if max_diff > atol:
+        logger.info(f"\t-[x] logits not close enough (atol: {atol})")
+        raise ValueError(
+            "Logits do not match between the key / value cache and past_key_values: "
+            f"Got max absolute difference of: {max_diff}"
+        )
+    logger.info(f"\t-[✓] all logits close (atol: {atol})")
+    return max_diff
+
+
+
+class _WrapperModel:
+    """
+    Runs a PyTorch `Wrapper` with the `predict` method of a Core ML model. With `trace`, the wrapper is traced
+    with the inputs of the first prediction, and the trace makes the predictions.
+    """
+
+    def __init__(self, wrapper: "torch.nn.Module", config: CoreMLConfig, dtype: "torch.dtype", trace: bool = False):
+        self.wrapper = wrapper
+        self.config = config
+        self.dtype = dtype
+        self.trace = trace
+
+    def predict(self, inputs: Dict[str, Any]) -> Dict[str, np.ndarray]:
+        wrapper_inputs = []
+        for input_desc in self.config.inputs.values():
+            value = torch.from_numpy(np.asarray(inputs[input_desc.name]))
+            if value.is_floating_point():
+                value = value.to(self.dtype)
+            elif value.dtype == torch.int32:
+                value = value.long()
+            wrapper_inputs.append(value)
+
+        with torch.no_grad():
+            if self.trace:
+                self.wrapper = torch.jit.trace(self.wrapper, wrapper_inputs, strict=True)
+                self.trace = False
+            outputs = self.wrapper(*wrapper_inputs)
+        if not isinstance(outputs, (tuple, list)):
+            outputs = (outputs,)
+
+        return {
+            output_desc.name: (value.float() if value.is_floating_point() else value).numpy()
+            for output_desc, value in zip(self.config.outputs.values(), outputs)
+        }
+
+
+def validate_chunks(
+    config: CoreMLConfig,
+    reference_model: "PreTrainedModel",
+    input_ids: "torch.Tensor",
+    atol: float,
+    trace: bool = True,
+) -> float:
+    """
+    Validate that the chunks of a model exported with `num_chunks`, run one after the other by a
+    [`~coreml.chunks.ChunkedModel`], predict the same logits as the whole model. With `use_past`, the tokens
+    are fed one at a time, and both models keep their key / value cache in a [`KeyValueCacheManager`].
+
+    This runs the (traced) PyTorch `Wrapper` of every chunk that the Core ML models are converted from, so it
+    does not need Core ML and can be used on any platform.
+
+    Args:
+        config ([`~coreml.config.CoreMLConfig`]):
+            The Core ML configuration with `num_chunks`.
+        reference_model ([`PreTrainedModel`]):
+            The model to export.
+        input_ids (`torch.Tensor`):
+            The tokens, of shape `(1, sequence_length)`. With a fixed-size cache, the sequence must fit in it.
+        atol (`float`):
+            Absolute tolerance. Differences larger than this value are considered problematic.
+        trace (`bool`, *optional*, defaults to `True`):
+            Compare the TorchScript traces of the wrappers, which is what gets converted, instead of running
+            them eagerly. A dynamic key / value cache is not traced, as its shapes change from token to token.
+
+    Returns:
+        `float`: the maximum absolute difference between the logits of both models.
+    """
+    from .chunks import ChunkedModel, get_chunk_manifest
+    from .convert import Wrapper
+    from .kv_cache import KeyValueCacheManager
+
+    if not config.chunk_layers:
+        raise ValueError("validate_chunks needs a CoreMLConfig with `num_chunks`")
+
+    sequence_length = input_ids.shape[-1]
+    if config.use_past and config.kv_cache != "dynamic" and sequence_length > config.max_context_length:
+        raise ValueError(
+            f"{sequence_length} tokens do not fit in a cache of max_context_length {config.max_context_length}"
+        )
+
+    reference_model.to("cpu").eval()
+    trace = trace and not (config.use_past and config.kv_cache == "dynamic")
+
+    def make_model(model_config):
+        wrapper = Wrapper(None, reference_model, model_config).eval()
+        return _WrapperModel(wrapper, model_config, reference_model.dtype, trace=trace)
+
+    whole_config = copy.copy(config)
+    whole_config.num_chunks = None
+    models = {
+        "whole": make_model(whole_config),
+        "chunked": ChunkedModel(
+            [make_model(config.get_chunk_config(chunk)) for chunk in range(config.num_chunks)],
+            get_chunk_manifest(config),
+        ),
+    }
+
+    # With `use_past`, every step runs the models on the tokens from `start` to `end`.
+    managers = {}
+    if config.use_past:
+        steps = [(position, position + 1) for position in range(sequence_length)]
+        managers = {name: KeyValueCacheManager(config, max_context_length=sequence_length) for name in models}
+    else:
+        steps = [(0, sequence_length)]
+
+    logits_name = whole_config.outputs["logits"].name
+    max_diff = 0.0
+    logger.info(f"Validating {config.num_chunks} chunks for {sequence_length} tokens...")
+    for start, end in steps:
+        tokens = input_ids[:, start:end].numpy()
+        logits = {}
+        for name, model in models.items():
+            if config.use_past:
+                outputs = model.predict(managers[name].get_inputs(tokens))
+                managers[name].update(outputs)
+            else:
+                attention_mask = np.ones(tokens.shape, dtype=np.int32)
+                outputs = model.predict({
+                    whole_config.inputs["input_ids"].name: tokens.astype(np.int32),
+                    whole_config.inputs["attention_mask"].name: attention_mask,
+                })
+            logits[name] = outputs[logits_name]
+        max_diff = max(max_diff, float(np.abs(logits["whole"] - logits["chunked"]).max()))
+
+    if max_diff > atol:
+        logger.info(f"\t-[x] logits not close enough (atol: {atol})")
+        raise ValueError(
+            "Logits do not match between the chunks and the whole model: "
+            f"Got max absolute difference of: {max_diff}"
+        )
+    logger.info(f"\t-[✓] all logits close (atol: {atol})")
+    return max_diff
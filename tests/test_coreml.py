@@ -13,8 +13,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import os
+import tempfile
+
+import numpy as np
 import pytest
 
+from pathlib import Path
 from unittest import TestCase
 from parameterized import parameterized
 from transformers import AutoConfig, is_tf_available, is_torch_available
@@ -24,6 +30,12 @@ from exporters.coreml import (
     export,
     validate_model_outputs,
 )
+from exporters.coreml.batch import (
+    ExportJob, MemoryBudget, estimate_export_memory, estimate_num_parameters, load_manifest, parse_size, read_outputs_file,
+)
+from exporters.coreml.cache import ExportCache
+from exporters.coreml.compression import CompressionPipeline, get_compression_pipeline, get_variant_name, is_pipeline_file
+from exporters.coreml.profiling import Profiler, profile_span
 from transformers.onnx.utils import get_preprocessor
 from transformers.testing_utils import require_tf, require_torch, require_vision, slow
 from .testing_utils import require_coreml, require_macos
@@ -37,6 +49,10 @@ class TextCoreMLConfig(CoreMLConfig):
     modality = "text"
 
 
+class AudioCoreMLConfig(CoreMLConfig):
+    modality = "audio"
+
+
 class CoreMLConfigTestCase(TestCase):
     def test_unknown_modality(self):
         with pytest.raises(ValueError):
@@ -63,6 +79,1049 @@ class CoreMLConfigTestCase(TestCase):
         flexible_outputs = config.get_flexible_outputs()
         self.assertTrue(len(flexible_outputs) == 0)
 
+    def test_enumerated_sequence_lengths(self):
+        with pytest.raises(ValueError):
+            TextCoreMLConfig(None, task="text-generation", use_past=True, sequence_lengths=[32, 64])
+        with pytest.raises(ValueError):
+            TextCoreMLConfig(None, task="feature-extraction", sequence_lengths=[])
+
+        config = TextCoreMLConfig(None, task="feature-extraction", sequence_lengths=[128, 32, 64])
+        self.assertEqual(config.inputs["input_ids"].sequence_length, [32, 64, 128])
+
+        flexible_output = config.get_flexible_outputs()["last_hidden_state"][0]
+        self.assertEqual((flexible_output["min"], flexible_output["max"]), (32, 128))
+        self.assertEqual(flexible_output["sizes"], [32, 64, 128])
+
+        # The model is traced with the longest sequence length.
+        self.assertEqual(config._get_max_sequence_length(config.inputs["input_ids"], 64), 128)
+
+    def test_batch_size(self):
+        with pytest.raises(ValueError):
+            TextCoreMLConfig(None, task="feature-extraction", batch_size=(0, 8))
+        with pytest.raises(ValueError):
+            TextCoreMLConfig(None, task="feature-extraction", batch_size=(1, 8), sequence_lengths=[32, 64])
+        with pytest.raises(ValueError):
+            TextCoreMLConfig(None, task="text-generation", use_past=True, batch_size=[1, 8])
+        with pytest.raises(ValueError):
+            TextCoreMLConfig(None, task="text-classification", batch_size=(1, 8))
+        with pytest.raises(ValueError):
+            AudioCoreMLConfig(None, task="feature-extraction", batch_size=[1, 8])
+
+        # Audio inputs have a range of lengths, so they take a range of batch sizes.
+        config = AudioCoreMLConfig(None, task="feature-extraction", batch_size=(1, 8))
+        self.assertEqual(config.batch_size, (1, 8))
+
+        config = TextCoreMLConfig(None, task="feature-extraction")
+        self.assertIsNone(config.batch_size)
+        self.assertEqual(config.dummy_batch_size, 1)
+
+        config = TextCoreMLConfig(None, task="feature-extraction", batch_size=(1, -1))
+        self.assertEqual(config.dummy_batch_size, 2)
+        flexible_output = config.get_flexible_outputs()["last_hidden_state"]
+        self.assertEqual(flexible_output[0], {"axis": 0, "min": 1, "max": -1})
+
+        config = TextCoreMLConfig(None, task="feature-extraction", batch_size=[32, 1, 8], sequence_lengths=[32, 64])
+        self.assertEqual(config.batch_size, [1, 8, 32])
+        self.assertEqual(config.dummy_batch_size, 8)
+        flexible_output = config.get_flexible_outputs()["last_hidden_state"]
+        self.assertEqual([shape["axis"] for shape in flexible_output], [0, 1])
+        self.assertEqual(flexible_output[0]["sizes"], [1, 8, 32])
+
+
+class ExportCacheTestCase(TestCase):
+    def _write_model(self, size):
+        def writer(path):
+            (path / "Model.mlmodel").write_bytes(b"x" * size)
+        return writer
+
+    def test_lookup(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = ExportCache(tmp_dir)
+            self.assertIsNone(cache.lookup_model("abc"))
+
+            cache.store("models", "abc", self._write_model(10))
+            path = cache.lookup_model("abc")
+            self.assertIsNotNone(path)
+            self.assertEqual(path.name, "Model.mlmodel")
+
+    def test_lru_eviction(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = ExportCache(tmp_dir, max_size=2500)
+            cache.store("models", "a", self._write_model(1000))
+            cache.store("models", "b", self._write_model(1000))
+
+            # Make "a" the most recently used entry.
+            os.utime(Path(tmp_dir) / "models" / "b" / "entry.json", (0, 0))
+            self.assertIsNotNone(cache.lookup_model("a"))
+
+            cache.store("models", "c", self._write_model(1000))
+            self.assertIsNotNone(cache.lookup_model("a"))
+            self.assertIsNone(cache.lookup_model("b"))
+            self.assertIsNotNone(cache.lookup_model("c"))
+
+    def test_key(self):
+        cache = ExportCache()
+        key1 = cache.make_key({"quantize": "float16", "compute_units": "ALL"})
+        key2 = cache.make_key({"compute_units": "ALL", "quantize": "float16"})
+        key3 = cache.make_key({"quantize": "float32", "compute_units": "ALL"})
+        self.assertEqual(key1, key2)
+        self.assertNotEqual(key1, key3)
+
+    @require_torch
+    def test_trace(self):
+        import torch
+        from types import SimpleNamespace
+
+        model = torch.nn.Linear(4, 2)
+        config = TextCoreMLConfig(AutoConfig.for_model("distilbert"), task="feature-extraction")
+        dummy_inputs = {"input_ids": (torch.zeros((1, 8), dtype=torch.long), None)}
+        preprocessor = SimpleNamespace(image_mean=[0.5, 0.5, 0.5], image_std=[0.2, 0.3, 0.4])
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = ExportCache(tmp_dir)
+            key = cache.get_trace_key(model, config, dummy_inputs, preprocessor)
+            self.assertIsNone(cache.lookup_trace(key))
+
+            example_input = torch.ones((1, 4))
+            traced_model = torch.jit.trace(model, example_input)
+            example_output = [traced_model(example_input).detach().numpy()]
+            cache.store_trace(key, traced_model, example_output)
+
+            cached_model, cached_output = cache.lookup_trace(key)
+            np.testing.assert_array_equal(cached_output[0], example_output[0])
+            np.testing.assert_allclose(cached_model(example_input).detach().numpy(), example_output[0])
+
+            # A different image normalization, input shape, or weights needs a new trace.
+            other_preprocessor = SimpleNamespace(image_mean=[0.5, 0.5, 0.5], image_std=[0.2, 0.2, 0.2])
+            self.assertNotEqual(key, cache.get_trace_key(model, config, dummy_inputs, other_preprocessor))
+            other_inputs = {"input_ids": (torch.zeros((1, 16), dtype=torch.long), None)}
+            self.assertNotEqual(key, cache.get_trace_key(model, config, other_inputs, preprocessor))
+            other_model = torch.nn.Linear(4, 2)
+            self.assertNotEqual(key, cache.get_trace_key(other_model, config, dummy_inputs, preprocessor))
+            self.assertEqual(key, cache.get_trace_key(model, config, dummy_inputs, preprocessor))
+
+    @require_torch
+    def test_export_key(self):
+        import torch
+        from types import SimpleNamespace
+
+        model = torch.nn.Linear(4, 2)
+        config = TextCoreMLConfig(AutoConfig.for_model("distilbert"), task="feature-extraction")
+        preprocessor = SimpleNamespace(image_mean=[0.5, 0.5, 0.5], image_std=[0.2, 0.3, 0.4])
+
+        cache = ExportCache()
+        key = cache.get_export_key(model, config, "float16", "ALL", preprocessor)
+        self.assertEqual(key, cache.get_export_key(model, config, "float16", "ALL", preprocessor))
+
+        # The image normalization is part of the converted model.
+        other_preprocessor = SimpleNamespace(image_mean=[0.5, 0.5, 0.5], image_std=[0.2, 0.2, 0.2])
+        self.assertNotEqual(key, cache.get_export_key(model, config, "float16", "ALL", other_preprocessor))
+        self.assertNotEqual(key, cache.get_export_key(model, config, "float32", "ALL", preprocessor))
+
+
+class BatchTestCase(TestCase):
+    def test_load_manifest(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = Path(tmp_dir) / "manifest.json"
+            path.write_text(json.dumps({
+                "defaults": {"quantize": "int8"},
+                "jobs": [
+                    {"model": "distilgpt2", "output": "a", "feature": "causal-lm"},
+                    {"model": "bert-base-cased", "output": "b", "quantize": ["float16", "int4"]},
+                ],
+            }))
+            jobs = load_manifest(path)
+
+        self.assertEqual(len(jobs), 2)
+        self.assertEqual(jobs[0].quantize, "int8")
+        self.assertEqual(jobs[1].quantize, ["float16", "int4"])
+        self.assertEqual(jobs[1].feature, "feature-extraction")
+
+        command = jobs[1].command()
+        self.assertEqual(command[-1], "b")
+        self.assertIn("--quantize", command)
+        self.assertNotIn("--use_past", command)
+        self.assertIn("--outputs_file=outputs.json", jobs[1].command("outputs.json"))
+
+    def test_read_outputs_file(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            outputs_file = Path(tmp_dir) / "outputs.json"
+            self.assertIsNone(read_outputs_file(outputs_file))
+            paths = [f"{tmp_dir}/encoder_Model-float16.mlpackage", f"{tmp_dir}/decoder_Model-float16.mlpackage"]
+            outputs_file.write_text(json.dumps(paths))
+            self.assertEqual(read_outputs_file(outputs_file), paths)
+
+    def test_parse_size(self):
+        self.assertEqual(parse_size("1000"), 1000)
+        self.assertEqual(parse_size("2GB"), 2 * 1024**3)
+        self.assertEqual(parse_size("512MiB"), 512 * 1024**2)
+
+    def test_estimate_memory(self):
+        config = AutoConfig.for_model("gpt2")
+        num_parameters = estimate_num_parameters(config)
+        self.assertAlmostEqual(num_parameters / 124e6, 1.0, delta=0.05)
+
+        config = AutoConfig.for_model(
+            "mistral", hidden_size=4096, intermediate_size=14336, num_hidden_layers=32,
+            num_attention_heads=32, num_key_value_heads=8, vocab_size=32000,
+        )
+        self.assertAlmostEqual(estimate_num_parameters(config) / 7.24e9, 1.0, delta=0.05)
+        self.assertLess(estimate_export_memory(config, low_memory=True), 32 * 1024**3)
+        self.assertGreater(estimate_export_memory(config), 32 * 1024**3)
+
+    def test_memory_budget(self):
+        budget = MemoryBudget(100)
+        budget.acquire(60)
+        budget.acquire(40)
+        self.assertEqual(budget.used, 100)
+        budget.release(100)
+        # A job larger than the whole budget is admitted when nothing else runs.
+        budget.acquire(200)
+        self.assertEqual(budget.used, 200)
+
+
+class CompressionPipelineTestCase(TestCase):
+    def test_builtin(self):
+        pipeline = get_compression_pipeline("float32")
+        self.assertEqual(pipeline.compute_precision, "float32")
+        self.assertEqual(pipeline.stages, [])
+
+        pipeline = get_compression_pipeline("mixed-6-4")
+        self.assertEqual(pipeline.compute_precision, "float16")
+        self.assertEqual(pipeline.stages[0]["config_type"], "OpPalettizerConfig")
+        self.assertEqual(pipeline.stages[0]["global_config"]["nbits"], 6)
+        # `linear` is an op type, not the name of a weight.
+        self.assertEqual(pipeline.stages[0]["op_type_configs"]["linear"], {"mode": "kmeans", "nbits": 4})
+        self.assertIsNone(pipeline.stages[0]["op_type_configs"]["gather"])
+        self.assertNotIn("op_name_configs", pipeline.stages[0])
+
+        with self.assertRaises(ValueError):
+            get_compression_pipeline("int3")
+
+    def test_builtin_op_names_resolve(self):
+        from exporters.coreml.compression import BUILTIN_PIPELINES, resolve_op_names
+
+        # Typical constant names of a converted decoder.
+        const_names = [
+            "model_embed_tokens_weight_to_fp16",
+            "model_layers_0_self_attn_q_proj_weight_to_fp16",
+            "model_layers_0_self_attn_o_proj_weight_to_fp16",
+            "model_layers_0_mlp_up_proj_weight_to_fp16",
+            "model_layers_0_mlp_down_proj_weight_to_fp16",
+            "model_norm_weight_to_fp16",
+            "lm_head_weight_to_fp16",
+        ]
+        for name in BUILTIN_PIPELINES:
+            for stage in get_compression_pipeline(name).stages:
+                # This is what `CompressionPipeline.apply` does for every stage, and it must not fail.
+                resolve_op_names(stage.get("op_name_configs") or {}, const_names)
+
+    def test_from_file(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = Path(tmp_dir) / "prune-palettize.json"
+            path.write_text(json.dumps({
+                "stages": [
+                    {"config_type": "OpMagnitudePrunerConfig", "global_config": {"target_sparsity": 0.5}},
+                    {"config_type": "OpPalettizerConfig", "global_config": {"mode": "kmeans", "nbits": 4}},
+                ],
+            }))
+            pipeline = get_compression_pipeline(path.as_posix())
+            self.assertEqual(get_variant_name(path.as_posix()), "prune-palettize")
+
+        self.assertEqual(pipeline.name, "prune-palettize")
+        self.assertEqual([stage["config_type"] for stage in pipeline.stages], ["OpMagnitudePrunerConfig", "OpPalettizerConfig"])
+        self.assertEqual(CompressionPipeline.from_dict(pipeline.to_dict()).stages, pipeline.stages)
+
+    def test_pipeline_file_is_read_once(self):
+        from unittest import mock
+        from exporters.coreml import compression
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = Path(tmp_dir) / "int8.json"
+            path.write_text(json.dumps({"config_type": "OpLinearQuantizerConfig", "global_config": {"dtype": "int8"}}))
+
+            with mock.patch.object(compression.json, "load", wraps=json.load) as load:
+                self.assertTrue(is_pipeline_file(path.as_posix()))
+                for _ in range(3):
+                    self.assertEqual(get_compression_pipeline(path.as_posix()).stages[0]["global_config"]["dtype"], "int8")
+                self.assertEqual(load.call_count, 1)
+
+                # Changes to the file are picked up.
+                path.write_text(json.dumps({"stages": [], "compute_precision": "float32"}))
+                os.utime(path, ns=(0, 0))
+                self.assertEqual(get_compression_pipeline(path.as_posix()).compute_precision, "float32")
+                self.assertEqual(load.call_count, 2)
+
+    def test_single_stage(self):
+        pipeline = CompressionPipeline.from_dict({"config_type": "OpLinearQuantizerConfig", "global_config": {"dtype": "int8"}})
+        self.assertEqual(len(pipeline.stages), 1)
+
+        with self.assertRaises(ValueError):
+            CompressionPipeline([{"config_type": "OpUnknownConfig"}])
+
+    def test_joint_compression(self):
+        prune = {"config_type": "OpMagnitudePrunerConfig", "global_config": {"target_sparsity": 0.5}}
+        palettize = {"config_type": "OpPalettizerConfig", "joint_compression": True, "global_config": {"mode": "kmeans", "nbits": 4}}
+        pipeline = CompressionPipeline([prune, palettize])
+        self.assertTrue(pipeline.to_dict()["stages"][1]["joint_compression"])
+
+        # There is nothing to palettize jointly without pruning first.
+        with self.assertRaises(ValueError):
+            CompressionPipeline([palettize])
+        with self.assertRaises(ValueError):
+            CompressionPipeline([{**prune, "joint_compression": True}])
+
+    @require_coreml
+    def test_compress_variants(self):
+        import numpy as np
+        import coremltools as ct
+        from coremltools.converters.mil import Builder as mb
+        from exporters.coreml.convert import compress_variants
+
+        weight = np.random.default_rng(0).standard_normal((64, 64)).astype(np.float32)
+
+        @mb.program(input_specs=[mb.TensorSpec(shape=(1, 64))])
+        def program(x):
+            return mb.linear(x=x, weight=weight)
+
+        mlmodel = ct.convert(program, convert_to="mlprogram", skip_model_load=True)
+        config = TextCoreMLConfig(None, task="feature-extraction")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = Path(tmp_dir) / "no-compression.json"
+            path.write_text(json.dumps({"stages": []}))
+            variants = ["float16", path.as_posix(), "int8"]
+            mlmodels = compress_variants(mlmodel, config, variants)
+
+            # The variants without compression stages do not share the converted model.
+            self.assertEqual(list(mlmodels.keys()), ["int8", "float16", path.as_posix()])
+            self.assertEqual(len(set(id(m) for m in mlmodels.values())), 3)
+            self.assertIs(mlmodels[path.as_posix()], mlmodel)
+            for variant, name in [("float16", "float16"), (path.as_posix(), "no-compression"), ("int8", "int8")]:
+                self.assertEqual(mlmodels[variant].user_defined_metadata["co.huggingface.exporters.precision"], name)
+            self.assertNotIn("co.huggingface.exporters.compression", mlmodels["float16"].user_defined_metadata)
+            self.assertIn("co.huggingface.exporters.compression", mlmodels["int8"].user_defined_metadata)
+
+            for variant, model in mlmodels.items():
+                model.save(os.path.join(tmp_dir, f"{get_variant_name(variant)}.mlpackage"))
+
+
+class PalettizationSearchTestCase(TestCase):
+    def test_solve_bit_allocation(self):
+        from exporters.coreml.sensitivity import solve_bit_allocation
+
+        sensitivity = {"a": {2: 0.5, 4: 0.1, 8: 0.01}, "b": {2: 0.02, 4: 0.005, 8: 0.001}}
+        num_parameters = {"a": 1000000, "b": 1000000}
+
+        # Everything fits uncompressed.
+        plan, size, error = solve_bit_allocation(sensitivity, num_parameters, max_size=4e6)
+        self.assertEqual(plan, {"a": 16, "b": 16})
+        self.assertEqual(error, 0.0)
+
+        # The insensitive layer gets fewer bits.
+        plan, size, error = solve_bit_allocation(sensitivity, num_parameters, max_size=1.5e6)
+        self.assertLessEqual(size, 1.5e6)
+        self.assertGreater(plan["a"], plan["b"])
+
+        plan, size, error = solve_bit_allocation(sensitivity, num_parameters, max_error=0.05)
+        self.assertLessEqual(error, 0.05)
+        self.assertEqual(plan, {"a": 8, "b": 2})
+
+    def test_resolve_op_names(self):
+        from exporters.coreml.compression import resolve_op_names
+
+        const_names = [
+            "model_model_layers_0_mlp_up_proj_weight_to_fp16",
+            "model_model_layers_10_mlp_up_proj_weight_to_fp16",
+        ]
+        resolved = resolve_op_names(
+            {"model.layers.0.mlp.up_proj.weight": {"nbits": 4}, "model.layers.1.mlp.up_proj.weight": None},
+            const_names,
+        )
+        self.assertEqual(resolved, {"model_model_layers_0_mlp_up_proj_weight_to_fp16": {"nbits": 4}})
+
+        # A weight that should be compressed but is not in the model is an error.
+        with self.assertRaises(ValueError):
+            resolve_op_names({"model.layers.1.mlp.up_proj.weight": {"nbits": 4}}, const_names)
+
+    @require_torch
+    def test_palettize_tensor(self):
+        import torch
+        from exporters.coreml.sensitivity import palettize_tensor
+
+        weight = torch.randn(64, 64)
+        palettized = palettize_tensor(weight, 3)
+        self.assertEqual(palettized.shape, weight.shape)
+        self.assertLessEqual(len(torch.unique(palettized)), 8)
+        self.assertLess((palettized - weight).abs().mean(), (palettize_tensor(weight, 1) - weight).abs().mean())
+
+
+class ParallelPalettizationTestCase(TestCase):
+    def test_read_blob_metadata(self):
+        import numpy as np
+        from exporters.coreml.palettization import _read_blob_metadata
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "weight.bin")
+            header = np.zeros(16, dtype=np.uint32)
+            header[:2] = [0xDEADBEEF, 1]
+            header[2:6].view(np.uint64)[:] = [128, 192]
+            with open(path, "wb") as f:
+                f.write(np.zeros(64, dtype=np.uint8).tobytes() + header.tobytes())
+
+            dtype, size, offset = _read_blob_metadata(path, 64)
+            self.assertEqual((dtype, size, offset), (np.float16, 128, 192))
+            with self.assertRaises(ValueError):
+                _read_blob_metadata(path, 0)
+
+    def test_histogram_kmeans(self):
+        import numpy as np
+        from exporters.coreml.palettization import histogram_kmeans
+
+        rng = np.random.default_rng(0)
+        weight = (rng.standard_normal((256, 256)) * 0.02).astype(np.float16)
+        lut, indices = histogram_kmeans(4, weight)
+        self.assertEqual(lut.shape, (16,))
+        self.assertEqual(lut.dtype, np.float16)
+        self.assertEqual(indices.shape, (weight.size,))
+        self.assertLess(indices.max(), 16)
+
+        # Close to the optimal 4-bit quantizer of a Gaussian, with a distortion of 0.0095 sigma^2.
+        error = np.mean((lut.astype(np.float64)[indices] - weight.reshape(-1)) ** 2)
+        self.assertLess(error, 0.0105 * 0.02**2)
+
+        # Weights with fewer distinct values than clusters are represented exactly.
+        weight = np.array([[1.0, 2.0], [3.0, 3.0]], dtype=np.float32)
+        lut, indices = histogram_kmeans(2, weight)
+        np.testing.assert_array_equal(lut[indices], weight.reshape(-1))
+
+    def test_histogram_kmeans_is_optimal(self):
+        import itertools
+        import numpy as np
+        from exporters.coreml.palettization import histogram_kmeans
+
+        rng = np.random.default_rng(0)
+        for _ in range(20):
+            values = np.sort(rng.choice(np.arange(-50, 50), size=9, replace=False)).astype(np.float32) / 7
+            counts = rng.integers(1, 6, size=len(values))
+            weight = rng.permutation(np.repeat(values, counts))
+
+            for nbits in (1, 2):
+                lut, indices = histogram_kmeans(nbits, weight)
+                error = np.sum((lut.astype(np.float64)[indices] - weight) ** 2)
+
+                # Every clustering of the sorted values into contiguous ranges.
+                best = np.inf
+                for splits in itertools.combinations(range(1, len(values)), 2 ** nbits - 1):
+                    bounds = (0,) + splits + (len(values),)
+                    total = 0.0
+                    for start, end in zip(bounds[:-1], bounds[1:]):
+                        cluster = np.repeat(values[start:end].astype(np.float64), counts[start:end])
+                        total += np.sum((cluster - cluster.mean()) ** 2)
+                    best = min(best, total)
+                self.assertAlmostEqual(error, best, delta=best * 1e-5)
+
+    @parameterized.expand([
+        # coremltools 7, where the k-means clustering runs in the workers.
+        (True,),
+        # Other versions, where coremltools clusters the weights itself.
+        (False,),
+    ])
+    @require_coreml
+    def test_parallel_palettization_matches_serial(self, kmeans_lut_supported):
+        from unittest import mock
+        import numpy as np
+        import coremltools as ct
+        import coremltools.optimize.coreml as cto
+        from coremltools.converters.mil import Builder as mb
+        from exporters.coreml import palettization
+        from exporters.coreml.palettization import ParallelPalettizer
+
+        if kmeans_lut_supported and not palettization.is_kmeans_lut_supported():
+            self.skipTest(f"the k-means clustering of coremltools {ct.__version__} cannot be called directly")
+
+        rng = np.random.default_rng(0)
+        weights = [rng.standard_normal((64, 64)).astype(np.float32) for _ in range(3)]
+
+        @mb.program(input_specs=[mb.TensorSpec(shape=(1, 64))])
+        def program(x):
+            for weight in weights:
+                x = mb.linear(x=x, weight=weight)
+            return x
+
+        mlmodel = ct.convert(program, convert_to="mlprogram", skip_model_load=True)
+        config = cto.OptimizationConfig(global_config=cto.OpPalettizerConfig(mode="kmeans", nbits=4))
+
+        serial = cto.palettize_weights(mlmodel, config=config)
+        palettizer = ParallelPalettizer(num_workers=2)
+        with mock.patch.object(palettization, "is_kmeans_lut_supported", return_value=kmeans_lut_supported):
+            parallel = palettizer.palettize(mlmodel, config)
+
+        self.assertEqual(palettizer.timings.get("num_weights", 0), 3 if kmeans_lut_supported else 0)
+        self.assertEqual(serial._spec.SerializeToString(), parallel._spec.SerializeToString())
+        with open(os.path.join(serial.weights_dir, "weight.bin"), "rb") as f1:
+            with open(os.path.join(parallel.weights_dir, "weight.bin"), "rb") as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+
+class DeduplicateWeightsTestCase(TestCase):
+    @require_coreml
+    def test_deduplicate_weights(self):
+        import numpy as np
+        import coremltools as ct
+        from coremltools.converters.mil import Builder as mb
+        from exporters.coreml.dedup import deduplicate_weights
+
+        rng = np.random.default_rng(0)
+        shared = rng.standard_normal((64, 64)).astype(np.float32)
+        other = rng.standard_normal((64, 64)).astype(np.float32)
+
+        @mb.program(input_specs=[mb.TensorSpec(shape=(1, 64))])
+        def program(x):
+            x = mb.linear(x=x, weight=shared)
+            x = mb.linear(x=x, weight=other)
+            return mb.linear(x=x, weight=shared.copy())
+
+        mlmodel = ct.convert(program, convert_to="mlprogram", skip_model_load=True)
+        report = deduplicate_weights(mlmodel)
+        self.assertEqual(report["num_unique_blobs"], report["num_blobs"] - 1)
+        self.assertLess(report["bytes_after"], report["bytes_before"])
+
+        # Nothing left to share.
+        report = deduplicate_weights(mlmodel)
+        self.assertEqual(report["num_unique_blobs"], report["num_blobs"])
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            mlmodel.save(os.path.join(tmp_dir, "Model.mlpackage"))
+
+
+class KeyValueCacheTestCase(TestCase):
+    def test_kv_cache_config(self):
+        model_config = AutoConfig.for_model("gpt2", n_layer=2)
+        with pytest.raises(ValueError):
+            TextCoreMLConfig(None, task="text-generation", kv_cache="stateful")
+        with pytest.raises(ValueError):
+            TextCoreMLConfig(None, task="feature-extraction", use_past=True, kv_cache="stateful")
+        with pytest.raises(ValueError):
+            TextCoreMLConfig(None, task="text-generation", use_past=True, kv_cache="unknown")
+        with pytest.raises(ValueError):
+            TextCoreMLConfig(None, task="text-generation", use_past=True, kv_cache="stateful", new_kv_only=True)
+
+        config = TextCoreMLConfig.with_past(model_config, task="text-generation", kv_cache="stateful", max_context_length=32)
+        self.assertEqual(list(config.inputs.keys()), ["input_ids", "position"])
+        self.assertEqual(list(config.outputs.keys()), ["logits"])
+        self.assertEqual(config.max_context_length, 32)
+        self.assertEqual(len(config.get_flexible_outputs()), 0)
+
+        config = TextCoreMLConfig.with_past(model_config, task="text-generation", kv_cache="static", max_context_length=32)
+        self.assertEqual(list(config.inputs.keys())[:3], ["input_ids", "position", "past_key_values_0_key"])
+        self.assertEqual(len(config.get_flexible_outputs()), 0)
+
+        config = TextCoreMLConfig.with_past(model_config, task="text-generation", stack_kv_cache=True)
+        self.assertEqual(list(config.inputs.keys()), ["input_ids", "attention_mask", "past_key_values"])
+        self.assertEqual(list(config.outputs.keys()), ["logits", "present_key_values"])
+        self.assertEqual(config.get_flexible_outputs()["present_key_values"][0]["axis"], 4)
+
+    def test_kv_cache_dtype(self):
+        model_config = AutoConfig.for_model("gpt2", n_layer=2)
+        with pytest.raises(ValueError):
+            TextCoreMLConfig.with_past(model_config, task="text-generation", kv_cache_dtype="bfloat16")
+        with pytest.raises(ValueError):
+            TextCoreMLConfig.with_past(model_config, task="text-generation", kv_cache="stateful", kv_cache_dtype="int8")
+
+        config = TextCoreMLConfig.with_past(model_config, task="text-generation")
+        self.assertEqual(config.get_kv_cache_io_dtypes("float16"), (np.float16, np.float16))
+        self.assertEqual(config.get_kv_cache_io_dtypes("float32"), (np.float32, np.float32))
+
+        config = TextCoreMLConfig.with_past(model_config, task="text-generation", kv_cache_dtype="float32")
+        self.assertEqual(config.get_kv_cache_io_dtypes("float16"), (np.float32, np.float32))
+
+        config = TextCoreMLConfig.with_past(model_config, task="text-generation", kv_cache_dtype="int8")
+        self.assertEqual(config.get_kv_cache_io_dtypes("float16"), (np.int8, np.float16))
+        self.assertEqual(
+            list(config.inputs.keys())[2:6],
+            ["past_key_values_0_key", "past_key_values_0_value", "past_key_values_0_key_scale", "past_key_values_0_value_scale"],
+        )
+        self.assertEqual(list(config.outputs.keys())[3:5], ["present_0_key_scale", "present_0_value_scale"])
+
+    def test_prefill_functions(self):
+        model_config = AutoConfig.for_model("gpt2", n_layer=2)
+        with pytest.raises(ValueError):
+            TextCoreMLConfig.with_past(model_config, task="text-generation", prefill_length=16)
+        with pytest.raises(ValueError):
+            TextCoreMLConfig.with_past(
+                model_config, task="text-generation", kv_cache="static", max_context_length=32, prefill_length=64
+            )
+
+        config = TextCoreMLConfig.with_past(model_config, task="text-generation", kv_cache="static")
+        self.assertEqual(config.functions, [])
+
+        config = TextCoreMLConfig.with_past(
+            model_config, task="text-generation", kv_cache="stateful", max_context_length=32, prefill_length=16
+        )
+        self.assertEqual(config.functions, ["prefill", "decode"])
+        prefill_config = config.get_function_config("prefill")
+        decode_config = config.get_function_config("decode")
+        self.assertEqual(prefill_config.functions, [])
+        self.assertEqual(prefill_config.inputs["input_ids"].sequence_length, 16)
+        self.assertEqual(decode_config.inputs["input_ids"].sequence_length, 1)
+        self.assertEqual(prefill_config.states, decode_config.states)
+        self.assertIsNone(config.function)
+
+    def test_grouped_query_attention(self):
+        from exporters.coreml.models import FalconCoreMLConfig, GPTBigcodeCoreMLConfig, MistralCoreMLConfig
+
+        model_config = AutoConfig.for_model(
+            "mistral", hidden_size=4096, num_attention_heads=32, num_key_value_heads=8, num_hidden_layers=2
+        )
+        config = MistralCoreMLConfig.with_past(model_config, task="text-generation", kv_cache="static", max_context_length=16)
+        self.assertEqual(config.kv_cache_shape, (1, 8, 16, 128))
+
+        model_config = AutoConfig.for_model("falcon", hidden_size=256, num_attention_heads=8, multi_query=True)
+        config = FalconCoreMLConfig.with_past(model_config, task="text-generation")
+        self.assertEqual(config.num_key_value_heads, 1)
+
+        model_config = AutoConfig.for_model(
+            "falcon", hidden_size=256, num_attention_heads=8, new_decoder_architecture=True, num_kv_heads=2
+        )
+        config = FalconCoreMLConfig.with_past(model_config, task="text-generation")
+        self.assertEqual(config.num_key_value_heads, 2)
+
+        # GPTBigCode's fused key / value cache is not supported.
+        model_config = AutoConfig.for_model("gpt_bigcode", n_embd=256, n_head=8, multi_query=True)
+        with self.assertRaises(ValueError):
+            GPTBigcodeCoreMLConfig.with_past(model_config, task="text-generation")
+
+    @parameterized.expand([
+        ("static", False, False),
+        ("stateful", False, False),
+        ("dynamic", True, False),
+        ("static", True, False),
+        ("dynamic", False, True),
+        ("static", True, True),
+    ])
+    @require_torch
+    def test_cache_matches_past_key_values(self, kv_cache, new_kv_only, stack_kv_cache):
+        import torch
+        from transformers import GPT2Config, GPT2LMHeadModel
+        from exporters.coreml.models import GPT2CoreMLConfig
+        from exporters.coreml.validate import validate_kv_cache
+
+        torch.manual_seed(0)
+        model_config = GPT2Config(n_embd=32, n_layer=2, n_head=4, n_positions=64, vocab_size=100)
+        model = GPT2LMHeadModel(model_config).eval()
+        config = GPT2CoreMLConfig.with_past(
+            model_config, task="text-generation", kv_cache=kv_cache, max_context_length=16,
+            new_kv_only=new_kv_only, stack_kv_cache=stack_kv_cache,
+        )
+        self.assertEqual(config.kv_cache_shape, (1, 4, 16, 8))
+        if kv_cache == "stateful":
+            self.assertEqual(list(config.states.keys())[:2], ["key_cache_0", "value_cache_0"])
+
+        input_ids = torch.randint(0, model_config.vocab_size, (1, 10))
+        max_diff = validate_kv_cache(config, model, input_ids, atol=1e-4)
+        self.assertLess(max_diff, 1e-4)
+
+    @parameterized.expand([
+        ("static",),
+        ("stateful",),
+    ])
+    @require_torch
+    def test_prefill_matches_past_key_values(self, kv_cache):
+        import torch
+        from transformers import GPT2Config, GPT2LMHeadModel
+        from exporters.coreml.models import GPT2CoreMLConfig
+        from exporters.coreml.validate import validate_kv_cache
+
+        torch.manual_seed(0)
+        model_config = GPT2Config(n_embd=32, n_layer=2, n_head=4, n_positions=64, vocab_size=100)
+        model = GPT2LMHeadModel(model_config).eval()
+        config = GPT2CoreMLConfig.with_past(
+            model_config, task="text-generation", kv_cache=kv_cache, max_context_length=16, prefill_length=6,
+        )
+
+        input_ids = torch.randint(0, model_config.vocab_size, (1, 10))
+        max_diff = validate_kv_cache(config, model, input_ids, atol=1e-4)
+        self.assertLess(max_diff, 1e-4)
+
+    @parameterized.expand([
+        ("dynamic", False),
+        ("static", True),
+    ])
+    @require_torch
+    def test_int8_cache_matches_past_key_values(self, kv_cache, stack_kv_cache):
+        import torch
+        from transformers import GPT2Config, GPT2LMHeadModel
+        from exporters.coreml.models import GPT2CoreMLConfig
+        from exporters.coreml.validate import validate_kv_cache
+
+        torch.manual_seed(0)
+        model_config = GPT2Config(n_embd=32, n_layer=2, n_head=4, n_positions=64, vocab_size=100)
+        model = GPT2LMHeadModel(model_config).eval()
+        config = GPT2CoreMLConfig.with_past(
+            model_config, task="text-generation", kv_cache=kv_cache, max_context_length=16,
+            stack_kv_cache=stack_kv_cache, kv_cache_dtype="int8",
+        )
+
+        # The quantization error of the keys and values makes the logits a little different.
+        input_ids = torch.randint(0, model_config.vocab_size, (1, 10))
+        max_diff = validate_kv_cache(config, model, input_ids, atol=1e-2)
+        self.assertLess(max_diff, 1e-2)
+
+
+class ChunkedModelTestCase(TestCase):
+    def test_chunk_config(self):
+        from exporters.coreml.chunks import get_chunk_manifest
+
+        model_config = AutoConfig.for_model("llama", num_hidden_layers=10)
+        with pytest.raises(ValueError):
+            TextCoreMLConfig(model_config, task="feature-extraction", num_chunks=2)
+        with pytest.raises(ValueError):
+            TextCoreMLConfig(model_config, task="text-generation", num_chunks=11)
+        with pytest.raises(ValueError):
+            TextCoreMLConfig.with_past(model_config, task="text-generation", kv_cache="stateful", num_chunks=2)
+
+        config = TextCoreMLConfig.with_past(model_config, task="text-generation", num_chunks=3)
+        self.assertEqual(config.chunk_layers, [(0, 3), (3, 6), (6, 10)])
+
+        first, middle, last = [config.get_chunk_config(chunk) for chunk in range(3)]
+        self.assertEqual(middle.chunk_layers, [])
+        self.assertEqual(middle.layer_range, (3, 6))
+        self.assertEqual(list(first.inputs.keys())[:3], ["input_ids", "attention_mask", "past_key_values_0_key"])
+        self.assertEqual(list(middle.inputs.keys())[:3], ["hidden_states", "attention_mask", "past_key_values_3_key"])
+        self.assertEqual(len(middle.inputs), 2 + 3 * 2)
+        self.assertEqual(list(middle.outputs.keys())[:2], ["hidden_states", "present_3_key"])
+        self.assertEqual(list(last.outputs.keys())[:2], ["logits", "present_6_key"])
+        self.assertIn("present_9_value", last.get_flexible_outputs())
+
+        manifest = get_chunk_manifest(config)
+        self.assertEqual([chunk["layers"] for chunk in manifest["chunks"]], [[0, 3], [3, 6], [6, 10]])
+        self.assertEqual(manifest["hidden_states"], {"input": "hidden_states", "output": "next_hidden_states"})
+        json.dumps(manifest)
+
+    @parameterized.expand([
+        (False, "dynamic"),
+        (True, "dynamic"),
+        (True, "static"),
+    ])
+    @require_torch
+    def test_chunks_match_whole_model(self, use_past, kv_cache):
+        import torch
+        from transformers import LlamaConfig, LlamaForCausalLM
+        from exporters.coreml.models import LlamaCoreMLConfig
+        from exporters.coreml.validate import validate_chunks
+
+        torch.manual_seed(0)
+        model_config = LlamaConfig(
+            hidden_size=32, intermediate_size=64, num_hidden_layers=4, num_attention_heads=4, num_key_value_heads=2,
+            vocab_size=100, max_position_embeddings=64,
+        )
+        model = LlamaForCausalLM(model_config).eval()
+        config_options = {"kv_cache": kv_cache, "max_context_length": 16} if kv_cache != "dynamic" else {}
+        config = LlamaCoreMLConfig(
+            model_config, task="text-generation", use_past=use_past, num_chunks=3, **config_options
+        )
+
+        input_ids = torch.randint(0, model_config.vocab_size, (1, 8))
+        max_diff = validate_chunks(config, model, input_ids, atol=1e-4)
+        self.assertLess(max_diff, 1e-4)
+
+
+class CrossAttentionCacheTestCase(TestCase):
+    def test_cross_attention_cache_config(self):
+        model_config = AutoConfig.for_model("bart", encoder_layers=2, decoder_layers=3)
+        with pytest.raises(ValueError):
+            TextCoreMLConfig(model_config, task="text2text-generation", seq2seq="decoder", cross_attention_cache=True)
+        with pytest.raises(ValueError):
+            TextCoreMLConfig(model_config, task="text-generation", cross_attention_cache=True)
+        with pytest.raises(ValueError):
+            TextCoreMLConfig.with_past(
+                model_config, task="text2text-generation", seq2seq="decoder", stack_kv_cache=True,
+                cross_attention_cache=True,
+            )
+
+        encoder = TextCoreMLConfig(
+            model_config, task="text2text-generation", seq2seq="encoder", cross_attention_cache=True
+        )
+        self.assertEqual(encoder.num_decoder_layers, 3)
+        self.assertEqual(len(encoder.outputs), 1 + 3 * 2)
+        self.assertEqual(list(encoder.outputs.keys())[1:3], ["encoder_present_0_key", "encoder_present_0_value"])
+        self.assertEqual(encoder.get_flexible_outputs()["encoder_present_2_value"], [{"axis": 2, "min": 1, "max": -1}])
+
+        decoder = TextCoreMLConfig.with_past(
+            model_config, task="text2text-generation", seq2seq="decoder", cross_attention_cache=True
+        )
+        self.assertNotIn("encoder_outputs", decoder.inputs)
+        self.assertEqual(list(decoder.inputs.keys())[-6:-4], ["encoder_past_key_values_0_key", "encoder_past_key_values_0_value"])
+        self.assertEqual(sum(name.startswith("encoder_past_key_values") for name in decoder.inputs), 3 * 2)
+        self.assertEqual(list(decoder.outputs.keys()), ["logits"] + [
+            f"present_{i}_{kind}" for i in range(3) for kind in ["key", "value"]
+        ])
+
+    @require_torch
+    def test_cross_attention_cache_matches_model(self):
+        import torch
+        from transformers import BartConfig, BartForConditionalGeneration
+        from exporters.coreml.convert import Wrapper
+
+        torch.manual_seed(0)
+        model_config = BartConfig(
+            d_model=32, encoder_layers=2, decoder_layers=3, encoder_attention_heads=4, decoder_attention_heads=4,
+            encoder_ffn_dim=64, decoder_ffn_dim=64, vocab_size=100, max_position_embeddings=64,
+        )
+        model = BartForConditionalGeneration(model_config).eval()
+        encoder_config = TextCoreMLConfig(
+            model_config, task="text2text-generation", seq2seq="encoder", cross_attention_cache=True
+        )
+        decoder_config = TextCoreMLConfig.with_past(
+            model_config, task="text2text-generation", seq2seq="decoder", cross_attention_cache=True
+        )
+
+        input_ids = torch.randint(0, model_config.vocab_size, (1, 7))
+        attention_mask = torch.ones_like(input_ids)
+        decoder_input_ids = torch.tensor([[model_config.decoder_start_token_id, 5]])
+
+        with torch.no_grad():
+            reference = model(
+                input_ids=input_ids, attention_mask=attention_mask, decoder_input_ids=decoder_input_ids
+            ).logits
+
+            encoder_outputs = Wrapper(None, model, encoder_config)(input_ids, attention_mask)
+            self.assertEqual(len(encoder_outputs), 1 + 3 * 2)
+            cross_attention_cache = encoder_outputs[1:]
+
+            decoder = Wrapper(None, model, decoder_config)
+            head_dim = model_config.d_model // model_config.decoder_attention_heads
+            presents = [torch.zeros((1, model_config.decoder_attention_heads, 0, head_dim))] * (3 * 2)
+            for step in range(decoder_input_ids.shape[1]):
+                inputs = {
+                    "decoder_input_ids": decoder_input_ids[:, step:step + 1],
+                    "decoder_attention_mask": torch.ones((1, step + 1), dtype=torch.long),
+                    "attention_mask": attention_mask,
+                }
+                for i in range(3):
+                    inputs[f"past_key_values_{i}_key"] = presents[i * 2]
+                    inputs[f"past_key_values_{i}_value"] = presents[i * 2 + 1]
+                    inputs[f"encoder_past_key_values_{i}_key"] = cross_attention_cache[i * 2]
+                    inputs[f"encoder_past_key_values_{i}_value"] = cross_attention_cache[i * 2 + 1]
+                outputs = decoder(*[inputs[name] for name in decoder_config.inputs])
+                logits, presents = outputs[0], outputs[1:]
+                self.assertLess((logits[:, -1] - reference[:, step]).abs().max().item(), 1e-4)
+
+
+class ProfilerTestCase(TestCase):
+    def test_spans(self):
+        with profile_span("not recorded"):
+            pass
+
+        with Profiler() as profiler:
+            with profile_span("outer"):
+                with profile_span("inner", quantize="int8"):
+                    pass
+
+        with profile_span("not recorded either"):
+            pass
+
+        report = profiler.report()
+        self.assertEqual([span["name"] for span in report["spans"]], ["outer", "inner"])
+        inner = report["spans"][1]
+        self.assertEqual(inner["parent"], "outer")
+        self.assertEqual(inner["metadata"], {"quantize": "int8"})
+        self.assertGreater(inner["peak_rss"], 0)
+
+    def test_chrome_trace(self):
+        with Profiler() as profiler:
+            with profile_span("stage"):
+                pass
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = Path(tmp_dir) / "trace.json"
+            profiler.save_chrome_trace(path)
+            trace = json.loads(path.read_text())
+
+        self.assertEqual(len(trace["traceEvents"]), 1)
+        self.assertEqual(trace["traceEvents"][0]["name"], "stage")
+        self.assertEqual(trace["traceEvents"][0]["ph"], "X")
+
+
+@require_coreml
+class CommandLineTestCase(TestCase):
+    def _make_args(self, output, **kwargs):
+        from argparse import Namespace
+
+        options = dict(
+            output=Path(output), quantize=["float16"], kv_cache="dynamic", max_context_length=None,
+            prefill_length=None, new_kv_only=False, stack_kv_cache=False, cross_attention_cache=False,
+            kv_cache_dtype=None, sequence_lengths=None, batch_size=None, num_chunks=None, compute_units="all",
+            atol=None, print_artifacts=False, compression_workers=None,
+        )
+        options.update(kwargs)
+        return Namespace(**options)
+
+    def test_parse_quantize_options(self):
+        from exporters.coreml.__main__ import parse_quantize_options
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            pipeline_dir = Path(tmp_dir) / "pipelines"
+            pipeline_dir.mkdir()
+            pipeline_path = pipeline_dir / "int8-linear.json"
+            pipeline_path.write_text(json.dumps({"config_type": "OpLinearQuantizerConfig", "global_config": {"dtype": "int8"}}))
+
+            # Pipeline files in a recipes file are relative to the recipes file, not to the working directory.
+            recipes_path = Path(tmp_dir) / "recipes.json"
+            recipes_path.write_text(json.dumps({"variants": ["float16", "pipelines/int8-linear.json", "int4"]}))
+            variants = parse_quantize_options(["int4", recipes_path.as_posix()])
+            self.assertEqual(variants, ["int4", "float16", pipeline_path.as_posix()])
+
+            # A plain list of variants works too.
+            list_path = Path(tmp_dir) / "list.json"
+            list_path.write_text(json.dumps(["float32", "pipelines/int8-linear.json"]))
+            self.assertEqual(parse_quantize_options([list_path.as_posix()]), ["float32", pipeline_path.as_posix()])
+
+            with self.assertRaises(ValueError):
+                parse_quantize_options(["int3"])
+            recipes_path.write_text(json.dumps({"variants": ["float16", "int3"]}))
+            with self.assertRaises(ValueError):
+                parse_quantize_options([recipes_path.as_posix()])
+
+    @parameterized.expand([(None, ""), ("encoder", "encoder_")])
+    def test_variant_filenames(self, seq2seq, prefix):
+        from functools import partial
+        from types import SimpleNamespace
+        from unittest import mock
+        from exporters.coreml import __main__ as main_module
+
+        class SavedModel:
+            def save(self, path):
+                Path(path).write_text("model")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            pipeline_path = Path(tmp_dir) / "prune.json"
+            pipeline_path.write_text(json.dumps({
+                "config_type": "OpMagnitudePrunerConfig", "global_config": {"target_sparsity": 0.5}
+            }))
+            variants = ["float16", "int8", pipeline_path.as_posix()]
+            args = self._make_args(Path(tmp_dir) / "Model.mlpackage", quantize=variants)
+            model = SimpleNamespace(config=AutoConfig.for_model("distilbert"))
+            model_coreml_config = partial(TextCoreMLConfig, task="feature-extraction")
+
+            def export(preprocessor, model, config, quantize, **kwargs):
+                self.assertEqual(quantize, variants)
+                return {variant: SavedModel() for variant in quantize}
+
+            with mock.patch.object(main_module, "export", side_effect=export), \
+                    mock.patch.object(main_module, "_is_macos", return_value=False), \
+                    mock.patch.object(main_module, "logger", create=True):
+                paths = main_module._convert_model(None, model, model_coreml_config, args, seq2seq=seq2seq)
+
+            names = [f"{prefix}Model-{name}.mlpackage" for name in ["float16", "int8", "prune"]]
+            self.assertEqual(paths, [(Path(tmp_dir) / name).as_posix() for name in names])
+            for path in paths:
+                self.assertTrue(Path(path).is_file())
+
+    @require_torch
+    def test_get_load_options(self):
+        import torch
+        from unittest import mock
+        from exporters.coreml import __main__ as main_module
+
+        def estimate_export_memory(config, low_memory=False):
+            return 16 * 1024**3 if low_memory else 64 * 1024**3
+
+        def get_load_options(**kwargs):
+            options = dict(framework="pt", model="model", low_memory=False, max_memory=None, quantize=["int4"])
+            options.update(kwargs)
+            args = self._make_args("Model.mlpackage", **options)
+            return main_module.get_load_options(args), args.low_memory
+
+        with mock.patch.object(main_module.AutoConfig, "from_pretrained"), \
+                mock.patch.object(main_module, "estimate_export_memory", side_effect=estimate_export_memory), \
+                mock.patch.object(main_module, "logger", create=True) as logger, \
+                mock.patch.object(torch, "__version__", "2.1.0+cpu"):
+            self.assertEqual(get_load_options(), ({}, False))
+            self.assertEqual(get_load_options(framework="tf", max_memory=1024**3), ({}, False))
+
+            # Within the budget, the weights are loaded as usual.
+            self.assertEqual(get_load_options(max_memory=128 * 1024**3), ({}, False))
+
+            # Over the budget, --low_memory is enabled, and the weights are loaded in float16.
+            float16_options = {"low_memory": True, "torch_dtype": torch.float16}
+            self.assertEqual(get_load_options(max_memory=32 * 1024**3), (float16_options, True))
+            logger.warning.assert_called_once()
+            self.assertIn("validated in float16", logger.warning.call_args[0][0])
+            logger.reset_mock()
+
+            # Even with --low_memory, the budget can be too small, which is only a warning.
+            self.assertEqual(get_load_options(max_memory=8 * 1024**3), (float16_options, True))
+            self.assertEqual(logger.warning.call_count, 2)
+
+            # A float32 variant keeps the weights in float32.
+            options = get_load_options(max_memory=32 * 1024**3, quantize=["float32", "int4"])
+            self.assertEqual(options, ({"low_memory": True}, True))
+
+            with mock.patch.object(torch, "__version__", "2.0.1"):
+                self.assertEqual(get_load_options(low_memory=True), ({"low_memory": True}, True))
+
+    @require_torch
+    def test_parallel_seq2seq_worker(self):
+        from types import SimpleNamespace
+        from unittest import mock
+        from exporters.coreml import __main__ as main_module
+
+        model = SimpleNamespace(config=None)
+        args = self._make_args("Model.mlpackage", low_memory=False, cache_dir=None)
+        calls = []
+
+        def load_model(args):
+            calls.append(("load_model", args.low_memory))
+            return None, model, None
+
+        def convert_model(preprocessor, model, model_coreml_config, args, use_past, seq2seq, cache):
+            calls.append(("convert_model", seq2seq, use_past, cache.get_weights_hash(model)))
+            return [f"{seq2seq}_Model.mlpackage"]
+
+        with mock.patch.object(main_module, "load_model", side_effect=load_model), \
+                mock.patch.object(main_module, "convert_model", side_effect=convert_model):
+            paths, _, spans = main_module._convert_model_in_worker(args, "decoder", True, 1, "abc", 20, False)
+
+        # The worker loads the weights like the parent, so the parent's hash of them is valid.
+        self.assertEqual(calls, [("load_model", False), ("convert_model", "decoder", True, "abc")])
+        self.assertEqual(paths, ["decoder_Model.mlpackage"])
+        self.assertIsNone(spans)
+
+    def test_parallel_seq2seq(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from types import SimpleNamespace
+        from unittest import mock
+        from exporters.coreml import __main__ as main_module
+
+        def convert_model(preprocessor, model, model_coreml_config, args, use_past=False, seq2seq=None, cache=None):
+            return [f"{seq2seq}_Model-{variant}.mlpackage" for variant in args.quantize]
+
+        def convert_model_in_worker(args, seq2seq, use_past, num_threads, weights_hash, log_level, profile):
+            # Every half gets half of the palettization workers.
+            self.assertEqual(args.compression_workers, 2)
+            self.assertIsNone(weights_hash)
+            return convert_model(None, None, None, args, use_past=use_past, seq2seq=seq2seq), 0.0, None
+
+        def executor(max_workers, mp_context):
+            self.assertEqual(mp_context.get_start_method(), "spawn")
+            return ThreadPoolExecutor(max_workers)
+
+        model = SimpleNamespace(config=None)
+        with mock.patch.object(main_module, "convert_model", side_effect=convert_model), \
+                mock.patch.object(main_module, "_convert_model_in_worker", side_effect=convert_model_in_worker), \
+                mock.patch.object(main_module, "ProcessPoolExecutor", side_effect=executor), \
+                mock.patch.object(main_module, "logger", create=True):
+            args = self._make_args("Model.mlpackage", quantize=["float16", "int4"], use_past=True, compression_workers=4)
+            args.parallel_seq2seq = False
+            sequential_paths = main_module.convert_seq2seq_model(None, model, None, args)
+            args.parallel_seq2seq = True
+            parallel_paths = main_module.convert_seq2seq_model(None, model, None, args)
+
+        self.assertEqual(parallel_paths, sequential_paths)
+        self.assertEqual(parallel_paths[0], "encoder_Model-float16.mlpackage")
+
 
 PYTORCH_EXPORT_MODELS = {
     ("beit", "microsoft/beit-base-patch16-224"),